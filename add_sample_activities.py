@@ -1,4 +1,5 @@
-from main import app, db, Activity
+from wsgi import create_app
+from models import db, Activity
 from datetime import date
 
 sample_activities = [
@@ -28,6 +29,7 @@ sample_activities = [
     }
 ]
 
+app = create_app()
 with app.app_context():
     for activity_data in sample_activities:
         activity = Activity(**activity_data)
@@ -1,66 +1,58 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from flask import Blueprint, request, jsonify, current_app
 from models import db, Trip, Activity, Todo
 import os
-from dotenv import load_dotenv
-from werkzeug.urls import url_quote
 import logging
 from sqlalchemy import inspect
+from sqlalchemy.orm.exc import StaleDataError
 from datetime import datetime
+import pagination
+import serialization
+from response_cache import trip_cached
+import budget
+import conflicts
+import bulk
+import migrations
+import gazetteer
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-print("Starting to load environment variables...")
-load_dotenv()
-print("Environment variables loaded.")
+# Trip CRUD and budget API; served by the app from wsgi.create_app().
+bp = Blueprint('api', __name__)
 
-print("Creating Flask app...")
-app = Flask(__name__)
-CORS(app)
-print("Flask app created and CORS initialized.")
-
-# Database configuration
-print("Configuring database...")
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY')
-print(f"Database URL: {app.config['SQLALCHEMY_DATABASE_URI']}")
-print(f"Secret Key set: {'Yes' if app.config['SECRET_KEY'] else 'No'}")
-
-print("Initializing database...")
-db.init_app(app)
-print("Database initialized.")
-
-def init_db():
+def init_db(app):
     with app.app_context():
-        inspector = inspect(db.engine)
-        if not inspector.has_table("trip"):
-            logger.info("Creating database tables...")
-            db.create_all()
-            logger.info("Database tables created.")
+        applied = migrations.upgrade(db.engine)
+        if applied:
+            logger.info(f"Applied migrations: {', '.join(applied)}")
         else:
-            logger.info("Database tables already exist.")
+            logger.info("Database schema is up to date.")
 
-@app.route('/')
+@bp.route('/api')
 def root():
     return jsonify({"message": "Welcome to the Trip Planner API"}), 200
 
-@app.route('/api/health')
+@bp.route('/api/health')
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
-@app.route('/api/test')
+@bp.route('/api/test')
 def test():
     return jsonify({"message": "Test route is working"}), 200
 
-@app.route('/api/trips', methods=['GET', 'POST'])
+@bp.route('/api/trips', methods=['GET', 'POST'])
 def trips():
     if request.method == 'GET':
+        try:
+            projection = serialization.Projection(serialization.TRIP_FIELDS, request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        query = projection.query(*pagination.TRIP_KEYSET.columns)
+        if pagination.wants_paging(request.args):
+            return pagination.list_response(pagination.TRIP_KEYSET, query, request.args, projection.serialize)
         logger.debug("Fetching all trips")
-        all_trips = Trip.query.all()
+        all_trips = projection.serialize_all(query)
         logger.debug(f"Found {len(all_trips)} trips")
-        return jsonify([trip.to_dict() for trip in all_trips])
+        return serialization.json_response(all_trips)
     elif request.method == 'POST':
         data = request.json
         logger.debug(f"Received POST request with data: {data}")
@@ -74,7 +66,8 @@ def trips():
         logger.debug(f"Created new trip: {new_trip.to_dict()}")
         return jsonify(new_trip.to_dict()), 201
 
-@app.route('/api/trips/<int:trip_id>', methods=['GET', 'PUT', 'DELETE'])
+@bp.route('/api/trips/<int:trip_id>', methods=['GET', 'PUT', 'DELETE'])
+@trip_cached()
 def trip(trip_id):
     trip = Trip.query.get_or_404(trip_id)
     
@@ -82,17 +75,129 @@ def trip(trip_id):
         return jsonify(trip.to_dict())
     elif request.method == 'PUT':
         data = request.json
+        # With the version the client read, a write over someone else's
+        # change is refused instead of silently overwriting it.
+        if data.get('version') is not None and data['version'] != trip.version:
+            return jsonify({'error': 'trip was changed since it was read', 'current': trip.to_dict()}), 409
         trip.name = data.get('name', trip.name)
         trip.start_date = datetime.strptime(data.get('startDate', trip.start_date.isoformat()), '%Y-%m-%d').date()
         trip.end_date = datetime.strptime(data.get('endDate', trip.end_date.isoformat()), '%Y-%m-%d').date()
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return jsonify({'error': 'trip was changed since it was read',
+                            'current': Trip.query.get_or_404(trip_id).to_dict()}), 409
         return jsonify(trip.to_dict())
     elif request.method == 'DELETE':
         db.session.delete(trip)
         db.session.commit()
         return '', 204
 
-@app.route('/api/debug/db_schema')
+@bp.route('/api/trips/<int:trip_id>/budget')
+@trip_cached()
+def trip_budget(trip_id):
+    Trip.query.get_or_404(trip_id)
+    return jsonify(budget.trip_budget(db.session, trip_id))
+
+@bp.route('/api/trips/<int:trip_id>/conflicts')
+@trip_cached()
+def trip_conflicts(trip_id):
+    Trip.query.get_or_404(trip_id)
+    buffer = request.args.get('buffer', current_app.config.get('SCHEDULE_BUFFER_MINUTES', 0), type=float)
+    if buffer < 0:
+        return jsonify({'error': 'buffer must not be negative'}), 400
+    return jsonify({
+        'tripId': trip_id,
+        'bufferMinutes': buffer,
+        'conflicts': conflicts.trip_conflicts(db.session, Activity, trip_id, buffer)
+    })
+
+@bp.route('/api/trips/<int:trip_id>/activities/batch', methods=['POST'])
+def activity_batch(trip_id):
+    Trip.query.get_or_404(trip_id)
+    data = request.get_json(silent=True)
+    # Anything but an object is rejected by apply_batch with a BatchError.
+    allow_overlap = isinstance(data, dict) and bool(data.get('allowOverlap'))
+    try:
+        result = bulk.apply_batch(db.session, Activity, trip_id, data,
+                                  check_conflicts=not allow_overlap,
+                                  buffer=current_app.config.get('SCHEDULE_BUFFER_MINUTES', 0),
+                                  geocoder=gazetteer.get_geocoder(current_app))
+    except (bulk.ConflictError, bulk.StaleError) as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), 409
+    except bulk.BatchError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), 400
+    db.session.commit()
+    return jsonify(result)
+
+@bp.route('/api/trips/<int:trip_id>/activities/shift', methods=['POST'])
+def shift_activities(trip_id):
+    Trip.query.get_or_404(trip_id)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'expected an object with days and/or minutes'}), 400
+    days, minutes = data.get('days', 0), data.get('minutes', 0)
+    if not all(isinstance(value, int) and not isinstance(value, bool) for value in (days, minutes)):
+        return jsonify({'error': 'days and minutes must be integers'}), 400
+    if not (days or minutes):
+        return jsonify({'error': 'days or minutes is required'}), 400
+    try:
+        on_or_after = datetime.strptime(data['from'], '%Y-%m-%d').date() if data.get('from') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'from must be YYYY-MM-DD'}), 400
+    try:
+        ids = bulk.shift_activities(db.session, Activity, trip_id, days, minutes, on_or_after,
+                                    check_conflicts=not data.get('allowOverlap'),
+                                    buffer=current_app.config.get('SCHEDULE_BUFFER_MINUTES', 0))
+    except bulk.ConflictError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), 409
+    except bulk.BatchError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), 400
+    db.session.commit()
+    return jsonify({'tripId': trip_id, 'shifted': len(ids)})
+
+@bp.route('/api/trips/<int:trip_id>/reschedule', methods=['POST'])
+def reschedule_trip(trip_id):
+    trip = Trip.query.get_or_404(trip_id)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'expected an object with startDate'}), 400
+    try:
+        start_date = datetime.strptime(data['startDate'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(data['endDate'], '%Y-%m-%d').date() if data.get('endDate') else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'startDate (and optional endDate) must be YYYY-MM-DD'}), 400
+    version = data.get('version')
+    if version is not None and (not isinstance(version, int) or isinstance(version, bool)):
+        return jsonify({'error': 'version must be an integer'}), 400
+    try:
+        result = bulk.reschedule_trip(db.session, Trip, Activity, trip, start_date, end_date, version=version)
+    except bulk.TripChangedError:
+        db.session.rollback()
+        return jsonify({'error': 'trip was changed since it was read',
+                        'current': Trip.query.get_or_404(trip_id).to_dict()}), 409
+    except bulk.BatchError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), 400
+    db.session.commit()
+    return jsonify(dict(result, tripId=trip_id))
+
+@bp.route('/api/budgets')
+def budgets():
+    try:
+        trip_ids = [int(value) for value in request.args.get('trip_ids', '').split(',') if value]
+    except ValueError:
+        return jsonify({'error': 'trip_ids must be a comma-separated list of integers'}), 400
+    if not trip_ids or len(trip_ids) > 1000:
+        return jsonify({'error': 'between 1 and 1000 trip_ids are required'}), 400
+    return jsonify(budget.trip_totals(db.session, trip_ids))
+
+@bp.route('/api/debug/db_schema')
 def db_schema():
     logger.debug("Fetching database schema")
     inspector = inspect(db.engine)
@@ -105,7 +210,10 @@ def db_schema():
     return jsonify(schema)
 
 if __name__ == '__main__':
-    init_db()  # Initialize the database before running the app
+    from wsgi import create_app
+    logging.basicConfig(level=logging.DEBUG)
+    app = create_app()
+    init_db(app)  # Initialize the database before running the app
     port = int(os.getenv('PORT', 8080))
     logger.info(f"Starting Flask server on port {port}...")
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,393 @@
+# Endpoint load benchmark. Seeds BENCH_DATABASE_URL (a fresh SQLite file by
+# default) with synthetic_data, drives every route of routes.py, app.py and
+# main.py, plus /api/debug/metrics, through the Flask test client and reports
+# throughput and latency percentiles per endpoint as JSON. Runs with the same
+# seed and sizes are comparable across commits:
+#
+#   python bench_endpoints.py --output before.json
+#   ... change something ...
+#   python bench_endpoints.py --compare before.json --threshold 15
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PERCENTILES = (0.5, 0.9, 0.95, 0.99)
+# Latency changes below this many milliseconds are noise, whatever the ratio.
+NOISE_FLOOR_MS = 0.2
+
+# path and data are called with (ctx, n) so each request can vary its ids;
+# read, when set, consumes a streamed response and returns its size.
+Case = namedtuple('Case', 'name app method path data read', defaults=(None,))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark every HTTP endpoint against synthetic data.')
+    parser.add_argument('--trips', type=int, default=20)
+    parser.add_argument('--activities', type=int, default=300, help='activities per trip')
+    parser.add_argument('--todos', type=int, default=20, help='todos per trip')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=100, help='timed requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per endpoint')
+    parser.add_argument('--cold', action='store_true', help='clear the response and fragment caches before every request')
+    parser.add_argument('--only', help='comma-separated substrings; run matching endpoints only')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON report to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0, help='p95 regression (%%) that fails --compare')
+    return parser.parse_args()
+
+
+def _database_url():
+    url = os.getenv('BENCH_DATABASE_URL')
+    if url:
+        return url
+    path = os.path.join(tempfile.gettempdir(), 'viettrip-bench.db')
+    if os.path.exists(path):
+        os.remove(path)
+    return f'sqlite:///{path}'
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _provider():
+    # Canned upstream answers: the weather and rate cases measure the gateway
+    # (cache, coalescing, snapshots), not the network.
+    import gateway
+
+    class BenchProvider(gateway.Provider):
+        async def forecast(self, latitude, longitude, start, end):
+            return [{'date': (start + timedelta(days=i)).isoformat(), 'tempMax': 31.0, 'tempMin': 24.0,
+                     'precipitation': 2.5, 'weatherCode': 3} for i in range((end - start).days + 1)]
+
+        async def rates(self, base):
+            return {'base': base, 'date': '2030-01-01', 'rates': {'VND': 25400.0, 'USD': 1.0, 'EUR': 0.92}}
+
+    return BenchProvider()
+
+
+def _apps(url):
+    sys.path.insert(0, ROOT)
+    from wsgi import create_app
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'SECRET_KEY': 'bench', 'DEBUG_METRICS': True,
+                      'GATEWAY_PROVIDER': _provider()})
+    logging.getLogger().setLevel(logging.WARNING)
+    # One app serves every module's routes; the case names keep the module.
+    return {'routes': app, 'app': app, 'main': app, 'instrumentation': app}
+
+
+def _setup(apps, args):
+    import migrations
+    import synthetic_data
+    import budget
+    from models import db, Trip, Activity, ChangeLog
+    from sqlalchemy import func
+
+    with apps['main'].app_context():
+        migrations.upgrade(db.engine)
+        trip_ids = synthetic_data.generate(db.session, args.trips, args.activities, args.todos, args.seed)
+        rows = db.session.query(Activity.id, Activity.trip_id, Activity.latitude, Activity.longitude) \
+            .filter(Activity.trip_id.in_(trip_ids)).order_by(Activity.id).all()
+        located = [row for row in rows if row.latitude is not None]
+        dates = dict(db.session.query(Trip.id, Trip.start_date).filter(Trip.id.in_(trip_ids)))
+
+        # Write endpoints get their own rows so they never disturb the data the
+        # read endpoints measure: a scratch trip, activities to edit and
+        # delete, and empty trips to delete.
+        count = args.warmup + args.iterations
+        scratch = synthetic_data.generate(db.session, 1, 0, 0, seed=args.seed + 1)[0]
+        pool = synthetic_data.insert_rows(db.session, Activity.__table__, [{
+            'trip_id': scratch, 'date': date(2030, 1, 1) + timedelta(days=n), 'title': f'Bench {n}',
+            'start_time': None, 'end_time': None, 'geohash': None
+        } for n in range(2 * count)])
+        empty_trips = synthetic_data.generate(db.session, 2 * count, 0, 0, seed=args.seed + 2)
+        budget.rebuild(db.session, [scratch])
+        token = db.session.query(func.max(ChangeLog.id)).scalar() or 0
+        db.session.commit()
+
+    return {
+        'trip_ids': trip_ids,
+        'trip_dates': dates,
+        'activity_ids': [row.id for row in rows],
+        'located': [(row.latitude, row.longitude) for row in located],
+        'scratch_trip': scratch,
+        'edit_activities': pool[:count],
+        'delete_activities': pool[count:],
+        'delete_trips': empty_trips[:count],
+        'api_delete_trips': empty_trips[count:],
+        'sync_token': token,
+        'search_terms': ['pho', 'hoi an', 'bun cha', 'cho dem', 'da lat', 'banh', 'check in', 'cooking class'],
+        'geocode_queries': ['Hoan Kiem Lake, Hanoi', 'Saigon', 'Danang', 'Hoi Ann', 'Cu Chi Tunnels', 'Mui Ne beach'],
+    }
+
+
+def _trip(ctx, n):
+    return ctx['trip_ids'][n % len(ctx['trip_ids'])]
+
+
+def _activity(ctx, n):
+    return ctx['activity_ids'][(n * 7919) % len(ctx['activity_ids'])]
+
+
+def _point(ctx, n):
+    return ctx['located'][(n * 104729) % len(ctx['located'])]
+
+
+def _viewport(ctx, n):
+    lat, lng = _point(ctx, n)
+    return f'south={lat - 0.5:.4f}&west={lng - 0.5:.4f}&north={lat + 0.5:.4f}&east={lng + 0.5:.4f}'
+
+
+def _activity_form(day, n):
+    return {
+        'title': f'Bench activity {n}', 'date': day.isoformat(), 'start_time': '08:00', 'end_time': '09:00',
+        'location': 'Hội An', 'category': 'Food', 'latitude': '15.8801', 'longitude': '108.3380',
+        'price': '45000', 'description': 'benchmark'
+    }
+
+
+def _import_form(ctx, n):
+    rows = ''.join(f'Import {n}-{i},2031-01-{1 + i % 28:02d},,,Huế,Food,16.46,107.59,30000,\n' for i in range(20))
+    return {'mode': 'stream', 'allow_overlap': '1',
+            'file': (io.BytesIO(('title,date,start,end,location,category,lat,lng,price,description\n' + rows).encode()),
+                     'bench.csv')}
+
+
+def _until_ready(response):
+    # An event stream never ends: read up to the `ready` event (after any
+    # replay), then hang up.
+    size = 0
+    try:
+        for chunk in response.response:
+            size += len(chunk)
+            if b'event: ready' in chunk:
+                break
+    finally:
+        response.close()
+    return size
+
+
+def _cases():
+    return [
+        # routes.py (server-rendered pages)
+        Case('routes GET /', 'routes', 'GET', lambda c, n: '/', None),
+        Case('routes GET /trip/<id>', 'routes', 'GET', lambda c, n: f'/trip/{_trip(c, n)}', None),
+        Case('routes GET /weekly_view/<id>', 'routes', 'GET', lambda c, n: f'/weekly_view/{_trip(c, n)}', None),
+        Case('routes GET /map_view/<id>', 'routes', 'GET', lambda c, n: f'/map_view/{_trip(c, n)}', None),
+        Case('routes GET /weather/<id>', 'routes', 'GET', lambda c, n: f'/weather/{_trip(c, n)}', None),
+        Case('routes GET /add_trip', 'routes', 'GET', lambda c, n: '/add_trip', None),
+        Case('routes GET /edit_trip/<id>', 'routes', 'GET', lambda c, n: f'/edit_trip/{_trip(c, n)}', None),
+        Case('routes GET /add_activity/<id>', 'routes', 'GET', lambda c, n: f'/add_activity/{_trip(c, n)}', None),
+        Case('routes GET /edit_activity/<id>', 'routes', 'GET', lambda c, n: f'/edit_activity/{_activity(c, n)}', None),
+        Case('routes GET /import_activities/<id>', 'routes', 'GET',
+             lambda c, n: f'/import_activities/{_trip(c, n)}', None),
+        Case('routes POST /add_trip', 'routes', 'POST', lambda c, n: '/add_trip',
+             lambda c, n: {'name': f'Bench trip {n}', 'start_date': '2030-01-01', 'end_date': '2030-01-10'}),
+        Case('routes POST /create_vietnam_trip', 'routes', 'POST', lambda c, n: '/create_vietnam_trip', None),
+        Case('routes POST /edit_trip/<id>', 'routes', 'POST', lambda c, n: f"/edit_trip/{c['scratch_trip']}",
+             lambda c, n: {'name': f'Scratch {n}', 'start_date': '2030-01-01', 'end_date': '2030-12-31'}),
+        Case('routes POST /add_activity/<id>', 'routes', 'POST', lambda c, n: f"/add_activity/{c['scratch_trip']}",
+             lambda c, n: _activity_form(date(2040, 1, 1) + timedelta(days=n), n)),
+        Case('routes POST /edit_activity/<id>', 'routes', 'POST',
+             lambda c, n: f"/edit_activity/{c['edit_activities'][n]}",
+             lambda c, n: _activity_form(date(2030, 1, 1) + timedelta(days=n), n)),
+        Case('routes POST /delete_activity/<id>', 'routes', 'POST',
+             lambda c, n: f"/delete_activity/{c['delete_activities'][n]}", None),
+        Case('routes POST /delete_trip/<id>', 'routes', 'POST', lambda c, n: f"/delete_trip/{c['delete_trips'][n]}", None),
+        Case('routes POST /import_activities/<id>', 'routes', 'POST',
+             lambda c, n: f"/import_activities/{c['scratch_trip']}?format=json", _import_form),
+        # app.py (JSON API)
+        Case('app GET /api', 'app', 'GET', lambda c, n: '/api', None),
+        Case('app GET /api/health', 'app', 'GET', lambda c, n: '/api/health', None),
+        Case('app GET /api/test', 'app', 'GET', lambda c, n: '/api/test', None),
+        Case('app GET /api/trips', 'app', 'GET', lambda c, n: '/api/trips', None),
+        Case('app GET /api/trips/<id>', 'app', 'GET', lambda c, n: f'/api/trips/{_trip(c, n)}', None),
+        Case('app GET /api/trips/<id>/budget', 'app', 'GET', lambda c, n: f'/api/trips/{_trip(c, n)}/budget', None),
+        Case('app GET /api/trips/<id>/conflicts', 'app', 'GET',
+             lambda c, n: f'/api/trips/{_trip(c, n)}/conflicts', None),
+        Case('app GET /api/budgets', 'app', 'GET',
+             lambda c, n: f"/api/budgets?trip_ids={','.join(map(str, c['trip_ids'][:10]))}", None),
+        Case('app GET /api/debug/db_schema', 'app', 'GET', lambda c, n: '/api/debug/db_schema', None),
+        Case('app POST /api/trips', 'app', 'POST', lambda c, n: '/api/trips',
+             lambda c, n: {'json': {'name': f'API trip {n}', 'startDate': '2030-02-01', 'endDate': '2030-02-05'}}),
+        Case('app PUT /api/trips/<id>', 'app', 'PUT', lambda c, n: f"/api/trips/{c['scratch_trip']}",
+             lambda c, n: {'json': {'name': f'Scratch API {n}'}}),
+        Case('app DELETE /api/trips/<id>', 'app', 'DELETE',
+             lambda c, n: f"/api/trips/{c['api_delete_trips'][n]}", None),
+        Case('app POST /api/trips/<id>/activities/batch', 'app', 'POST',
+             lambda c, n: f"/api/trips/{c['scratch_trip']}/activities/batch",
+             lambda c, n: {'json': {
+                 'create': [{'title': f'Batch {n}-{i}', 'date': '2045-01-01', 'category': 'Food', 'price': 40000}
+                            for i in range(10)],
+                 'update': [{'id': id, 'price': 1000.0 * n} for id in c['edit_activities'][:10]]}}),
+        Case('app POST /api/trips/<id>/activities/shift', 'app', 'POST',
+             lambda c, n: f"/api/trips/{c['scratch_trip']}/activities/shift",
+             lambda c, n: {'json': {'days': 1 if n % 2 else -1}}),
+        Case('app POST /api/trips/<id>/reschedule', 'app', 'POST', lambda c, n: f"/api/trips/{c['scratch_trip']}/reschedule",
+             lambda c, n: {'json': {'startDate': '2030-02-01' if n % 2 else '2030-01-01'}}),
+        # main.py (JSON API)
+        Case('main GET /api/map', 'main', 'GET', lambda c, n: f'/api/map?zoom=9&{_viewport(c, n)}', None),
+        Case('main GET /api/map?trip_id', 'main', 'GET', lambda c, n: f'/api/map?trip_id={_trip(c, n)}', None),
+        Case('main GET /api/activities?trip_id', 'main', 'GET',
+             lambda c, n: f'/api/activities?trip_id={_trip(c, n)}', None),
+        Case('main GET /api/activities?limit', 'main', 'GET',
+             lambda c, n: f'/api/activities?trip_id={_trip(c, n)}&limit=50&fields=id,title,date', None),
+        Case('main GET /api/activities/bbox', 'main', 'GET', lambda c, n: f'/api/activities/bbox?{_viewport(c, n)}', None),
+        Case('main GET /api/activities/nearest', 'main', 'GET',
+             lambda c, n: '/api/activities/nearest?lat={:.4f}&lng={:.4f}&k=10'.format(*_point(c, n)), None),
+        Case('main GET /api/trips/<id>/route', 'main', 'GET', lambda c, n: f'/api/trips/{_trip(c, n)}/route', None),
+        Case('main GET /api/search', 'main', 'GET',
+             lambda c, n: f"/api/search?q={c['search_terms'][n % len(c['search_terms'])]}", None),
+        Case('main GET /api/geocode', 'main', 'GET',
+             lambda c, n: f"/api/geocode?q={c['geocode_queries'][n % len(c['geocode_queries'])]}", None),
+        Case('main GET /api/trips/<id>/snapshot', 'main', 'GET',
+             lambda c, n: f'/api/trips/{_trip(c, n)}/snapshot', None),
+        Case('main GET /api/sync', 'main', 'GET', lambda c, n: f"/api/sync?since={max(c['sync_token'] - 500, 0)}", None),
+        Case('main GET /api/sync?trip_id', 'main', 'GET',
+             lambda c, n: f'/api/sync?since=0&trip_id={_trip(c, n)}', None),
+        Case('main GET /api/trips/<id>/weather', 'main', 'GET', lambda c, n: f'/api/trips/{_trip(c, n)}/weather', None),
+        Case('main GET /api/exchange_rates', 'main', 'GET',
+             lambda c, n: f"/api/exchange_rates?base={('VND', 'USD', 'EUR')[n % 3]}&symbols=VND,USD", None),
+        Case('main GET /api/trips/<id>/events', 'main', 'GET', lambda c, n: f'/api/trips/{_trip(c, n)}/events', None,
+             _until_ready),
+        Case('main GET /api/trips/<id>/events?since', 'main', 'GET',
+             lambda c, n: f"/api/trips/{_trip(c, n)}/events?since={max(c['sync_token'] - 500, 0)}", None,
+             _until_ready),
+        # instrumentation.py (debug endpoint, enabled by DEBUG_METRICS)
+        Case('instrumentation GET /api/debug/metrics', 'instrumentation', 'GET', lambda c, n: '/api/debug/metrics', None),
+    ]
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def _run_case(client, ctx, case, args):
+    import fragments
+    import instrumentation
+    import response_cache
+
+    def request(n):
+        data = case.data(ctx, n) if case.data else None
+        kwargs = data if data and 'json' in data else {'data': data}
+        if args.cold:
+            response_cache.cache.clear()
+            fragments.cache.clear()
+        started = time.perf_counter()
+        if case.read:
+            response = client.open(case.path(ctx, n), method=case.method, buffered=False, **kwargs)
+            size = case.read(response)
+        else:
+            response = client.open(case.path(ctx, n), method=case.method, **kwargs)
+            size = len(response.get_data())
+        return time.perf_counter() - started, response.status_code, size
+
+    for n in range(args.warmup):
+        request(n)
+    instrumentation.reset()
+    timings = []
+    statuses = Counter()
+    size = 0
+    started = time.perf_counter()
+    for n in range(args.warmup, args.warmup + args.iterations):
+        elapsed, status, size = request(n)
+        timings.append(elapsed * 1000)
+        statuses[status] += 1
+    wall = time.perf_counter() - started
+
+    metrics = instrumentation.snapshot()['endpoints'].values()
+    requests = sum(m['requests'] for m in metrics) or 1
+    ordered = sorted(timings)
+    return {
+        'requests': len(timings),
+        'throughputRps': round(len(timings) / wall, 1),
+        'latencyMs': dict({f'p{round(q * 100)}': round(_percentile(ordered, q), 3) for q in PERCENTILES},
+                          mean=round(sum(timings) / len(timings), 3), max=round(ordered[-1], 3)),
+        'queriesPerRequest': round(sum(m['queriesPerRequest'] * m['requests'] for m in metrics) / requests, 2),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'responseBytes': size
+    }
+
+
+def compare(report, baseline, threshold):
+    # Prints p50/p95 changes per endpoint; returns the endpoints whose p95 got
+    # more than `threshold` percent (and NOISE_FLOOR_MS) slower.
+    regressions = []
+    print(f"{'endpoint':<44} {'p50 ms':>16} {'p95 ms':>16} {'change':>8}", file=sys.stderr)
+    for name, current in report['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(name)
+        if before is None:
+            continue
+        old, new = before['latencyMs']['p95'], current['latencyMs']['p95']
+        change = (new - old) / old * 100 if old else 0.0
+        flag = ''
+        if change > threshold and new - old > NOISE_FLOOR_MS:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<44} {before['latencyMs']['p50']:>7.2f} -> {current['latencyMs']['p50']:<7.2f}"
+              f"{old:>7.2f} -> {new:<7.2f}{change:>+7.1f}%{flag}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    args = _parse_args()
+    url = _database_url()
+    apps = _apps(url)
+    ctx = _setup(apps, args)
+    clients = {name: app.test_client() for name, app in apps.items()}
+    cases = _cases()
+    if args.only:
+        wanted = [part.strip() for part in args.only.split(',') if part.strip()]
+        cases = [case for case in cases if any(part in case.name for part in wanted)]
+
+    import sqlalchemy
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'createdAt': datetime.utcnow().isoformat(),
+            'database': url.split(':', 1)[0],
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'dataset': {'trips': args.trips, 'activitiesPerTrip': args.activities,
+                        'todosPerTrip': args.todos, 'seed': args.seed},
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'responseCache': 'cold' if args.cold else 'warm'
+        },
+        'endpoints': {}
+    }
+    for case in cases:
+        report['endpoints'][case.name] = _run_case(clients[case.app], ctx, case, args)
+        print(f"{case.name:<44} {report['endpoints'][case.name]['latencyMs']['p95']:>9.2f} ms p95", file=sys.stderr)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(f"p95 regressed by more than {args.threshold}% on: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
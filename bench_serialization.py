@@ -0,0 +1,70 @@
+# Micro-benchmark: ORM hydration + to_dict() + json versus the projected
+# serialization path. Runs against BENCH_DATABASE_URL (in-memory SQLite by
+# default) so it never touches the application database.
+import os
+import sys
+import time
+import json
+from datetime import date, time as dtime, timedelta
+
+os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', 'sqlite://')
+
+from wsgi import create_app
+from models import db, Trip, Activity
+import serialization
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+REPEAT = 3
+
+
+def seed():
+    db.create_all()
+    trip = Trip(name='Benchmark trip', start_date=date(2024, 1, 1), end_date=date(2024, 3, 1))
+    db.session.add(trip)
+    db.session.commit()
+    db.session.execute(Activity.__table__.insert(), [{
+        'trip_id': trip.id,
+        'date': date(2024, 1, 1) + timedelta(days=i % 60),
+        'start_time': dtime(8 + i % 10, 0),
+        'end_time': dtime(9 + i % 10, 30),
+        'title': f'Activity {i}',
+        'location': 'Hoi An, Vietnam',
+        'description': 'Lantern-lit old town walk',
+        'category': 'Sightseeing',
+        'price': 12.5,
+        'latitude': 15.88 + i * 1e-6,
+        'longitude': 108.33
+    } for i in range(ROWS)])
+    db.session.commit()
+    return trip.id
+
+
+def orm_to_dict(trip_id):
+    activities = Activity.query.filter_by(trip_id=trip_id).all()
+    return json.dumps([activity.to_dict() for activity in activities]).encode()
+
+
+def projected(trip_id, fields=None):
+    projection = serialization.Projection(serialization.ACTIVITY_FIELDS, fields)
+    rows = projection.query().filter(Activity.trip_id == trip_id)
+    return serialization.dumps(projection.serialize_all(rows))
+
+
+def measure(name, fn, *args):
+    best = None
+    for _ in range(REPEAT):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        payload = fn(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<28} {ROWS / best:>12,.0f} rows/sec  ({best * 1000:.1f} ms, {len(payload):,} bytes)')
+
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        trip_id = seed()
+        print(f'{ROWS} activities, encoder: {"orjson" if serialization.orjson else "json"}')
+        measure('orm + to_dict + json', orm_to_dict, trip_id)
+        measure('projection (all fields)', projected, trip_id)
+        measure('projection (id,title,date)', projected, trip_id, 'id,title,date')
@@ -0,0 +1,148 @@
+from collections import defaultdict
+from sqlalchemy import event, func, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+# Category '' stands for "no category" so it can be part of the primary key.
+UNCATEGORIZED = ''
+
+_models = {}
+
+
+def register(Activity, BudgetRollup):
+    _models['Activity'] = Activity
+    _models['BudgetRollup'] = BudgetRollup
+
+
+def _key(trip_id, day, category):
+    return trip_id, day, category or UNCATEGORIZED
+
+
+def _add(deltas, key, price, sign):
+    entry = deltas[key]
+    entry[0] += sign * (price or 0.0)
+    entry[1] += sign
+
+
+def rows_deltas(rows, sign=1, deltas=None):
+    # Fold plain column dicts (e.g. a Core insert batch) into rollup deltas.
+    deltas = defaultdict(lambda: [0.0, 0]) if deltas is None else deltas
+    for row in rows:
+        _add(deltas, _key(row['trip_id'], row['date'], row.get('category')), row.get('price'), sign)
+    return deltas
+
+
+def _old_value(state, name):
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return state.attrs[name].value
+
+
+def _flush_deltas(session):
+    Activity = _models['Activity']
+    deltas = defaultdict(lambda: [0.0, 0])
+    for obj in session.new:
+        if isinstance(obj, Activity):
+            _add(deltas, _key(obj.trip_id, obj.date, obj.category), obj.price, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Activity):
+            state = inspect(obj)
+            _add(deltas, _key(*(_old_value(state, n) for n in ('trip_id', 'date', 'category'))),
+                 _old_value(state, 'price'), -1)
+    for obj in session.dirty:
+        if not isinstance(obj, Activity) or obj in session.deleted:
+            continue
+        state = inspect(obj)
+        names = ('trip_id', 'date', 'category', 'price')
+        if not any(state.attrs[n].history.has_changes() for n in names):
+            continue
+        old = [_old_value(state, n) for n in names]
+        _add(deltas, _key(*old[:3]), old[3], -1)
+        _add(deltas, _key(obj.trip_id, obj.date, obj.category), obj.price, 1)
+    return deltas
+
+
+def apply_deltas(connection, deltas):
+    deltas = {key: value for key, value in deltas.items() if value[0] or value[1]}
+    if not deltas:
+        return
+    table = _models['BudgetRollup'].__table__
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    stmt = dialect.insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.trip_id, table.c.date, table.c.category],
+        set_={'total': table.c.total + stmt.excluded.total, 'count': table.c.count + stmt.excluded.count}
+    )
+    connection.execute(stmt, [
+        {'trip_id': trip_id, 'date': day, 'category': category, 'total': total, 'count': count}
+        for (trip_id, day, category), (total, count) in deltas.items()
+    ])
+    trip_ids = {key[0] for key in deltas}
+    connection.execute(table.delete().where(table.c.trip_id.in_(trip_ids), table.c.count <= 0))
+
+
+def apply_rows(session, rows, sign=1):
+    apply_deltas(session.connection(), rows_deltas(rows, sign))
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_rollups(session, flush_context):
+    if 'Activity' in _models:
+        apply_deltas(session.connection(), _flush_deltas(session))
+
+
+def rebuild(session, trip_ids=None):
+    Activity = _models['Activity']
+    table = _models['BudgetRollup'].__table__
+    delete = table.delete()
+    source = session.query(
+        Activity.trip_id,
+        Activity.date,
+        func.coalesce(Activity.category, UNCATEGORIZED),
+        func.coalesce(func.sum(Activity.price), 0.0),
+        func.count(Activity.id)
+    )
+    if trip_ids:
+        delete = delete.where(table.c.trip_id.in_(trip_ids))
+        source = source.filter(Activity.trip_id.in_(trip_ids))
+    source = source.group_by(Activity.trip_id, Activity.date, func.coalesce(Activity.category, UNCATEGORIZED))
+    session.execute(delete)
+    session.execute(table.insert().from_select(['trip_id', 'date', 'category', 'total', 'count'], source.subquery().select()))
+
+
+def trip_budget(session, trip_id):
+    BudgetRollup = _models['BudgetRollup']
+    rows = session.query(BudgetRollup.date, BudgetRollup.category, BudgetRollup.total, BudgetRollup.count) \
+        .filter(BudgetRollup.trip_id == trip_id).order_by(BudgetRollup.date, BudgetRollup.category).all()
+    by_category = defaultdict(float)
+    by_day = {}
+    total = 0.0
+    count = 0
+    for day, category, amount, n in rows:
+        category = category or None
+        by_category[category] += amount
+        entry = by_day.setdefault(day, {'date': day.isoformat(), 'total': 0.0, 'categories': {}})
+        entry['total'] += amount
+        entry['categories'][category or 'Uncategorized'] = round(amount, 2)
+        total += amount
+        count += n
+    for entry in by_day.values():
+        entry['total'] = round(entry['total'], 2)
+    return {
+        'tripId': trip_id,
+        'total': round(total, 2),
+        'activityCount': count,
+        'byCategory': {(c or 'Uncategorized'): round(v, 2) for c, v in by_category.items()},
+        'byDay': list(by_day.values())
+    }
+
+
+def trip_totals(session, trip_ids):
+    BudgetRollup = _models['BudgetRollup']
+    rows = session.query(BudgetRollup.trip_id, func.sum(BudgetRollup.total), func.sum(BudgetRollup.count)) \
+        .filter(BudgetRollup.trip_id.in_(trip_ids)).group_by(BudgetRollup.trip_id).all()
+    totals = {trip_id: {'tripId': trip_id, 'total': 0.0, 'activityCount': 0} for trip_id in trip_ids}
+    for trip_id, total, count in rows:
+        totals[trip_id] = {'tripId': trip_id, 'total': round(total or 0.0, 2), 'activityCount': int(count or 0)}
+    return list(totals.values())
@@ -0,0 +1,323 @@
+# Many activity changes in one transaction, and whole-itinerary moves as
+# single UPDATE statements. Everything here is Core SQL, so the rollup,
+# search, change-log and version hooks are fed by hand, like csv_import does.
+from datetime import date, time, timedelta
+from sqlalchemy import Date, bindparam, case, cast, func, select
+from spatial import geohash_for
+from csv_import import MAX_LENGTHS
+import budget
+import changelog
+import gazetteer
+import conflicts
+import search
+import versions
+
+MAX_OPERATIONS = 1000
+# Largest shift or reschedule, in days either way: enough to move a trip by
+# years, not far enough to leave the dates Python and the databases handle.
+MAX_SHIFT_DAYS = 3660
+
+# JSON name -> (column, parser); the names match Activity.to_dict().
+FIELDS = {
+    'title': ('title', str),
+    'date': ('date', date.fromisoformat),
+    'startTime': ('start_time', time.fromisoformat),
+    'endTime': ('end_time', time.fromisoformat),
+    'location': ('location', str),
+    'category': ('category', str),
+    'latitude': ('latitude', float),
+    'longitude': ('longitude', float),
+    'price': ('price', float),
+    'description': ('description', str),
+}
+# Read back for updates and deletes: what the rollups, search index and
+# geohash need from the old row.
+OLD_COLUMNS = ('id', 'trip_id', 'date', 'category', 'price', 'latitude', 'longitude',
+               'title', 'location', 'description', 'version')
+
+
+class BatchError(ValueError):
+    def __init__(self, message, op=None, index=None):
+        super().__init__(message)
+        self.op = op
+        self.index = index
+
+    def to_dict(self):
+        return {'error': str(self), 'op': self.op, 'index': self.index}
+
+
+class StaleError(ValueError):
+    # Updates or deletes that named a version the row has moved past.
+    def __init__(self, current):
+        super().__init__(f"changed since read: {conflicts.describe_refs(sorted(current))}")
+        self.current = current
+
+    def to_dict(self):
+        return {'error': str(self), 'versions': {str(id): version for id, version in sorted(self.current.items())}}
+
+
+class TripChangedError(ValueError):
+    # The trip's version moved past the one the caller read.
+    pass
+
+
+class ConflictError(ValueError):
+    def __init__(self, found):
+        super().__init__(f"schedule conflicts for {conflicts.describe_refs(sorted(found))}")
+        self.found = found
+
+    def to_dict(self):
+        return {'error': str(self), 'conflicts': {str(id): others for id, others in sorted(self.found.items())}}
+
+
+def _parse(values, op, index, required=()):
+    if not isinstance(values, dict):
+        raise BatchError('expected an object', op, index)
+    row = {}
+    for name, value in values.items():
+        if name in ('id', 'version'):
+            continue
+        if name not in FIELDS:
+            raise BatchError(f'unknown field {name}', op, index)
+        column, parse = FIELDS[name]
+        try:
+            row[column] = None if value is None else parse(value)
+        except (TypeError, ValueError):
+            raise BatchError(f'invalid {name}', op, index)
+        if column in MAX_LENGTHS and row[column] and len(row[column]) > MAX_LENGTHS[column]:
+            raise BatchError(f'{name} longer than {MAX_LENGTHS[column]} characters', op, index)
+    for name in required:
+        if not row.get(FIELDS[name][0]):
+            raise BatchError(f'{name} is required', op, index)
+    return row
+
+
+def _integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _id(value, op, index, expected):
+    # An id, or {'id', 'version'}; the version, when given, goes to `expected`.
+    if isinstance(value, dict):
+        if value.get('version') is not None:
+            if not _integer(value['version']):
+                raise BatchError('version must be an integer', op, index)
+            expected[value.get('id')] = value['version']
+        value = value.get('id')
+    if not _integer(value):
+        raise BatchError('id must be an integer', op, index)
+    return value
+
+
+def parse_batch(data):
+    # {'create': [fields], 'update': [{'id', 'version'?, fields}], 'delete': [id or {'id', 'version'?}]}
+    # -> (creates, {id: fields}, [ids], {id: expected version}); raises
+    # BatchError naming the operation.
+    if not isinstance(data, dict):
+        raise BatchError('expected an object with create, update and delete lists')
+    ops = {op: data.get(op) or [] for op in ('create', 'update', 'delete')}
+    for op, items in ops.items():
+        if not isinstance(items, list):
+            raise BatchError(f'{op} must be a list', op)
+    if sum(len(items) for items in ops.values()) > MAX_OPERATIONS:
+        raise BatchError(f'at most {MAX_OPERATIONS} operations per batch')
+    creates = [_parse(values, 'create', n, required=('title', 'date')) for n, values in enumerate(ops['create'])]
+    updates = {}
+    expected = {}
+    for n, values in enumerate(ops['update']):
+        id = _id(values, 'update', n, expected)
+        if id in updates:
+            raise BatchError(f'activity {id} is updated twice', 'update', n)
+        updates[id] = _parse(values, 'update', n)
+        if 'title' in updates[id] and not updates[id]['title']:
+            raise BatchError('title is required', 'update', n)
+        if 'date' in updates[id] and updates[id]['date'] is None:
+            raise BatchError('date is required', 'update', n)
+    deletes = []
+    for n, value in enumerate(ops['delete']):
+        id = _id(value, 'delete', n, expected)
+        if id in updates:
+            raise BatchError(f'activity {id} is both updated and deleted', 'delete', n)
+        deletes.append(id)
+    return creates, updates, list(dict.fromkeys(deletes)), expected
+
+
+def _old_rows(session, table, trip_id, ids):
+    # Locked until commit (Postgres), so the versions checked are the ones
+    # overwritten.
+    rows = {}
+    for start in range(0, len(ids), MAX_OPERATIONS):
+        chunk = ids[start:start + MAX_OPERATIONS]
+        query = select(*(table.c[name] for name in OLD_COLUMNS)).where(
+            table.c.trip_id == trip_id, table.c.id.in_(chunk)).with_for_update()
+        rows.update((row['id'], dict(row)) for row in session.execute(query).mappings())
+    missing = [id for id in ids if id not in rows]
+    if missing:
+        raise BatchError(f"activities not in this trip: {', '.join(map(str, missing[:10]))}")
+    return rows
+
+
+def apply_batch(session, Activity, trip_id, data, check_conflicts=True, buffer=0, geocoder=None):
+    # All or nothing: the caller commits on success and rolls back on error.
+    # Created activities with a location but no coordinates are geocoded.
+    creates, updates, deletes, expected = parse_batch(data)
+    table = Activity.__table__
+    old = _old_rows(session, table, trip_id, list(updates) + deletes)
+    stale = {id: old[id]['version'] for id, version in expected.items() if old[id]['version'] != version}
+    if stale:
+        raise StaleError(stale)
+
+    deltas = budget.rows_deltas([old[id] for id in list(updates) + deletes], sign=-1)
+
+    if deletes:
+        session.execute(table.delete().where(table.c.trip_id == trip_id, table.c.id.in_(deletes)))
+        search.stage_removed(session, 'activity', deletes)
+        changelog.log_rows(session, 'activity', trip_id, deletes, deleted=True)
+
+    merged = []
+    if updates:
+        # One executemany per distinct set of columns.
+        groups = {}
+        for id, values in updates.items():
+            row = dict(old[id], **values)
+            if 'latitude' in values or 'longitude' in values:
+                values = dict(values, geohash=geohash_for(row['latitude'], row['longitude']))
+            merged.append(row)
+            groups.setdefault(tuple(sorted(values)), []).append(dict(values, b_id=id))
+        for columns, params in groups.items():
+            if columns:
+                session.execute(table.update().where(table.c.id == bindparam('b_id'))
+                                .values(version=table.c.version + 1), params)
+        search.stage_rows(session, 'activity', merged, list(updates))
+        changelog.log_rows(session, 'activity', trip_id, list(updates))
+
+    created = []
+    if creates:
+        rows = [dict({column: None for column, _ in FIELDS.values()}, **row, trip_id=trip_id,
+                     geohash=geohash_for(row.get('latitude'), row.get('longitude'))) for row in creates]
+        gazetteer.fill_coordinates(geocoder, rows, session)
+        # `created` follows the request order. Postgres sorts RETURNING rows
+        # itself; SQLite hands out rowids in VALUES order, so sorting by id
+        # gives the same without falling back to one INSERT per row.
+        postgres = session.connection().dialect.name == 'postgresql'
+        inserted = session.execute(table.insert().returning(
+            table.c.id, table.c.trip_id, *(table.c[name] for name in search.FIELD_WEIGHTS['activity']),
+            sort_by_parameter_order=postgres
+        ), rows).mappings().all()
+        if not postgres:
+            inserted = sorted(inserted, key=lambda row: row['id'])
+        created = [row['id'] for row in inserted]
+        merged.extend(rows)
+        search.stage_rows(session, 'activity', inserted, created)
+        changelog.log_rows(session, 'activity', trip_id, created)
+
+    budget.apply_deltas(session.connection(), budget.rows_deltas(merged, deltas=deltas))
+    if check_conflicts:
+        # Updates that leave the schedule alone are not held to it.
+        moved = [id for id, values in updates.items() if values.keys() & {'date', 'start_time', 'end_time'}]
+        found = conflicts.check_ids(session, Activity, trip_id, created + moved, buffer)
+        if found:
+            raise ConflictError(found)
+    dates = {row['date'] for row in list(old.values()) + merged}
+    versions.touch(session, trip_id, dates=dates)
+    return {'created': created, 'updated': list(updates), 'deleted': deletes}
+
+
+def _shift_values(dialect, Activity, days, minutes):
+    # New (date, start_time, end_time) expressions. A minute shift that
+    # crosses midnight carries the start into the next or previous day;
+    # activities without a start time only move by whole days.
+    if dialect == 'postgresql':
+        new_date = case(
+            (Activity.start_time.is_(None), Activity.date + days),
+            else_=cast(Activity.date + Activity.start_time + timedelta(days=days, minutes=minutes), Date)
+        )
+        return new_date, Activity.start_time + timedelta(minutes=minutes), Activity.end_time + timedelta(minutes=minutes)
+    # SQLite stores dates as 'YYYY-MM-DD' and times as 'HH:MM:SS.ffffff';
+    # time() drops the fraction, so it is appended back.
+    new_date = case(
+        (Activity.start_time.is_(None), func.date(Activity.date, f'{days:+d} days')),
+        else_=func.date(Activity.date.op('||')(' ').op('||')(Activity.start_time),
+                        f'{minutes:+d} minutes', f'{days:+d} days')
+    )
+
+    def shift_time(column):
+        return func.time(column, f'{minutes:+d} minutes').op('||')(func.substr(column, 9))
+    return new_date, shift_time(Activity.start_time), shift_time(Activity.end_time)
+
+
+def _check_shift(session, table, trip_id, days, minutes, on_or_after):
+    if abs(days * 24 * 60 + minutes) > MAX_SHIFT_DAYS * 24 * 60:
+        raise BatchError(f'shifts are limited to {MAX_SHIFT_DAYS} days')
+    query = select(func.min(table.c.date), func.max(table.c.date)).where(table.c.trip_id == trip_id)
+    if on_or_after is not None:
+        query = query.where(table.c.date >= on_or_after)
+    first, last = session.execute(query).one()
+    if first is None:
+        return
+    # One day of slack for minutes carried across midnight.
+    try:
+        date.fromordinal(first.toordinal() + days - (1 if minutes < 0 else 0))
+        date.fromordinal(last.toordinal() + days + (1 if minutes > 0 else 0))
+    except (OverflowError, ValueError):
+        raise BatchError('shift moves activities outside the supported date range')
+
+
+def shift_activities(session, Activity, trip_id, days=0, minutes=0, on_or_after=None,
+                     check_conflicts=True, buffer=0):
+    # Moves every activity of the trip (on or after `on_or_after`, if given)
+    # by days and minutes in one UPDATE. Returns the ids moved.
+    table = Activity.__table__
+    _check_shift(session, table, trip_id, days, minutes, on_or_after)
+    new_date, new_start, new_end = _shift_values(session.connection().dialect.name, Activity, days, minutes)
+    values = {'date': new_date, 'version': table.c.version + 1}
+    if minutes:
+        values.update(start_time=new_start, end_time=new_end)
+    statement = table.update().where(table.c.trip_id == trip_id)
+    if on_or_after is not None:
+        statement = statement.where(table.c.date >= on_or_after)
+    ids = session.execute(statement.values(values).returning(table.c.id)).scalars().all()
+    if not ids:
+        return ids
+    # Rollups are keyed by date, so the trip's are rebuilt in one statement
+    # pair rather than diffed row by row.
+    budget.rebuild(session, [trip_id])
+    changelog.log_rows(session, 'activity', trip_id, ids)
+    if check_conflicts and on_or_after is not None:
+        # Moving everything keeps every gap as it was; moving part of the
+        # trip can land on activities that stayed put.
+        found = conflicts.check_ids(session, Activity, trip_id, ids, buffer)
+        if found:
+            raise ConflictError(found)
+    versions.touch(session, trip_id)
+    return ids
+
+
+def reschedule_trip(session, Trip, Activity, trip, start_date, end_date=None, version=None):
+    # Moves the trip to start on `start_date` and every activity with it.
+    # end_date defaults to keeping the trip's length. With `version`, the
+    # trip must not have changed since the caller read it.
+    table = Trip.__table__
+    # The delta comes from the locked row, and the UPDATE only applies to the
+    # version it was computed from (SQLite ignores FOR UPDATE), so two
+    # reschedules at once cannot both shift the activities.
+    current = session.execute(select(table.c.start_date, table.c.end_date, table.c.version)
+                              .where(table.c.id == trip.id).with_for_update()).one()
+    if version is not None and version != current.version:
+        raise TripChangedError('trip was changed since it was read')
+    delta = (start_date - current.start_date).days
+    if abs(delta) > MAX_SHIFT_DAYS:
+        raise BatchError(f'trips can be moved by at most {MAX_SHIFT_DAYS} days')
+    end_date = end_date or current.end_date + timedelta(days=delta)
+    if end_date < start_date:
+        raise BatchError('endDate must not be before startDate')
+    updated = session.execute(table.update().where(table.c.id == trip.id, table.c.version == current.version).values(
+        start_date=start_date, end_date=end_date, version=table.c.version + 1)).rowcount
+    if not updated:
+        raise TripChangedError('trip was changed since it was read')
+    changelog.log_rows(session, 'trip', trip.id, [trip.id])
+    moved = shift_activities(session, Activity, trip.id, days=delta, check_conflicts=False) if delta else []
+    versions.touch(session, trip.id)
+    session.expire(trip)
+    return {'startDate': start_date.isoformat(), 'endDate': end_date.isoformat(),
+            'shiftedDays': delta, 'activitiesMoved': len(moved)}
@@ -0,0 +1,257 @@
+import bisect
+import logging
+import os
+import threading
+from sqlalchemy import event, func, inspect, select, text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Append-only log of row changes. Each entry's id is the change token a client
+# has seen up to; entries are written in the same transaction as the change.
+ENTITIES = {'Trip': 'trip', 'Activity': 'activity', 'Todo': 'todo'}
+
+# Entries are collected during the transaction and inserted just before it
+# commits, under this lock (Postgres only), so log ids become visible in id
+# order and a reader never skips over a token that is still in flight. The
+# lock covers only that insert and the commit, not the writes before it, so a
+# long import or batch does not hold up other writers.
+ADVISORY_LOCK_KEY = 7351862
+
+PENDING_KEY = 'pending_change_log'
+WRITTEN_KEY = 'change_log_written'
+
+# Follower: how often other processes' entries are read, and how many at once.
+POLL_SECONDS = 1
+FETCH_LIMIT = 5000
+# Id ranges this process wrote that are remembered, so the follower can skip
+# changes the commit hooks here already applied.
+MAX_WRITTEN = 4096
+
+_models = {}
+_commit_listeners = []
+_change_handlers = []
+_written = []
+_written_lock = threading.Lock()
+_followers = {}  # engine -> the Follower running for it
+
+
+def register(ChangeLog):
+    _models['ChangeLog'] = ChangeLog
+
+
+def on_commit(callback):
+    # callback() runs after every commit that wrote log entries, e.g. to wake
+    # a reader of the log instead of waiting for its next poll.
+    _commit_listeners.append(callback)
+
+
+def on_change(handler):
+    # handler(connection, entries) runs in the follower thread for entries
+    # committed by other processes (id, trip_id, entity, entity_id, deleted),
+    # so per-process state can catch up with their writes.
+    _change_handlers.append(handler)
+
+
+def _trip_id(obj, old=False):
+    if type(obj).__name__ == 'Trip':
+        return obj.id
+    if old:
+        history = inspect(obj).attrs.trip_id.history
+        if history.deleted:
+            return history.deleted[0]
+    return obj.trip_id
+
+
+def _write(session, entries):
+    if entries and 'ChangeLog' in _models:
+        session.info.setdefault(PENDING_KEY, []).extend(entries)
+
+
+def _entry(trip_id, entity, entity_id, deleted=False):
+    return {'trip_id': trip_id, 'entity': entity, 'entity_id': entity_id, 'deleted': deleted}
+
+
+def log_rows(session, entity, trip_id, ids, deleted=False):
+    # For Core writes that bypass the unit of work.
+    _write(session, [_entry(trip_id, entity, id, deleted) for id in ids])
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_flush(session, flush_context):
+    entries = []
+    for obj in session.new:
+        entity = ENTITIES.get(type(obj).__name__)
+        if entity:
+            entries.append(_entry(_trip_id(obj), entity, obj.id))
+    for obj in session.dirty:
+        entity = ENTITIES.get(type(obj).__name__)
+        if not entity or obj in session.deleted or not session.is_modified(obj):
+            continue
+        old_trip_id = _trip_id(obj, old=True)
+        if old_trip_id != _trip_id(obj):
+            # Moved to another trip: gone from the old one.
+            entries.append(_entry(old_trip_id, entity, obj.id, deleted=True))
+        entries.append(_entry(_trip_id(obj), entity, obj.id))
+    for obj in session.deleted:
+        entity = ENTITIES.get(type(obj).__name__)
+        if entity:
+            entries.append(_entry(_trip_id(obj, old=True), entity, obj.id, deleted=True))
+    _write(session, entries)
+
+
+@event.listens_for(Session, 'before_commit')
+def _insert(session):
+    # Flushed first, so the entries of the last flush are included.
+    session.flush()
+    entries = session.info.pop(PENDING_KEY, None)
+    if not entries:
+        return
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': ADVISORY_LOCK_KEY})
+    table = _models['ChangeLog'].__table__
+    rows = connection.execute(table.insert().returning(table.c.id, table.c.trip_id), entries).all()
+    ids = [row.id for row in rows]
+    # One insert under the lock (or SQLite's single writer): the ids are
+    # consecutive.
+    with _written_lock:
+        bisect.insort(_written, (min(ids), max(ids)))
+        if len(_written) > 2 * MAX_WRITTEN:
+            del _written[:-MAX_WRITTEN]
+    session.info[WRITTEN_KEY] = (connection.engine, rows)
+
+
+def _own(id):
+    with _written_lock:
+        n = bisect.bisect_right(_written, (id, float('inf'))) - 1
+        return n >= 0 and _written[n][0] <= id <= _written[n][1]
+
+
+@event.listens_for(Session, 'after_commit')
+def _committed(session):
+    written = session.info.pop(WRITTEN_KEY, None)
+    if written:
+        follower = _follower(written[0])
+        if follower is not None:
+            follower.note(written[1])
+        for callback in _commit_listeners:
+            callback()
+
+
+def _follower(engine):
+    follower = _followers.get(engine)
+    return follower if follower is not None and follower.pid == os.getpid() else None
+
+
+def latest_token(session, trip_id=None):
+    # The newest change_log id of the trip (of any trip for None). While a
+    # follower runs in this process it is answered from memory: local
+    # commits and the follower keep the tokens current, so only a trip not
+    # seen since the follower started is read from the database.
+    follower = _follower(session.get_bind())
+    if follower is not None:
+        token = follower.tokens.get(trip_id)
+        if token is not None:
+            return token
+    table = _models['ChangeLog'].__table__
+    query = select(func.max(table.c.id))
+    if trip_id is not None:
+        query = query.where(table.c.trip_id == trip_id)
+    token = session.execute(query).scalar() or 0
+    if follower is not None:
+        follower.note([], {trip_id: token})
+    return token
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _release(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+    session.info.pop(WRITTEN_KEY, None)
+
+
+class Follower:
+    # Reads entries committed after it started and hands those written by
+    # other processes (workers, scripts) to the on_change handlers.
+    def __init__(self, engine, poll_seconds=POLL_SECONDS):
+        self.engine = engine
+        self.poll_seconds = poll_seconds
+        self.pid = os.getpid()
+        self.token = None
+        # trip id (None: any trip) -> newest change_log id known to be
+        # committed. Tokens only grow, so a late write of an older value
+        # never hides a newer one.
+        self.tokens = {}
+        self._tokens_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def note(self, rows, tokens=None):
+        # rows: committed (id, trip_id) pairs; tokens: {trip_id: id} read from
+        # the database.
+        latest = dict(tokens or {})
+        for row in rows:
+            latest[row.trip_id] = max(latest.get(row.trip_id, 0), row.id)
+            latest[None] = max(latest.get(None, 0), row.id)
+        with self._tokens_lock:
+            for trip_id, token in latest.items():
+                if token > self.tokens.get(trip_id, -1):
+                    self.tokens[trip_id] = token
+
+    def poll(self):
+        # Returns the number of log entries read.
+        table = _models['ChangeLog'].__table__
+        with self.engine.connect() as connection:
+            if self.token is None:
+                self.token = connection.execute(select(func.max(table.c.id))).scalar() or 0
+                return 0
+            rows = connection.execute(
+                select(table.c.id, table.c.trip_id, table.c.entity, table.c.entity_id, table.c.deleted)
+                .where(table.c.id > self.token).order_by(table.c.id).limit(FETCH_LIMIT)).all()
+            if not rows:
+                return 0
+            self.token = rows[-1].id
+            self.note(rows)
+            remote = [row for row in rows if not _own(row.id)]
+            if remote:
+                for handler in _change_handlers:
+                    try:
+                        handler(connection, remote)
+                    except Exception as e:
+                        logger.warning(f"Applying {len(remote)} changes from other processes failed: {e}")
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.poll() >= FETCH_LIMIT:
+                    continue
+            except Exception as e:
+                logger.warning(f"Change log follower error: {e}")
+            self._stop.wait(self.poll_seconds)
+
+    def start(self):
+        self.poll()
+        _followers[self.engine] = self
+        self._thread = threading.Thread(target=self._run, name='changes', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if _followers.get(self.engine) is self:
+            del _followers[self.engine]
+        if self._thread is not None:
+            self._thread.join()
+
+
+def follow(app):
+    # One running follower per app and process, like events.get_feed().
+    follower = app.extensions.get('changes')
+    if follower is None or follower[0] != os.getpid():
+        from models import db
+        with app.app_context():
+            engine = db.engine
+        follower = app.extensions['changes'] = (os.getpid(), Follower(
+            engine, app.config.get('CHANGES_POLL_SECONDS', POLL_SECONDS)).start())
+    return follower[1]
@@ -0,0 +1,94 @@
+from sqlalchemy import func, literal_column
+import spatial
+import versions
+from cache import LRUCache
+
+MIN_ZOOM = 0
+MAX_ZOOM = 20
+MAX_TILES = 64
+
+tile_cache = LRUCache(maxsize=4096, ttl=600)
+
+
+def precision_for_zoom(zoom):
+    # Aim for cells roughly 64px wide: 256 * 2**zoom / 2**lng_bits == 64.
+    return max(1, min(spatial.GEOHASH_PRECISION, round((zoom + 2) * 2 / 5)))
+
+
+def _tile_clusters(db, Activity, trip_id, precision, tiles):
+    # One grouped query for every uncached tile; clusters are assigned back to
+    # their tile by geohash prefix.
+    cell = func.substr(Activity.geohash, 1, literal_column(str(precision)))
+    query = db.session.query(
+        cell.label('cell'),
+        func.count(Activity.id),
+        func.avg(Activity.latitude),
+        func.avg(Activity.longitude),
+        func.min(Activity.latitude),
+        func.min(Activity.longitude),
+        func.max(Activity.latitude),
+        func.max(Activity.longitude),
+        func.min(Activity.title),
+        func.min(Activity.id)
+    ).filter(spatial.range_filter(Activity.geohash, tiles))
+    if trip_id:
+        query = query.filter(Activity.trip_id == trip_id)
+    by_tile = {tile: [] for tile in tiles}
+    tile_len = len(tiles[0])
+    for geohash, count, lat, lng, south, west, north, east, title, first_id in query.group_by(cell):
+        cluster = {
+            'geohash': geohash,
+            'count': count,
+            'lat': lat,
+            'lng': lng,
+            'bounds': {'south': south, 'west': west, 'north': north, 'east': east}
+        }
+        if count == 1:
+            cluster['title'] = title
+            cluster['id'] = first_id
+        by_tile[geohash[:tile_len]].append(cluster)
+    return by_tile
+
+
+def data_bounds(db, Activity, trip_id=None):
+    key = ('map_bounds', trip_id, versions.current(trip_id))
+    bounds = tile_cache.get(key)
+    if bounds is None:
+        query = db.session.query(
+            func.min(Activity.latitude), func.min(Activity.longitude),
+            func.max(Activity.latitude), func.max(Activity.longitude)
+        ).filter(Activity.geohash.isnot(None))
+        if trip_id:
+            query = query.filter(Activity.trip_id == trip_id)
+        bounds = tuple(query.one())
+        tile_cache.set(key, bounds)
+    return None if bounds[0] is None else bounds
+
+
+def clusters(db, Activity, south, west, north, east, zoom, trip_id=None):
+    precision = precision_for_zoom(zoom)
+    boxes = [(south, west, north, east)] if west <= east else \
+        [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+    # Keep the payload bounded: coarsen when the viewport spans too many tiles.
+    while precision > 1 and sum(spatial.estimate_cells(*box, precision - 1) for box in boxes) > MAX_TILES:
+        precision -= 1
+    tile_precision = max(1, precision - 1)
+    tiles = set()
+    for box in boxes:
+        tiles.update(spatial.cells_in_bbox(*box, tile_precision))
+
+    version = versions.current(trip_id)
+    result = []
+    missing = []
+    for tile in sorted(tiles):
+        cached = tile_cache.get(('map_tile', trip_id, precision, tile, version))
+        if cached is None:
+            missing.append(tile)
+        else:
+            result.extend(cached)
+    if missing:
+        for tile, tile_clusters in _tile_clusters(db, Activity, trip_id, precision, missing).items():
+            tile_cache.set(('map_tile', trip_id, precision, tile, version), tile_clusters)
+            result.extend(tile_clusters)
+    return result, precision
@@ -0,0 +1,159 @@
+import bisect
+import heapq
+import itertools
+from collections import namedtuple
+
+MINUTES_PER_DAY = 24 * 60
+
+# start/end are minutes since midnight of `date`; an end before the start is
+# taken to run past midnight. `ref` is whatever the caller uses to identify
+# the interval (an activity id, a CSV line number, ...).
+Interval = namedtuple('Interval', 'ref date start end')
+
+
+def minutes(value):
+    return value.hour * 60 + value.minute + value.second / 60
+
+
+def make_interval(ref, date, start_time, end_time):
+    if start_time is None:
+        return None
+    start = minutes(start_time)
+    end = minutes(end_time) if end_time is not None else start
+    if end < start:
+        end += MINUTES_PER_DAY
+    return Interval(ref, date, start, end)
+
+
+def _kind(a, b):
+    return 'overlap' if a.start < b.end and b.start < a.end else 'buffer'
+
+
+def sweep(intervals, buffer=0):
+    # Every pair of intervals on the same date that overlaps or sits closer
+    # than `buffer` minutes, in O(n log n + pairs).
+    pairs = []
+    ordered = sorted(intervals, key=lambda i: (i.date, i.start, i.end))
+    for _, day in itertools.groupby(ordered, key=lambda i: i.date):
+        active = []
+        for n, current in enumerate(day):
+            while active and active[0][0] + buffer <= current.start:
+                heapq.heappop(active)
+            for _, _, other in active:
+                pairs.append((other, current, _kind(other, current)))
+            heapq.heappush(active, (current.end, n, current))
+    return pairs
+
+
+class DayIndex:
+    # Intervals of one day sorted by start, with a running maximum of their
+    # ends, so the overlaps of a new interval are found with one bisect and a
+    # backward scan that stops as soon as no earlier interval can reach it.
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals, key=lambda i: i.start)
+        self.starts = [i.start for i in self.intervals]
+        self.max_end = list(itertools.accumulate((i.end for i in self.intervals), max))
+
+    def conflicts(self, interval, buffer=0):
+        found = []
+        k = bisect.bisect_left(self.starts, interval.end + buffer)
+        for n in range(k - 1, -1, -1):
+            if self.max_end[n] + buffer <= interval.start:
+                break
+            other = self.intervals[n]
+            if other.end + buffer > interval.start and other.ref != interval.ref:
+                found.append((other, _kind(other, interval)))
+        return found
+
+
+def describe_refs(refs):
+    return ', '.join(f'line {ref[1]}' if isinstance(ref, tuple) else f'activity #{ref}' for ref in refs)
+
+
+def _day_intervals(session, Activity, trip_id, dates, exclude_id=None):
+    query = session.query(Activity.id, Activity.date, Activity.start_time, Activity.end_time).filter(
+        Activity.trip_id == trip_id, Activity.date.in_(dates), Activity.start_time.isnot(None))
+    if exclude_id is not None:
+        query = query.filter(Activity.id != exclude_id)
+    return [make_interval(*row) for row in query]
+
+
+def check_activity(session, Activity, trip_id, date, start_time, end_time, exclude_id=None, buffer=0):
+    interval = make_interval(exclude_id, date, start_time, end_time)
+    if interval is None:
+        return []
+    index = DayIndex(_day_intervals(session, Activity, trip_id, [date], exclude_id))
+    return index.conflicts(interval, buffer)
+
+
+def check_batch(session, Activity, trip_id, rows, buffer=0):
+    # rows: (line, column dict) pairs about to be inserted. Returns
+    # {line: [activity id or ('line', n), ...]} for rows that clash with stored
+    # activities or with an earlier row of the same batch.
+    new = [make_interval(('line', line), row['date'], row['start_time'], row['end_time']) for line, row in rows]
+    new = [interval for interval in new if interval is not None]
+    if not new:
+        return {}
+    existing = _day_intervals(session, Activity, trip_id, {i.date for i in new})
+    rejected = {}
+    within_batch = []
+    for a, b, _ in sweep(existing + new, buffer):
+        a_new = isinstance(a.ref, tuple)
+        b_new = isinstance(b.ref, tuple)
+        if a_new and b_new:
+            within_batch.append(tuple(sorted((a.ref[1], b.ref[1]))))
+        elif a_new or b_new:
+            line, other = (a.ref[1], b.ref) if a_new else (b.ref[1], a.ref)
+            rejected.setdefault(line, []).append(other)
+    # Between two new rows the later line loses, unless the earlier one is
+    # already rejected and so will not be inserted.
+    for first, later in sorted(within_batch, key=lambda pair: (pair[1], pair[0])):
+        if first not in rejected:
+            rejected.setdefault(later, []).append(('line', first))
+    return rejected
+
+
+def check_ids(session, Activity, trip_id, ids, buffer=0):
+    # For changes already written in this transaction: {id: [other ids]} for
+    # each of `ids` that now clashes with another activity of the trip.
+    ids = set(ids)
+    if not ids:
+        return {}
+    dates = {day for (day,) in session.query(Activity.date).filter(
+        Activity.trip_id == trip_id, Activity.id.in_(ids), Activity.start_time.isnot(None)).distinct()}
+    if not dates:
+        return {}
+    found = {}
+    for a, b, _ in sweep(_day_intervals(session, Activity, trip_id, dates), buffer):
+        if a.ref in ids:
+            found.setdefault(a.ref, []).append(b.ref)
+        if b.ref in ids:
+            found.setdefault(b.ref, []).append(a.ref)
+    return found
+
+
+def trip_conflicts(session, Activity, trip_id, buffer=0):
+    rows = session.query(
+        Activity.id, Activity.date, Activity.start_time, Activity.end_time, Activity.title
+    ).filter(Activity.trip_id == trip_id, Activity.start_time.isnot(None)).all()
+    intervals = [make_interval(row.id, row.date, row.start_time, row.end_time) for row in rows]
+    by_id = {row.id: row for row in rows}
+
+    def describe(interval):
+        row = by_id[interval.ref]
+        return {
+            'id': row.id,
+            'title': row.title,
+            'startTime': row.start_time.isoformat(),
+            'endTime': row.end_time.isoformat() if row.end_time else None
+        }
+
+    result = []
+    for a, b, kind in sweep(intervals, buffer):
+        entry = {'date': a.date.isoformat(), 'kind': kind, 'activities': [describe(a), describe(b)]}
+        if kind == 'overlap':
+            entry['overlapMinutes'] = round(min(a.end, b.end) - max(a.start, b.start), 2)
+        else:
+            entry['gapMinutes'] = round(max(a.start, b.start) - min(a.end, b.end), 2)
+        result.append(entry)
+    return result
@@ -0,0 +1,203 @@
+import csv
+import io
+import time
+from datetime import date, datetime, time as dtime
+from spatial import geohash_for
+import versions
+import budget
+import conflicts
+import search
+import changelog
+import gazetteer
+
+DEFAULT_BATCH_SIZE = 1000
+
+CSV_COLUMNS = ['title', 'date', 'start_time', 'end_time', 'location', 'category',
+               'latitude', 'longitude', 'price', 'description']
+
+# Column limits from models.Activity; checked up front so one long value
+# cannot fail a whole batch insert.
+MAX_LENGTHS = {'title': 100, 'location': 100, 'category': 50}
+
+
+class ImportReport:
+    def __init__(self, mode, batch_size):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.rows_imported = 0
+        self.rows_failed = 0
+        self.rows_geocoded = 0
+        self.batches = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_sec(self):
+        if not self.elapsed:
+            return 0.0
+        return (self.rows_imported + self.rows_failed) / self.elapsed
+
+    def add_error(self, line, message):
+        self.rows_failed += 1
+        self.errors.append({'line': line, 'error': message})
+
+    def to_dict(self, max_errors=None):
+        errors = self.errors if max_errors is None else self.errors[:max_errors]
+        return {
+            'mode': self.mode,
+            'batchSize': self.batch_size,
+            'rowsImported': self.rows_imported,
+            'rowsFailed': self.rows_failed,
+            'rowsGeocoded': self.rows_geocoded,
+            'batches': self.batches,
+            'elapsed': round(self.elapsed, 4),
+            'rowsPerSec': round(self.rows_per_sec, 1),
+            'errors': errors
+        }
+
+
+def _optional(value, parse):
+    value = value.strip()
+    return parse(value) if value else None
+
+
+def parse_row(trip_id, row):
+    if len(row) != len(CSV_COLUMNS):
+        raise ValueError(f"expected {len(CSV_COLUMNS)} columns, got {len(row)}")
+    title, day, start_time, end_time, location, category, latitude, longitude, price, description = row
+    title = title.strip()
+    if not title:
+        raise ValueError("title is required")
+    for name, value in (('title', title), ('location', location), ('category', category)):
+        if len(value) > MAX_LENGTHS[name]:
+            raise ValueError(f"{name} longer than {MAX_LENGTHS[name]} characters")
+    latitude = _optional(latitude, float)
+    longitude = _optional(longitude, float)
+    return {
+        'trip_id': trip_id,
+        'title': title,
+        'date': date.fromisoformat(day.strip()),
+        'start_time': _optional(start_time, dtime.fromisoformat),
+        'end_time': _optional(end_time, dtime.fromisoformat),
+        'location': location or None,
+        'category': category or None,
+        'latitude': latitude,
+        'longitude': longitude,
+        'geohash': geohash_for(latitude, longitude),
+        'price': _optional(price, float),
+        'description': description or None
+    }
+
+
+def iter_csv_rows(stream):
+    # Decode the upload incrementally instead of reading it into memory first.
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.reader(text)
+        next(reader, None)  # Skip header row
+        for row in reader:
+            if row:
+                yield reader.line_num, row
+    finally:
+        text.detach()
+
+
+def stream_import(db, Activity, trip_id, stream, batch_size=DEFAULT_BATCH_SIZE, check_conflicts=True, buffer=0,
+                  geocoder=None):
+    # Rows with a location but no coordinates get them from `geocoder`
+    # (gazetteer.Geocoder), when given.
+    report = ImportReport('stream', batch_size)
+    table = Activity.__table__
+    started = time.perf_counter()
+    batch = []
+    dates = set()
+
+    def flush():
+        report.rows_geocoded += gazetteer.fill_coordinates(geocoder, [row for _, row in batch], db.session)
+        rows = batch
+        if check_conflicts:
+            # Earlier batches are already inserted in this transaction, so they
+            # take part in the check like any stored activity.
+            rejected = conflicts.check_batch(db.session, Activity, trip_id, batch, buffer)
+            for line in sorted(rejected):
+                report.add_error(line, f"schedule conflict with {conflicts.describe_refs(rejected[line])}")
+            rows = [pair for pair in batch if pair[0] not in rejected]
+        rows = [row for _, row in rows]
+        if rows:
+            # RETURNING the indexed fields with the id avoids needing rows back
+            # in parameter order, which SQLite can only do one row at a time.
+            inserted = db.session.execute(table.insert().returning(
+                table.c.id, table.c.trip_id, *(table.c[name] for name in search.FIELD_WEIGHTS['activity'])
+            ), rows).mappings().all()
+            ids = [row['id'] for row in inserted]
+            budget.apply_rows(db.session, rows)
+            search.stage_rows(db.session, 'activity', inserted, ids)
+            changelog.log_rows(db.session, 'activity', trip_id, ids)
+            dates.update(row['date'] for row in rows)
+        report.rows_imported += len(rows)
+        report.batches += 1
+        batch.clear()
+
+    try:
+        for line, row in iter_csv_rows(stream):
+            try:
+                batch.append((line, parse_row(trip_id, row)))
+            except ValueError as e:
+                report.add_error(line, str(e))
+                continue
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        if report.rows_imported:
+            versions.touch(db.session, trip_id, dates=dates)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        report.elapsed = time.perf_counter() - started
+    return report
+
+
+def orm_import(db, Activity, trip_id, stream, check_conflicts=True, buffer=0, geocoder=None):
+    # The original all-or-nothing path, kept for comparison with stream_import.
+    # Blank coordinates are filled from `geocoder` the same way.
+    report = ImportReport('orm', None)
+    started = time.perf_counter()
+    try:
+        csv_input = csv.reader(io.StringIO(stream.read().decode("UTF8"), newline=None))
+        next(csv_input)  # Skip header row
+        rows = []
+        for row in csv_input:
+            title, day, start_time, end_time, location, category, latitude, longitude, price, description = row
+            rows.append((csv_input.line_num, dict(
+                trip_id=trip_id,
+                title=title,
+                date=datetime.strptime(day, '%Y-%m-%d').date(),
+                start_time=datetime.strptime(start_time, '%H:%M').time(),
+                end_time=datetime.strptime(end_time, '%H:%M').time(),
+                location=location,
+                category=category,
+                latitude=_optional(latitude, float),
+                longitude=_optional(longitude, float),
+                price=float(price),
+                description=description
+            )))
+        report.rows_geocoded = gazetteer.fill_coordinates(geocoder, [values for _, values in rows], db.session)
+        if check_conflicts:
+            rejected = conflicts.check_batch(db.session, Activity, trip_id, rows, buffer)
+            if rejected:
+                lines = ', '.join(str(line) for line in sorted(rejected)[:10])
+                raise ValueError(f"schedule conflicts on lines {lines}")
+        for _, values in rows:
+            db.session.add(Activity(**values))
+            report.rows_imported += 1
+        db.session.commit()
+        report.batches = 1
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        report.elapsed = time.perf_counter() - started
+    return report
@@ -0,0 +1,255 @@
+# Push updates for everyone viewing a trip, as Server-Sent Events.
+#
+# One feed thread per process reads new change_log entries and publishes one
+# compact event per changed trip (which rows changed or were deleted, not
+# their contents) to a broker. Every client watching the trip gets the same
+# encoded bytes from its own queue, so a hundred viewers cost one log query
+# per poll, not a hundred polling requests. Commits in this process wake the
+# feed at once; other workers' commits show up within POLL_SECONDS.
+#
+# Event ids are change tokens. A client that reconnects (EventSource sends
+# Last-Event-ID, or ?since= after loading a snapshot) first gets what it
+# missed from the log, then live events; one that falls QUEUE_SIZE events
+# behind is disconnected and catches up the same way.
+#
+# Each open stream holds a server thread, so serve these from a threaded or
+# async worker. LocalBroker is in-process; anything with the same subscribe,
+# unsubscribe, publish and channels methods can replace it (EVENT_BROKER in
+# the app config).
+import json
+import logging
+import os
+import queue
+import threading
+import weakref
+from sqlalchemy import func, select
+from models import ChangeLog
+from snapshots import ENTITIES
+import changelog
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 1
+HEARTBEAT_SECONDS = 15
+QUEUE_SIZE = 256
+FETCH_LIMIT = 5000
+# A client further behind than this reloads a snapshot instead.
+REPLAY_LIMIT = 5000
+RETRY_MS = 3000
+
+_feeds = weakref.WeakSet()
+
+
+def channel(trip_id):
+    return f'trip:{trip_id}'
+
+
+class Subscription:
+    def __init__(self, channel, maxsize=QUEUE_SIZE):
+        self.channel = channel
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+
+    def get(self, timeout):
+        # The next message, or None after `timeout` seconds without one.
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LocalBroker:
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def subscribe(self, channel):
+        subscription = Subscription(channel, self.queue_size)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._channels.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._channels[subscription.channel]
+
+    def channels(self):
+        with self._lock:
+            return set(self._channels)
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # Too slow to keep up: its stream ends and the client resumes
+                # from the last event it got.
+                subscription.closed = True
+                self.unsubscribe(subscription)
+        return len(subscriptions)
+
+
+def encode(trip_id, entries):
+    # entries: (token, entity, entity_id, deleted) in log order, each row
+    # reported once in its latest state. Returns (token, SSE frame).
+    latest = {}
+    for _, entity, entity_id, deleted in entries:
+        latest[(entity, entity_id)] = deleted
+    token = entries[-1][0]
+    event = {'tripId': trip_id, 'token': token}
+    for gone, name in ((False, 'changed'), (True, 'deleted')):
+        groups = {}
+        for (entity, entity_id), deleted in latest.items():
+            if deleted == gone:
+                groups.setdefault(ENTITIES[entity][2], []).append(entity_id)
+        if groups:
+            event[name] = {key: sorted(ids) for key, ids in groups.items()}
+    return token, _frame('change', event, token)
+
+
+def _frame(name, data, token=None):
+    head = f'id: {token}\n' if token is not None else ''
+    return f"{head}event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+class Feed:
+    def __init__(self, engine, broker, poll_seconds=POLL_SECONDS):
+        self.engine = engine
+        self.broker = broker
+        self.poll_seconds = poll_seconds
+        # Log entries after this token are still to be published; None while
+        # nobody is watching.
+        self.token = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        _feeds.add(self)
+
+    def watch(self, token):
+        # A new subscriber has everything up to `token`.
+        with self._lock:
+            if self.token is None or token < self.token:
+                self.token = token
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='events', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def poll(self):
+        # Publishes what was logged since the last poll; returns the number of
+        # log entries read.
+        with self._lock:
+            if not self.broker.channels():
+                self.token = None
+            token = self.token
+        if token is None:
+            return 0
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(ChangeLog.id, ChangeLog.trip_id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.deleted)
+                .where(ChangeLog.id > token).order_by(ChangeLog.id).limit(FETCH_LIMIT)).all()
+        if not rows:
+            return 0
+        with self._lock:
+            if self.token == token:
+                self.token = rows[-1].id
+        by_trip = {}
+        for row in rows:
+            by_trip.setdefault(row.trip_id, []).append((row.id, row.entity, row.entity_id, row.deleted))
+        # Read after the query: a channel subscribed since then already has
+        # these rows from its own replay.
+        watched = self.broker.channels()
+        for trip_id, entries in by_trip.items():
+            if channel(trip_id) in watched:
+                self.broker.publish(channel(trip_id), encode(trip_id, entries))
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.poll() >= FETCH_LIMIT:
+                    continue
+            except Exception as e:
+                logger.warning(f"Change feed error: {e}")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+def _wake_feeds():
+    for feed in list(_feeds):
+        feed.wake()
+
+
+changelog.on_commit(_wake_feeds)
+
+
+def get_feed(app):
+    # One feed (and thread) per app and process, like gateway.get_gateway().
+    feed = app.extensions.get('events')
+    if feed is None or feed[0] != os.getpid():
+        from models import db
+        with app.app_context():
+            engine = db.engine
+        broker = app.config.get('EVENT_BROKER') or LocalBroker()
+        feed = app.extensions['events'] = (os.getpid(), Feed(
+            engine, broker, app.config.get('EVENTS_POLL_SECONDS', POLL_SECONDS)))
+    return feed[1]
+
+
+def stream(app, session, trip_id, since=None):
+    # The response body for one client: a replay of the trip's log entries
+    # after `since`, a `ready` event carrying the current token, then live
+    # events until the client goes away.
+    feed = get_feed(app)
+    subscription = feed.broker.subscribe(channel(trip_id))
+    try:
+        # Subscribed first, so nothing committed after this read is missed.
+        latest = session.query(func.max(ChangeLog.id)).scalar() or 0
+        first = [f'retry: {RETRY_MS}\n\n'.encode()]
+        if since is not None and since > latest:
+            first.append(_frame('reset', {'error': f'token {since} is newer than the latest change {latest}'}))
+            feed.broker.unsubscribe(subscription)
+            return iter(first)
+        if since is not None and since < latest:
+            entries = session.query(ChangeLog.id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.deleted).filter(
+                ChangeLog.trip_id == trip_id, ChangeLog.id > since, ChangeLog.id <= latest
+            ).order_by(ChangeLog.id).limit(REPLAY_LIMIT + 1).all()
+            if len(entries) > REPLAY_LIMIT:
+                first.append(_frame('reset', {'error': f'more than {REPLAY_LIMIT} changes since token {since}'}))
+                feed.broker.unsubscribe(subscription)
+                return iter(first)
+            if entries:
+                first.append(encode(trip_id, entries)[1])
+        first.append(_frame('ready', {'tripId': trip_id, 'token': latest}, latest))
+        feed.watch(latest)
+    except Exception:
+        feed.broker.unsubscribe(subscription)
+        raise
+    return _live(feed.broker, subscription, latest, first)
+
+
+def _live(broker, subscription, after, first):
+    try:
+        yield from first
+        while not subscription.closed:
+            message = subscription.get(HEARTBEAT_SECONDS)
+            if message is None:
+                yield b': keepalive\n\n'
+            elif message[0] > after:
+                yield message[1]
+    finally:
+        broker.unsubscribe(subscription)
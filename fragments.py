@@ -0,0 +1,76 @@
+# Rendered HTML for one day of a trip's itinerary, cached under
+# (template, trip_id, date, day version). An activity edit bumps only the
+# versions of the days it was and now is on, so a page built from these
+# re-renders those days and reuses every other one without querying it.
+from datetime import date
+from flask import current_app, render_template
+from markupsafe import Markup
+import versions
+from cache import LRUCache
+
+DEFAULT_TTL = 600
+DEFAULT_MAXSIZE = 8192
+# Longest span one page may ask for.
+MAX_RANGE_DAYS = 92
+
+cache = LRUCache(maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL)
+
+
+def date_range(args, start=None, end=None):
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD, each falling back to the given default
+    # when missing or malformed.
+    start = args.get('start', start, type=date.fromisoformat)
+    end = args.get('end', end, type=date.fromisoformat)
+    if start is not None and end is not None:
+        end = min(max(end, start), date.fromordinal(start.toordinal() + MAX_RANGE_DAYS - 1))
+    return start, end
+
+
+def activity_dates(session, Activity, trip_id, start=None, end=None):
+    # The dates with at least one activity, within [start, end] when given.
+    key = ('dates', trip_id, versions.current(trip_id), start, end)
+    dates = cache.get(key)
+    if dates is None:
+        query = session.query(Activity.date).filter(Activity.trip_id == trip_id)
+        if start is not None:
+            query = query.filter(Activity.date >= start)
+        if end is not None:
+            query = query.filter(Activity.date <= end)
+        dates = [day for (day,) in query.distinct().order_by(Activity.date)]
+        cache.set(key, dates, ttl=_ttl())
+    return dates
+
+
+def day_fragments(session, Activity, trip_id, dates, template):
+    # {date: Markup}. The days not cached are loaded in one query and rendered
+    # with `template`, which gets trip_id, date and that day's activities.
+    # Versions are read before the query, so a commit landing in between
+    # leaves at worst a newer fragment under the older version.
+    keys = {day: (template, trip_id, day, versions.day(trip_id, day)) for day in dates}
+    fragments = {}
+    for day, key in keys.items():
+        html = cache.get(key)
+        if html is not None:
+            fragments[day] = html
+    missing = [day for day in dates if day not in fragments]
+    if not missing:
+        return fragments
+
+    by_date = {day: [] for day in missing}
+    rows = session.query(
+        Activity.id, Activity.title, Activity.date, Activity.start_time, Activity.end_time, Activity.location,
+        Activity.version
+    ).filter(Activity.trip_id == trip_id, Activity.date.in_(missing)).order_by(
+        Activity.date, Activity.start_time, Activity.id)
+    for row in rows:
+        by_date[row.date].append(row)
+    ttl = _ttl()
+    for day in missing:
+        html = Markup(render_template(template, trip_id=trip_id, date=day, activities=by_date[day]))
+        cache.set(keys[day], html, ttl=ttl)
+        fragments[day] = html
+    return fragments
+
+
+def _ttl():
+    return current_app.config.get('FRAGMENT_CACHE_TTL', DEFAULT_TTL)
@@ -0,0 +1,315 @@
+# Weather and exchange-rate data from external APIs. Requests go through one
+# event loop per process (a background thread), so every Flask worker thread
+# shares the same cache and in-flight requests:
+#
+# - identical requests already in flight are awaited, not repeated;
+# - an entry younger than its ttl is served from memory;
+# - an entry past its ttl but within stale_ttl is served at once while a
+#   refresh runs in the background (stale-while-revalidate);
+# - if the upstream fails, the last value saved in gateway_snapshot is
+#   served, however old, and marked stale.
+#
+# The upstream APIs are behind a Provider, so a stub can stand in for them
+# (GATEWAY_PROVIDER in the app config).
+import abc
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime
+from sqlalchemy import func, select
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+WEATHER_API_URL = 'https://api.open-meteo.com/v1/forecast'
+RATES_API_URL = 'https://api.exchangerate-api.com/v4/latest/{base}'
+TIMEOUT_SECONDS = 5
+# seconds: (ttl, stale_ttl)
+WEATHER_TTL = (3600, 6 * 3600)
+RATES_TTL = (6 * 3600, 24 * 3600)
+MAX_ENTRIES = 4096
+# Threads for blocking upstream calls and snapshot reads/writes; the default
+# executor scales with CPUs, which says nothing about network waits.
+MAX_CONCURRENCY = 16
+# Activities within the same 4-character geohash cell (about 40 x 20 km)
+# count as one destination.
+DESTINATION_PRECISION = 4
+
+_SnapshotModel = None
+
+
+def register(snapshot_model):
+    global _SnapshotModel
+    _SnapshotModel = snapshot_model
+
+
+class GatewayError(Exception):
+    pass
+
+
+class Provider(abc.ABC):
+    @abc.abstractmethod
+    async def forecast(self, latitude, longitude, start, end):
+        # Returns [{'date', 'tempMax', 'tempMin', 'precipitation', 'weatherCode'}, ...]
+        pass
+
+    @abc.abstractmethod
+    async def rates(self, base):
+        # Returns {'base', 'date', 'rates': {currency: rate}}
+        pass
+
+
+class HTTPProvider(Provider):
+    # Open-Meteo forecasts and exchangerate-api rates. There is no async HTTP
+    # client in the dependencies, so the blocking calls run on the loop's
+    # default thread pool; a shared Session keeps connections alive.
+    def __init__(self, weather_url=WEATHER_API_URL, rates_url=RATES_API_URL, timeout=TIMEOUT_SECONDS):
+        import requests
+        self.weather_url = weather_url
+        self.rates_url = rates_url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _get(self, url, params=None):
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def forecast(self, latitude, longitude, start, end):
+        data = await asyncio.to_thread(self._get, self.weather_url, {
+            'latitude': latitude,
+            'longitude': longitude,
+            'start_date': start.isoformat(),
+            'end_date': end.isoformat(),
+            'daily': 'temperature_2m_max,temperature_2m_min,precipitation_sum,weathercode',
+            'timezone': 'auto'
+        })
+        daily = data['daily']
+        return [{
+            'date': day,
+            'tempMax': temp_max,
+            'tempMin': temp_min,
+            'precipitation': precipitation,
+            'weatherCode': code
+        } for day, temp_max, temp_min, precipitation, code in zip(
+            daily['time'], daily['temperature_2m_max'], daily['temperature_2m_min'],
+            daily['precipitation_sum'], daily['weathercode'])]
+
+    async def rates(self, base):
+        data = await asyncio.to_thread(self._get, self.rates_url.format(base=base))
+        return {'base': data.get('base', base), 'date': data.get('date'), 'rates': data['rates']}
+
+
+class SnapshotStore:
+    # Last known value per key in gateway_snapshot, shared by all workers and
+    # kept across restarts.
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = _SnapshotModel.__table__
+
+    def load(self, key):
+        with self.engine.connect() as connection:
+            row = connection.execute(
+                select(self.table.c.value, self.table.c.fetched_at).where(self.table.c.key == key)
+            ).first()
+        return (json.loads(row.value), row.fetched_at) if row else None
+
+    def load_many(self, keys):
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(self.table.c.key, self.table.c.value, self.table.c.fetched_at).where(self.table.c.key.in_(keys))
+            ).all()
+        return {row.key: (json.loads(row.value), row.fetched_at) for row in rows}
+
+    def save(self, key, value, fetched_at):
+        values = {'value': json.dumps(value), 'fetched_at': fetched_at}
+        with self.engine.begin() as connection:
+            updated = connection.execute(
+                self.table.update().where(self.table.c.key == key, self.table.c.fetched_at < fetched_at), values
+            ).rowcount
+            if not updated and not connection.execute(
+                    select(func.count()).where(self.table.c.key == key)).scalar():
+                connection.execute(self.table.insert(), dict(values, key=key))
+
+
+class Gateway:
+    def __init__(self, provider, store=None, timeout=TIMEOUT_SECONDS, maxsize=MAX_ENTRIES):
+        self.provider = provider
+        self.store = store
+        self.timeout = timeout
+        self.entries = LRUCache(maxsize)
+        self._inflight = {}
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(ThreadPoolExecutor(MAX_CONCURRENCY, thread_name_prefix='gateway'))
+        self._thread = threading.Thread(target=self._loop.run_forever, name='gateway', daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine):
+        # Blocking entry point for request threads.
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        try:
+            # Fetches give up after self.timeout and fall back; the extra
+            # second covers reading the snapshot store.
+            return future.result(self.timeout + 1)
+        except FutureTimeoutError:
+            future.cancel()
+            raise GatewayError('upstream data is not available right now')
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _refresh(self, key, fetch):
+        task = self._inflight.get(key)
+        if task is None:
+            # A fresh context: the fetch is shared by every waiting request, so
+            # its queries are not charged to whichever one started it.
+            task = self._inflight[key] = self._loop.create_task(self._fetch(key, fetch), context=contextvars.Context())
+            task.add_done_callback(lambda done: self._done(key, done))
+        return task
+
+    def _done(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Refreshing {key} failed: {task.exception()!r}")
+
+    async def _fetch(self, key, fetch):
+        value = await asyncio.wait_for(fetch(), self.timeout)
+        entry = (value, datetime.utcnow())
+        self.entries.set(key, entry)
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.save, key, *entry)
+            except Exception as e:
+                logger.warning(f"Could not save snapshot for {key}: {e}")
+        return entry
+
+    async def _load(self, key, check_store=True):
+        entry = self.entries.get(key)
+        if entry is None and check_store and self.store is not None:
+            try:
+                entry = await asyncio.to_thread(self.store.load, key)
+            except Exception as e:
+                logger.warning(f"Could not load snapshot for {key}: {e}")
+            if entry is not None:
+                self.entries.set(key, entry)
+        return entry
+
+    async def preload(self, keys):
+        # One store query for all the keys a page is about to ask for.
+        missing = [key for key in keys if self.entries.get(key) is None]
+        if not missing or self.store is None:
+            return
+        try:
+            entries = await asyncio.to_thread(self.store.load_many, missing)
+        except Exception as e:
+            logger.warning(f"Could not load snapshots: {e}")
+            return
+        for key, entry in entries.items():
+            if self.entries.get(key) is None:
+                self.entries.set(key, entry)
+
+    async def get(self, key, fetch, ttl, stale_ttl, check_store=True):
+        # check_store=False when preload() already looked the key up.
+        entry = await self._load(key, check_store)
+        if entry is not None:
+            age = (datetime.utcnow() - entry[1]).total_seconds()
+            if age < ttl:
+                return _result(entry, 'cache', stale=False)
+            if age < ttl + stale_ttl:
+                self._refresh(key, fetch)
+                return _result(entry, 'cache', stale=True)
+        try:
+            # Shielded: a caller that gives up must not cancel the fetch for
+            # everyone else waiting on it.
+            return _result(await asyncio.shield(self._refresh(key, fetch)), 'live', stale=False)
+        except Exception as e:
+            if entry is None:
+                raise GatewayError(f'{key} is not available and there is no saved copy')
+            return _result(entry, 'snapshot', stale=True)
+
+    async def forecast(self, latitude, longitude, start, end, check_store=True):
+        latitude, longitude = round(latitude, 2), round(longitude, 2)
+        key = forecast_key(latitude, longitude, start, end)
+        return await self.get(key, lambda: self.provider.forecast(latitude, longitude, start, end), *WEATHER_TTL,
+                              check_store=check_store)
+
+    async def rates(self, base):
+        return await self.get(f'rates:{base}', lambda: self.provider.rates(base), *RATES_TTL)
+
+
+def forecast_key(latitude, longitude, start, end):
+    # Two decimals (about 1 km) so nearby points share an entry.
+    return f'forecast:{round(latitude, 2)}:{round(longitude, 2)}:{start.isoformat()}:{end.isoformat()}'
+
+
+def _result(entry, source, stale):
+    value, fetched_at = entry
+    return {'data': value, 'fetchedAt': fetched_at.isoformat(), 'source': source, 'stale': stale}
+
+
+def get_gateway(app):
+    # One gateway (and loop thread) per app and process; a forked worker
+    # builds its own since threads do not survive fork.
+    gateway = app.extensions.get('gateway')
+    if gateway is None or gateway[0] != os.getpid():
+        from models import db
+        provider = app.config.get('GATEWAY_PROVIDER') or HTTPProvider(
+            app.config.get('WEATHER_API_URL') or WEATHER_API_URL,
+            app.config.get('RATES_API_URL') or RATES_API_URL,
+            app.config.get('GATEWAY_TIMEOUT', TIMEOUT_SECONDS)
+        )
+        with app.app_context():
+            store = SnapshotStore(db.engine)
+        gateway = app.extensions['gateway'] = (os.getpid(), Gateway(
+            provider, store, timeout=app.config.get('GATEWAY_TIMEOUT', TIMEOUT_SECONDS)))
+    return gateway[1]
+
+
+def destinations(session, Activity, trip_id):
+    # One row per geohash cell the trip visits, with its date span.
+    cell = func.substr(Activity.geohash, 1, DESTINATION_PRECISION)
+    rows = session.query(
+        cell.label('cell'), func.min(Activity.location).label('location'),
+        func.avg(Activity.latitude).label('latitude'), func.avg(Activity.longitude).label('longitude'),
+        func.min(Activity.date).label('start'), func.max(Activity.date).label('end')
+    ).filter(Activity.trip_id == trip_id, Activity.geohash.isnot(None)).group_by(cell).order_by('start').all()
+    return rows
+
+
+async def _forecasts(gateway, rows):
+    await gateway.preload([forecast_key(row.latitude, row.longitude, row.start, row.end) for row in rows])
+    results = await asyncio.gather(*(
+        gateway.forecast(row.latitude, row.longitude, row.start, row.end, check_store=False) for row in rows
+    ), return_exceptions=True)
+    destinations = []
+    for row, result in zip(rows, results):
+        destination = {
+            'location': row.location,
+            'latitude': round(row.latitude, 4),
+            'longitude': round(row.longitude, 4),
+            'startDate': row.start.isoformat(),
+            'endDate': row.end.isoformat()
+        }
+        if isinstance(result, Exception):
+            destination['error'] = str(result)
+        else:
+            destination.update(forecast=result['data'], fetchedAt=result['fetchedAt'],
+                               source=result['source'], stale=result['stale'])
+        destinations.append(destination)
+    return destinations
+
+
+def trip_weather(gateway, session, Activity, trip_id):
+    # All of the trip's destinations are fetched concurrently.
+    rows = destinations(session, Activity, trip_id)
+    if not rows:
+        return []
+    return gateway.run(_forecasts(gateway, rows))
+
+
+def exchange_rates(gateway, base):
+    return gateway.run(gateway.rates(base))
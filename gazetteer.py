@@ -0,0 +1,466 @@
+# Coordinates for free-text activity locations, without a network call.
+#
+# Places come from vn_places.tsv (or a GeoNames country extract such as
+# VN.txt) and are compiled once into a flat binary file that is memory-mapped
+# read-only, so loading takes no parsing and forked workers share the pages.
+# The file holds the coordinates as float32 arrays, place names, every name
+# and alternate name as a compact key ("Thành phố Hồ Chí Minh" -> "hochiminh")
+# sorted for exact and prefix lookups, and a trigram index over those keys for
+# fuzzy ones, all diacritic-insensitive.
+#
+# The Geocoder in front of it remembers resolved strings in memory and in
+# geocode_cache, so a location seen once is never matched again; a row edited
+# by hand there overrides the gazetteer for that string.
+#
+#   python gazetteer.py build [source] [output]
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from cache import LRUCache
+from search import fold
+from spatial import geohash_for
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATH = os.path.join(HERE, 'vn_places.tsv')
+DATA_PATH = os.path.join(HERE, 'vn_places.gaz')
+
+MAGIC = b'VNGZ'
+FORMAT_VERSION = 1
+# magic, format version, places, key entries, trigrams, postings, then the
+# byte lengths of the names and keys blobs.
+HEADER = struct.Struct('<4sIIIIIII')
+
+# Dice similarity of trigram sets a fuzzy match needs, and the shortest key
+# worth matching fuzzily ("hue" is three letters from anything).
+MIN_SIMILARITY = 0.6
+MIN_FUZZY_LENGTH = 4
+MAX_KEY_LENGTH = 64
+MAX_PREFIX_SCAN = 4096
+# Longest geocode_cache key; longer strings are still resolved, not cached.
+MAX_QUERY_LENGTH = 200
+CACHE_SIZE = 65536
+# Seconds. Hits are re-read from geocode_cache now and then so edits there
+# take effect; misses are retried in case a row was added.
+HIT_TTL = 3600
+MISS_TTL = 300
+LOAD_BATCH_SIZE = 500
+
+# Administrative words that are dropped from the ends of names and queries.
+PREFIXES = ('thanh pho ', 'tp ', 'tinh ', 'thi xa ', 'tx ')
+SUFFIXES = (' city', ' province', ' vietnam', ' viet nam', ' vn')
+
+Match = namedtuple('Match', 'name province kind latitude longitude score')
+
+_WORD_RE = re.compile(r'[a-z0-9]+')
+_PART_RE = re.compile(r'[,;/()]')
+_ALPHABET = {c: n for n, c in enumerate('$abcdefghijklmnopqrstuvwxyz0123456789')}
+_UNKNOWN = object()
+
+_CacheModel = None
+
+
+def register(cache_model):
+    global _CacheModel
+    _CacheModel = cache_model
+
+
+def normalize(text):
+    # "TP. Hồ Chí Minh" -> "ho chi minh": folded, punctuation dropped and an
+    # administrative prefix or suffix removed when something is left.
+    words = ' '.join(_WORD_RE.findall(fold(text)))
+    for prefix in PREFIXES:
+        if words.startswith(prefix) and len(words) > len(prefix):
+            words = words[len(prefix):]
+            break
+    for suffix in SUFFIXES:
+        if words.endswith(suffix) and len(words) > len(suffix):
+            words = words[:-len(suffix)]
+            break
+    return words
+
+
+def compact(text):
+    # The index key: spacing is ignored, so "Danang" finds "Đà Nẵng".
+    return normalize(text).replace(' ', '')
+
+
+def cache_key(text):
+    # Comma-separated parts stay apart, since lookups try them one by one.
+    return ','.join(filter(None, (normalize(part) for part in _PART_RE.split(text))))
+
+
+def _parts(text):
+    # Word lists to try, most specific first: each part ("Hoan Kiem Lake,
+    # Hanoi" -> hoan kiem lake, hanoi), then the whole string.
+    parts = [normalize(part).split() for part in _PART_RE.split(text)]
+    parts = [words for words in parts if words]
+    if len(parts) > 1:
+        parts.append([word for words in parts for word in words])
+    return parts
+
+
+def _trigrams(key):
+    padded = f'$${key}$'
+    return {(_ALPHABET[padded[n]] * 37 + _ALPHABET[padded[n + 1]]) * 37 + _ALPHABET[padded[n + 2]]
+            for n in range(len(padded) - 2)}
+
+
+# Building
+
+def _read_source(path):
+    # Yields (name, alternate names, province, kind, latitude, longitude,
+    # population) from vn_places.tsv or a GeoNames dump.
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 19:
+                # geonameid, name, asciiname, alternatenames, latitude,
+                # longitude, feature class, feature code, ..., population, ...
+                yield (fields[1], [fields[2]] + fields[3].split(','), '', fields[7].lower(),
+                       float(fields[4]), float(fields[5]), int(fields[14] or 0))
+            elif len(fields) == 7 and fields[0] != 'name':
+                name, alternates, province, kind, latitude, longitude, population = fields
+                yield (name, alternates.split(';') if alternates else [], province, kind,
+                       float(latitude), float(longitude), int(population or 0))
+            elif fields[0] != 'name':
+                raise ValueError(f'{path}: expected 7 or 19 tab-separated columns, got {len(fields)}')
+
+
+def _padded(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+def build(source=SOURCE_PATH, path=DATA_PATH):
+    # Compiles `source` into `path`; returns the number of places. The file is
+    # written beside the target and renamed over it, so readers never see a
+    # partial one.
+    latitudes, longitudes, ranks = array('f'), array('f'), array('I')
+    name_offsets, names = array('I', [0]), bytearray()
+    entries = []
+    for name, alternates, province, kind, latitude, longitude, population in _read_source(source):
+        place = len(ranks)
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+        ranks.append(max(0, min(population, 2 ** 32 - 1)))
+        names += f'{name}\t{province}\t{kind}'.encode()
+        name_offsets.append(len(names))
+        for key in {compact(text) for text in [name] + alternates}:
+            if key and len(key) <= MAX_KEY_LENGTH:
+                entries.append((key.encode(), place))
+    # Within a key, larger places first.
+    entries.sort(key=lambda entry: (entry[0], -ranks[entry[1]]))
+
+    key_offsets, key_places, keys = array('I', [0]), array('I'), bytearray()
+    postings_by_gram = {}
+    for n, (key, place) in enumerate(entries):
+        keys += key
+        key_offsets.append(len(keys))
+        key_places.append(place)
+        for gram in _trigrams(key.decode()):
+            postings_by_gram.setdefault(gram, []).append(n)
+    gram_codes, gram_offsets, postings = array('I'), array('I', [0]), array('I')
+    for gram in sorted(postings_by_gram):
+        gram_codes.append(gram)
+        postings.extend(postings_by_gram[gram])
+        gram_offsets.append(len(postings))
+
+    sections = [latitudes, longitudes, ranks, name_offsets, _padded(bytes(names)),
+                key_offsets, key_places, _padded(bytes(keys)), gram_codes, gram_offsets, postings]
+    if sys.byteorder != 'little':
+        for section in sections:
+            if isinstance(section, array):
+                section.byteswap()
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(ranks), len(entries), len(gram_codes), len(postings),
+                                len(names), len(keys)))
+            for section in sections:
+                f.write(section if isinstance(section, bytes) else section.tobytes())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return len(ranks)
+
+
+# Reading
+
+class Gazetteer:
+    def __init__(self, path=DATA_PATH):
+        if sys.byteorder != 'little':
+            raise ValueError('the gazetteer file is little-endian; this machine is not')
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, places, entries, grams, postings, names_length, keys_length = \
+            HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a gazetteer file of format {FORMAT_VERSION}')
+        view = memoryview(self._map)
+        offset = HEADER.size
+
+        def section(length, format=None):
+            nonlocal offset
+            size = length * 4 if format else length + (-length % 4)
+            part = view[offset:offset + size]
+            offset += size
+            return part.cast(format) if format else part[:length]
+
+        self.latitudes = section(places, 'f')
+        self.longitudes = section(places, 'f')
+        self.ranks = section(places, 'I')
+        self._name_offsets = section(places + 1, 'I')
+        self._names = section(names_length)
+        self._key_offsets = section(entries + 1, 'I')
+        self._key_places = section(entries, 'I')
+        self._keys = section(keys_length)
+        self._gram_codes = section(grams, 'I')
+        self._gram_offsets = section(grams + 1, 'I')
+        self._postings = section(postings, 'I')
+        if offset != len(self._map):
+            raise ValueError(f'{path} is truncated or corrupt')
+        self.path = path
+
+    def __len__(self):
+        return len(self.ranks)
+
+    def _key(self, entry):
+        return bytes(self._keys[self._key_offsets[entry]:self._key_offsets[entry + 1]])
+
+    def _search(self, key):
+        return bisect.bisect_left(range(len(self._key_places)), key, key=self._key)
+
+    def _exact(self, key):
+        # Places indexed under `key`, largest first.
+        key = key.encode()
+        entry = self._search(key)
+        places = []
+        while entry < len(self._key_places) and self._key(entry) == key:
+            places.append(self._key_places[entry])
+            entry += 1
+        return places
+
+    def _fuzzy(self, key):
+        # {place: similarity} for keys whose trigrams are at least
+        # MIN_SIMILARITY alike (Dice coefficient).
+        grams = _trigrams(key)
+        counts = {}
+        for gram in grams:
+            n = bisect.bisect_left(self._gram_codes, gram)
+            if n < len(self._gram_codes) and self._gram_codes[n] == gram:
+                for entry in self._postings[self._gram_offsets[n]:self._gram_offsets[n + 1]]:
+                    counts[entry] = counts.get(entry, 0) + 1
+        # Dice is at most 2c / (|grams| + c) for c shared trigrams.
+        least = MIN_SIMILARITY * len(grams) / (2 - MIN_SIMILARITY)
+        scores = {}
+        for entry, count in counts.items():
+            if count < least:
+                continue
+            score = 2 * count / (len(grams) + len(_trigrams(self._key(entry).decode())))
+            place = self._key_places[entry]
+            if score >= MIN_SIMILARITY and score > scores.get(place, 0):
+                scores[place] = score
+        return scores
+
+    def _describe(self, place):
+        return bytes(self._names[self._name_offsets[place]:self._name_offsets[place + 1]]).decode().split('\t')
+
+    def _match(self, place, score):
+        name, province, kind = self._describe(place)
+        return Match(name, province or None, kind or None, round(self.latitudes[place], 5),
+                     round(self.longitudes[place], 5), round(score, 3))
+
+    def _best(self, places, context):
+        # Several places share the key: prefer one in a province the query
+        # names ("Vinh, Nghe An"), then the most populous.
+        return max(places, key=lambda place: (compact(self._describe(place)[1]) in context, self.ranks[place]))
+
+    def lookup(self, text):
+        # The best match for a free-text location, or None. Each part of the
+        # string is tried in order, exactly and then fuzzily, before the whole.
+        # The score is 1 for an exact name, else the share of the string matched
+        # or the trigram similarity.
+        parts = _parts(text)
+        context = {''.join(words) for words in parts}
+        for words in parts:
+            key = ''.join(words)
+            places = self._exact(key)
+            if places:
+                return self._match(self._best(places, context), 1.0)
+            # Then its leading words, longest first: "Mui Ne beach" -> "muine".
+            for n in range(len(words) - 1, 0, -1):
+                lead = ''.join(words[:n])
+                places = self._exact(lead) if len(lead) >= MIN_FUZZY_LENGTH else None
+                if places:
+                    return self._match(self._best(places, context), len(lead) / len(key))
+            if len(key) >= MIN_FUZZY_LENGTH:
+                scores = self._fuzzy(key)
+                if scores:
+                    top = max(scores.values())
+                    return self._match(self._best([place for place, score in scores.items() if score == top],
+                                                  context), top)
+        return None
+
+    def suggest(self, text, limit=10):
+        # Places whose names start with `text`, exact names and larger places
+        # first, topped up with fuzzy matches.
+        key = compact(text)
+        if not key:
+            return []
+        prefix = key.encode()
+        found = {}
+        entry = self._search(prefix)
+        end = min(len(self._key_places), entry + MAX_PREFIX_SCAN)
+        while entry < end:
+            name = self._key(entry)
+            if not name.startswith(prefix):
+                break
+            place = self._key_places[entry]
+            found[place] = max(found.get(place, 0), len(prefix) / len(name))
+            entry += 1
+        if len(found) < limit and len(key) >= MIN_FUZZY_LENGTH:
+            for place, score in self._fuzzy(key).items():
+                found.setdefault(place, score)
+        ranked = sorted(found.items(), key=lambda item: (-item[1], -self.ranks[item[0]]))
+        return [self._match(place, score) for place, score in ranked[:limit]]
+
+
+class Geocoder:
+    def __init__(self, gazetteer, maxsize=CACHE_SIZE):
+        self.gazetteer = gazetteer
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def resolve_many(self, texts, session=None):
+        # {text: Match or None}. With a session, geocode_cache is read first
+        # and new matches are added to it in the caller's transaction.
+        keys = {text: cache_key(text) for text in set(texts) if text}
+        matches = {}
+        for key in set(keys.values()):
+            match = self.cache.get(key, _UNKNOWN)
+            if match is not _UNKNOWN:
+                matches[key] = match
+        pending = {key for key in keys.values() if key not in matches}
+        cacheable = session is not None and _CacheModel is not None
+        if pending and cacheable:
+            for key, match in self._load(session, pending).items():
+                matches[key] = match
+                self.cache.set(key, match, ttl=HIT_TTL)
+                pending.discard(key)
+        resolved = {}
+        for key in pending:
+            match = matches[key] = self.gazetteer.lookup(key) if key else None
+            self.cache.set(key, match, ttl=HIT_TTL if match else MISS_TTL)
+            if match and len(key) <= MAX_QUERY_LENGTH:
+                resolved[key] = match
+        if resolved and cacheable:
+            self._save(session, resolved)
+        return {text: matches[key] for text, key in keys.items()}
+
+    def resolve(self, text, session=None):
+        return self.resolve_many([text], session).get(text)
+
+    def _load(self, session, keys):
+        table = _CacheModel.__table__
+        keys = [key for key in keys if len(key) <= MAX_QUERY_LENGTH]
+        found = {}
+        for start in range(0, len(keys), LOAD_BATCH_SIZE):
+            rows = session.execute(select(
+                table.c.location, table.c.name, table.c.province, table.c.kind,
+                table.c.latitude, table.c.longitude, table.c.score
+            ).where(table.c.location.in_(keys[start:start + LOAD_BATCH_SIZE])))
+            for row in rows:
+                found[row.location] = Match(row.name, row.province, row.kind, row.latitude, row.longitude, row.score)
+        return found
+
+    def _save(self, session, matches):
+        table = _CacheModel.__table__
+        connection = session.connection()
+        dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+        # Another writer may have cached the same string meanwhile; either
+        # row will do.
+        now = datetime.utcnow()
+        connection.execute(dialect.insert(table).on_conflict_do_nothing(index_elements=[table.c.location]), [
+            dict(match._asdict(), location=key, resolved_at=now) for key, match in matches.items()
+        ])
+
+
+def fill_coordinates(geocoder, rows, session=None):
+    # Sets latitude, longitude and geohash on row dicts that have a location
+    # but no coordinates. Returns how many were filled.
+    missing = [row for row in rows
+               if row.get('location') and (row.get('latitude') is None or row.get('longitude') is None)]
+    if not missing or geocoder is None:
+        return 0
+    matches = geocoder.resolve_many([row['location'] for row in missing], session)
+    filled = 0
+    for row in missing:
+        match = matches.get(row['location'])
+        if match:
+            row['latitude'], row['longitude'] = match.latitude, match.longitude
+            row['geohash'] = geohash_for(match.latitude, match.longitude)
+            filled += 1
+    return filled
+
+
+def _stale(source, path):
+    if not os.path.exists(path):
+        return True
+    return os.path.exists(source) and os.path.getmtime(source) > os.path.getmtime(path)
+
+
+def load(source=SOURCE_PATH, path=DATA_PATH):
+    # The compiled gazetteer, rebuilt first if `source` is newer.
+    if _stale(source, path):
+        started = datetime.utcnow()
+        count = build(source, path)
+        logger.info(f"Built gazetteer {path} with {count} places in "
+                    f"{(datetime.utcnow() - started).total_seconds() * 1000:.0f} ms")
+    return Gazetteer(path)
+
+
+def get_geocoder(app):
+    # One geocoder per app and process, or None when the gazetteer cannot be
+    # built or read (locations then keep whatever coordinates they came with).
+    # The mapped file itself is shared with forked workers.
+    geocoder = app.extensions.get('geocoder')
+    if geocoder is None or geocoder[0] != os.getpid():
+        gazetteer = geocoder[1].gazetteer if geocoder and geocoder[1] else None
+        if gazetteer is None:
+            source = app.config.get('GAZETTEER_SOURCE') or SOURCE_PATH
+            path = app.config.get('GAZETTEER_PATH') or DATA_PATH
+            try:
+                gazetteer = load(source, path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Gazetteer unavailable, locations will not be geocoded: {e}")
+        geocoder = app.extensions['geocoder'] = (
+            os.getpid(), Geocoder(gazetteer, app.config.get('GEOCODE_CACHE_SIZE', CACHE_SIZE)) if gazetteer else None)
+    return geocoder[1]
+
+
+if __name__ == '__main__':
+    # Usage: python gazetteer.py build [source] [output]
+    #        python gazetteer.py lookup <location>
+    command = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    if command == 'build':
+        source = sys.argv[2] if len(sys.argv) > 2 else SOURCE_PATH
+        path = sys.argv[3] if len(sys.argv) > 3 else DATA_PATH
+        print(f"Wrote {build(source, path)} places to {path}.")
+    elif command == 'lookup':
+        gazetteer = load()
+        for text in sys.argv[2:]:
+            print(f"{text}: {gazetteer.lookup(text)}")
+    else:
+        sys.exit(f"unknown command: {command}")
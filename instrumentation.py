@@ -0,0 +1,247 @@
+import contextvars
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from flask import abort, current_app, g, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# The same statement text this many times in one request is reported as an
+# N+1 pattern (one query per row of an earlier result).
+N_PLUS_ONE_THRESHOLD = 5
+MAX_REPEATED_STATEMENTS = 5
+SQL_PREVIEW_LENGTH = 200
+
+# Latency histogram buckets grow by 5% from 0.05 ms, so percentiles are off
+# by at most a few percent at constant memory per endpoint.
+HISTOGRAM_MIN_MS = 0.05
+HISTOGRAM_GROWTH = 1.05
+_LOG_GROWTH = math.log(HISTOGRAM_GROWTH)
+
+# Requests that matched no route share one entry, so scans of random URLs do
+# not grow the table.
+UNMATCHED = '<unmatched>'
+
+_current = contextvars.ContextVar('request_stats', default=None)
+_lock = threading.Lock()
+_endpoints = {}
+_started = datetime.utcnow()
+
+
+class RequestStats:
+    __slots__ = ('queries', 'sql_seconds', 'rows', 'serialize_seconds', 'statements', 'started')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.serialize_seconds = 0.0
+        self.statements = Counter()
+        self.started = time.perf_counter()
+
+    def repeated(self):
+        return [(sql, n) for sql, n in self.statements.most_common(MAX_REPEATED_STATEMENTS)
+                if n >= N_PLUS_ONE_THRESHOLD]
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        bucket = 0 if ms <= HISTOGRAM_MIN_MS else int(math.log(ms / HISTOGRAM_MIN_MS) / _LOG_GROWTH) + 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(HISTOGRAM_MIN_MS * HISTOGRAM_GROWTH ** bucket, self.max)
+        return self.max
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.serialize_seconds = 0.0
+        self.n_plus_one = 0
+        self.repeated = {}
+
+    def add(self, stats, ms, status):
+        self.latency.add(ms)
+        self.errors += status >= 500
+        self.queries += stats.queries
+        self.sql_seconds += stats.sql_seconds
+        self.rows += stats.rows
+        self.serialize_seconds += stats.serialize_seconds
+        repeated = stats.repeated()
+        if repeated:
+            self.n_plus_one += 1
+            for sql, n in repeated:
+                self.repeated[sql] = max(self.repeated.get(sql, 0), n)
+            if len(self.repeated) > MAX_REPEATED_STATEMENTS:
+                top = sorted(self.repeated.items(), key=lambda item: item[1], reverse=True)
+                self.repeated = dict(top[:MAX_REPEATED_STATEMENTS])
+
+    def to_dict(self):
+        n = self.latency.count or 1
+        return {
+            'requests': self.latency.count,
+            'errors': self.errors,
+            'latencyMs': {
+                'p50': _round(self.latency.percentile(0.50)),
+                'p95': _round(self.latency.percentile(0.95)),
+                'p99': _round(self.latency.percentile(0.99)),
+                'max': _round(self.latency.max),
+                'mean': _round(self.latency.total / n)
+            },
+            'queriesPerRequest': round(self.queries / n, 2),
+            'sqlMsPerRequest': _round(self.sql_seconds * 1000 / n),
+            'rowsPerRequest': round(self.rows / n, 2),
+            'serializeMsPerRequest': _round(self.serialize_seconds * 1000 / n),
+            'nPlusOne': {
+                'requests': self.n_plus_one,
+                'statements': [{'sql': sql, 'repeats': repeats} for sql, repeats in
+                               sorted(self.repeated.items(), key=lambda item: item[1], reverse=True)]
+            }
+        }
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None:
+        return
+    started = conn.info.get('query_started')
+    if started:
+        stats.sql_seconds += time.perf_counter() - started.pop()
+    stats.queries += 1
+    stats.statements[statement] += 1
+    # DBAPI rowcount: rows returned by a SELECT on psycopg2 and rows written
+    # by DML everywhere; SQLite reports -1 for SELECTs.
+    if cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+
+
+def add_serialize_time(seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.serialize_seconds += seconds
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # jsonify() goes through the app's JSON provider; count its time as
+    # serialization.
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            add_serialize_time(time.perf_counter() - started)
+
+
+def _start():
+    g.request_stats_token = _current.set(RequestStats())
+
+
+def _finish(response):
+    stats = _current.get()
+    if stats is None:
+        return response
+    ms = (time.perf_counter() - stats.started) * 1000
+    endpoint = f'{request.method} {request.endpoint or UNMATCHED}'
+    repeated = stats.repeated()
+    if repeated:
+        sql, n = repeated[0]
+        logger.warning(f"Possible N+1 in {endpoint}: {n} identical queries ({sql[:SQL_PREVIEW_LENGTH]})")
+    with _lock:
+        entry = _endpoints.get(endpoint)
+        if entry is None:
+            entry = _endpoints[endpoint] = EndpointStats()
+        entry.add(stats, ms, response.status_code)
+    if exposed():
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.sql_seconds * 1000:.2f};desc="{stats.queries} queries", '
+            f'ser;dur={stats.serialize_seconds * 1000:.2f}, total;dur={ms:.2f}'
+        )
+    return response
+
+
+def _teardown(exc):
+    token = g.pop('request_stats_token', None)
+    if token is not None:
+        _current.reset(token)
+
+
+def install(app):
+    if not app.config.get('SQL_INSTRUMENTATION', True):
+        return
+    app.json = TimedJSONProvider(app)
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.teardown_request(_teardown)
+    app.add_url_rule('/api/debug/metrics', 'debug_metrics', metrics_view, methods=['GET', 'DELETE'])
+
+
+def exposed():
+    # The metrics report includes SQL text and DELETE resets it, with no auth,
+    # and Server-Timing shows every client query counts: only in debug mode or
+    # with DEBUG_METRICS. Checked per request, since run(debug=True) turns
+    # debug on after create_app().
+    return current_app.debug or bool(current_app.config.get('DEBUG_METRICS'))
+
+
+def snapshot():
+    with _lock:
+        endpoints = {name: entry.to_dict() for name, entry in sorted(_endpoints.items())}
+    return {
+        'since': _started.isoformat(),
+        'nPlusOneThreshold': N_PLUS_ONE_THRESHOLD,
+        'endpoints': endpoints
+    }
+
+
+def reset():
+    global _started
+    with _lock:
+        _endpoints.clear()
+        _started = datetime.utcnow()
+
+
+def metrics_view():
+    if not exposed():
+        abort(404)
+    if request.method == 'DELETE':
+        reset()
+        return '', 204
+    return jsonify(snapshot())
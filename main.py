@@ -1,74 +1,213 @@
 #!/usr/bin/env python3
-import os
-from flask import Flask, jsonify, render_template, request
-from flask_cors import CORS
-from models import db, Trip, Activity
-from sqlalchemy import func
+from datetime import datetime
+from flask import Blueprint, Response, current_app, jsonify, request
+from models import db, Trip, Activity, Todo
+import spatial
+import clustering
+import pagination
+import serialization
+import search
+import snapshots
+import gateway
+import events
+import gazetteer
+from response_cache import trip_cached
 
-app = Flask(__name__)
-CORS(app)
+# Map, search and sync API; served by the app from wsgi.create_app().
+bp = Blueprint('main', __name__)
 
-# Configure the SQLAlchemy part of the app instance
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY')
+@bp.route('/api/map')
+def map_data():
+    trip_id = request.args.get('trip_id', type=int)
+    zoom = request.args.get('zoom', 10 if trip_id else 2, type=int)
+    zoom = max(clustering.MIN_ZOOM, min(clustering.MAX_ZOOM, zoom))
 
-# Initialize SQLAlchemy
-db.init_app(app)
+    viewport = [request.args.get(name, type=float) for name in ('south', 'west', 'north', 'east')]
+    if None in viewport:
+        viewport = clustering.data_bounds(db, Activity, trip_id)
+    elif not (-90 <= viewport[0] <= viewport[2] <= 90) or not all(-180 <= v <= 180 for v in viewport[1::2]):
+        return jsonify({'error': 'invalid viewport'}), 400
 
-@app.route('/')
-def index():
-    google_maps_api_key = os.getenv('GOOGLE_MAPS_API_KEY')
-    return render_template('index.html', google_maps_api_key=google_maps_api_key)
+    clusters = []
+    precision = None
+    if viewport:
+        clusters, precision = clustering.clusters(db, Activity, *viewport, zoom, trip_id=trip_id)
 
-@app.route('/api/map')
-def map_data():
-    trip_id = request.args.get('trip_id', type=int)
-    
-    if trip_id:
-        activities = Activity.query.filter_by(trip_id=trip_id).all()
-    else:
-        activities = Activity.query.all()
-    
-    markers = [
-        {
-            'lat': activity.latitude,
-            'lng': activity.longitude,
-            'title': activity.title
-        }
-        for activity in activities
-        if activity.latitude and activity.longitude
-    ]
-    
-    if markers:
+    total = sum(cluster['count'] for cluster in clusters)
+    if total:
         center = {
-            'lat': sum(marker['lat'] for marker in markers) / len(markers),
-            'lng': sum(marker['lng'] for marker in markers) / len(markers)
+            'lat': sum(cluster['lat'] * cluster['count'] for cluster in clusters) / total,
+            'lng': sum(cluster['lng'] * cluster['count'] for cluster in clusters) / total
         }
     else:
         center = {'lat': 0, 'lng': 0}
-    
+
     map_data = {
         'center': center,
-        'zoom': 10 if trip_id else 2,
-        'markers': markers
+        'zoom': zoom,
+        'precision': precision,
+        'total': total,
+        'clusters': clusters
     }
-    
-    return jsonify(map_data)
 
-@app.route('/api/trips')
-def get_trips():
-    trips = Trip.query.all()
-    return jsonify([trip.to_dict() for trip in trips])
+    return jsonify(map_data)
 
-@app.route('/api/activities')
+@bp.route('/api/activities')
+@trip_cached()
 def get_activities():
+    try:
+        projection = serialization.Projection(serialization.ACTIVITY_FIELDS, request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    query = projection.query(*pagination.ACTIVITY_KEYSET.columns)
     trip_id = request.args.get('trip_id', type=int)
     if trip_id:
-        activities = Activity.query.filter_by(trip_id=trip_id).all()
-    else:
-        activities = Activity.query.all()
+        query = query.filter(Activity.trip_id == trip_id)
+    if pagination.wants_paging(request.args):
+        return pagination.list_response(pagination.ACTIVITY_KEYSET, query, request.args, projection.serialize)
+    return serialization.json_response(projection.serialize_all(query))
+
+@bp.route('/api/activities/bbox')
+def activities_in_bbox():
+    bounds = [request.args.get(name, type=float) for name in ('south', 'west', 'north', 'east')]
+    if None in bounds:
+        return jsonify({'error': 'south, west, north and east are required'}), 400
+    south, west, north, east = bounds
+    if not (-90 <= south <= north <= 90) or not (-180 <= west <= 180 and -180 <= east <= 180):
+        return jsonify({'error': 'invalid bounding box'}), 400
+    trip_id = request.args.get('trip_id', type=int)
+    limit = max(1, min(request.args.get('limit', spatial.MAX_BBOX_RESULTS, type=int), spatial.MAX_BBOX_RESULTS))
+    activities = spatial.bbox_query(Activity, south, west, north, east, trip_id=trip_id, limit=limit).all()
     return jsonify([activity.to_dict() for activity in activities])
 
+@bp.route('/api/activities/nearest')
+def nearest_activities():
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return jsonify({'error': 'valid lat and lng are required'}), 400
+    k = min(max(request.args.get('k', 10, type=int), 1), 100)
+    trip_id = request.args.get('trip_id', type=int)
+    max_km = request.args.get('max_km', type=float)
+    results = spatial.nearest(Activity, lat, lng, k=k, trip_id=trip_id, max_km=max_km)
+    return jsonify([dict(activity.to_dict(), distanceKm=round(distance, 3)) for distance, activity in results])
+
+@bp.route('/api/trips/<int:trip_id>/route')
+@trip_cached()
+def trip_route(trip_id):
+    Trip.query.get_or_404(trip_id)
+    day = request.args.get('date')
+    if day:
+        try:
+            day = datetime.strptime(day, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'date must be YYYY-MM-DD'}), 400
+    import route_optimizer  # pulls in numpy; only this endpoint needs it
+    return jsonify({'tripId': trip_id, 'days': route_optimizer.suggest_routes(trip_id, day)})
+
+@bp.route('/api/trips/<int:trip_id>/weather')
+def trip_weather(trip_id):
+    Trip.query.get_or_404(trip_id)
+    try:
+        destinations = gateway.trip_weather(gateway.get_gateway(current_app), db.session, Activity, trip_id)
+    except gateway.GatewayError as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify({'tripId': trip_id, 'destinations': destinations})
+
+@bp.route('/api/exchange_rates')
+def exchange_rates():
+    base = request.args.get('base', 'VND').upper()
+    if not (len(base) == 3 and base.isalpha()):
+        return jsonify({'error': 'base must be a 3-letter currency code'}), 400
+    try:
+        result = gateway.exchange_rates(gateway.get_gateway(current_app), base)
+    except gateway.GatewayError as e:
+        return jsonify({'error': str(e)}), 503
+    symbols = [symbol.upper() for symbol in request.args.get('symbols', '').split(',') if symbol.strip()]
+    rates = result['data']['rates']
+    if symbols:
+        rates = {symbol: rates[symbol] for symbol in symbols if symbol in rates}
+    return jsonify(dict(result, data=dict(result['data'], rates=rates)))
+
+@bp.route('/api/search')
+def search_view():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    kinds = [kind for kind in request.args.get('type', '').split(',') if kind]
+    if any(kind not in search.FIELD_WEIGHTS for kind in kinds):
+        return jsonify({'error': f"type must be one of {', '.join(search.FIELD_WEIGHTS)}"}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    search.ensure_loaded(db.session, Trip, Activity, Todo)
+    hits = search.index.search(
+        query,
+        limit=limit,
+        trip_id=request.args.get('trip_id', type=int),
+        kinds=kinds,
+        prefix=request.args.get('prefix', '1') != '0'
+    )
+    return jsonify({'query': query, 'hits': hits})
+
+@bp.route('/api/geocode')
+def geocode():
+    # Offline matches for a location string: the best one, then places whose
+    # names start with it, for autocomplete without a Maps key.
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    geocoder = gazetteer.get_geocoder(current_app)
+    if geocoder is None:
+        return jsonify({'error': 'the gazetteer is not available'}), 503
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    match = geocoder.resolve(query)
+    return jsonify({
+        'query': query,
+        'match': match._asdict() if match else None,
+        'suggestions': [suggestion._asdict() for suggestion in geocoder.gazetteer.suggest(query, limit)]
+    })
+
+@bp.route('/api/trips/<int:trip_id>/snapshot')
+def trip_snapshot(trip_id):
+    # The ETag only changes with this trip's own log entries, so an unchanged
+    # trip is a 304 even while other trips are being edited.
+    etag = f'snap-{trip_id}-{snapshots.latest_token(trip_id)}'
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+    data = snapshots.snapshot(trip_id)
+    if data is None:
+        return jsonify({'error': 'trip not found'}), 404
+    return serialization.json_response(data, headers={'ETag': f'"{etag}"'}, compress=True)
+
+@bp.route('/api/sync')
+def sync():
+    since = request.args.get('since', '0')
+    if not since.isdigit():
+        return jsonify({'error': 'since must be a change token'}), 400
+    trip_ids = [int(id) for id in request.args.get('trip_ids', '').split(',') if id.strip().isdigit()]
+    trip_id = request.args.get('trip_id', type=int)
+    if trip_id:
+        trip_ids.append(trip_id)
+    limit = max(1, min(request.args.get('limit', snapshots.SYNC_LIMIT, type=int), snapshots.SYNC_LIMIT))
+    try:
+        changes = snapshots.changes_since(int(since), trip_ids=trip_ids, limit=limit)
+    except snapshots.TokenAhead as e:
+        # The log was reset (e.g. a restored database): start from a snapshot.
+        return jsonify({'error': str(e)}), 410
+    return serialization.json_response(changes, compress=True)
+
+@bp.route('/api/trips/<int:trip_id>/events')
+def trip_events(trip_id):
+    # Server-Sent Events; Last-Event-ID (set by EventSource on reconnect) or
+    # ?since= is the change token to resume from.
+    Trip.query.get_or_404(trip_id)
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    if since is not None and not since.isdigit():
+        return jsonify({'error': 'since must be a change token'}), 400
+    body = events.stream(current_app._get_current_object(), db.session, trip_id,
+                         int(since) if since is not None else None)
+    return Response(body, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001)
+    from wsgi import create_app
+    create_app().run(host='0.0.0.0', port=5001)
@@ -0,0 +1,259 @@
+import logging
+import sys
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect, select, text
+from sqlalchemy.orm import Session
+from models import db, Trip, Activity, Todo, BudgetRollup, ChangeLog, GatewaySnapshot, ReminderState, GeocodeCache
+from spatial import geohash_for
+import budget
+
+logger = logging.getLogger(__name__)
+
+# Versioned schema changes, applied in order and recorded in
+# schema_migrations. A fresh database is created from the models and stamped
+# with every version instead of replaying them.
+#
+# Non-transactional revisions run in autocommit mode on Postgres so that
+# CREATE INDEX CONCURRENTLY can build without blocking writes; they must be
+# safe to re-run if interrupted.
+Revision = namedtuple('Revision', 'version description upgrade transactional')
+
+# Serializes concurrent runners (e.g. several workers starting at once).
+ADVISORY_LOCK_KEY = 7351863
+BACKFILL_BATCH_SIZE = 5000
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', String(64), primary_key=True),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+
+def _is_postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def create_index(connection, name, table, columns):
+    if _is_postgres(connection):
+        # An interrupted concurrent build leaves an INVALID index behind that
+        # IF NOT EXISTS would skip over.
+        invalid = connection.execute(text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {'name': name}).first()
+        if invalid:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+    else:
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+
+def _optional_activity_fields(connection):
+    # Formerly update_activity_schema.py. SQLite tables come from the models,
+    # which already allow NULL here.
+    if _is_postgres(connection):
+        for column in ('start_time', 'end_time', 'category', 'price'):
+            connection.execute(text(f'ALTER TABLE activity ALTER COLUMN {column} DROP NOT NULL'))
+
+
+def _activity_geohash(connection):
+    # Formerly update_activity_geohash.py.
+    if 'geohash' not in {column['name'] for column in inspect(connection).get_columns('activity')}:
+        connection.execute(text('ALTER TABLE activity ADD COLUMN geohash VARCHAR(12)'))
+    create_index(connection, 'ix_activity_geohash', 'activity', ['geohash'])
+    create_index(connection, 'ix_activity_trip_id_geohash', 'activity', ['trip_id', 'geohash'])
+    while True:
+        rows = connection.execute(text(
+            "SELECT id, latitude, longitude FROM activity "
+            "WHERE geohash IS NULL AND latitude IS NOT NULL AND longitude IS NOT NULL LIMIT :limit"
+        ), {'limit': BACKFILL_BATCH_SIZE}).all()
+        if not rows:
+            break
+        connection.execute(
+            text("UPDATE activity SET geohash = :geohash WHERE id = :id"),
+            [{'id': row.id, 'geohash': geohash_for(row.latitude, row.longitude)} for row in rows]
+        )
+
+
+def _budget_rollup(connection):
+    BudgetRollup.__table__.create(connection, checkfirst=True)
+    budget.rebuild(Session(bind=connection))
+
+
+def _change_log(connection):
+    ChangeLog.__table__.create(connection, checkfirst=True)
+
+
+def _gateway_snapshot(connection):
+    GatewaySnapshot.__table__.create(connection, checkfirst=True)
+
+
+def _reminders(connection):
+    ReminderState.__table__.create(connection, checkfirst=True)
+    # The scheduler loads upcoming reminders by date across all trips.
+    create_index(connection, 'ix_activity_date_start_time', 'activity', ['date', 'start_time'])
+    create_index(connection, 'ix_trip_start_date', 'trip', ['start_date'])
+
+
+def _row_versions(connection):
+    for table in ('trip', 'activity', 'todo'):
+        if 'version' not in {column['name'] for column in inspect(connection).get_columns(table)}:
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+
+
+def _geocode_cache(connection):
+    GeocodeCache.__table__.create(connection, checkfirst=True)
+
+
+def _hot_path_indexes(connection):
+    # Every trip page filters by trip_id and orders by (date, start_time); the
+    # composite index also serves plain trip_id lookups.
+    create_index(connection, 'ix_activity_trip_id_date_start_time', 'activity', ['trip_id', 'date', 'start_time'])
+    create_index(connection, 'ix_todo_trip_id', 'todo', ['trip_id'])
+
+
+REVISIONS = [
+    Revision('0001_activity_optional_fields', 'Allow NULL start/end time, category and price',
+             _optional_activity_fields, True),
+    Revision('0002_activity_geohash', 'Add activity.geohash with its indexes and backfill it',
+             _activity_geohash, False),
+    Revision('0003_budget_rollup', 'Add budget_rollup and build it from existing activities',
+             _budget_rollup, True),
+    Revision('0004_change_log', 'Add change_log for delta sync', _change_log, True),
+    Revision('0005_hot_path_indexes', 'Index activity (trip_id, date, start_time) and todo (trip_id)',
+             _hot_path_indexes, False),
+    Revision('0006_gateway_snapshot', 'Add gateway_snapshot for last known weather and exchange rates',
+             _gateway_snapshot, True),
+    Revision('0007_reminders', 'Add reminder_state and index activity (date, start_time) and trip (start_date)',
+             _reminders, False),
+    Revision('0008_row_versions', 'Add version to trip, activity and todo for optimistic concurrency',
+             _row_versions, True),
+    Revision('0009_geocode_cache', 'Add geocode_cache for location strings matched against the gazetteer',
+             _geocode_cache, True),
+]
+
+
+def applied(connection):
+    schema_migrations.create(connection, checkfirst=True)
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+def _stamp(connection, version):
+    connection.execute(schema_migrations.insert(), {'version': version, 'applied_at': datetime.utcnow()})
+
+
+def _run(engine, revision):
+    with engine.connect() as connection:
+        if not revision.transactional and _is_postgres(connection):
+            connection.execution_options(isolation_level='AUTOCOMMIT')
+            revision.upgrade(connection)
+        else:
+            with connection.begin():
+                revision.upgrade(connection)
+    with engine.begin() as connection:
+        _stamp(connection, revision.version)
+
+
+def upgrade(engine):
+    with engine.connect() as lock:
+        if _is_postgres(lock):
+            lock.execute(text('SELECT pg_advisory_lock(:key)'), {'key': ADVISORY_LOCK_KEY})
+            lock.commit()
+        try:
+            with engine.begin() as connection:
+                done = applied(connection)
+                if not inspect(connection).has_table(Trip.__tablename__):
+                    logger.info("Creating database tables...")
+                    db.metadata.create_all(connection)
+                    for revision in REVISIONS:
+                        if revision.version not in done:
+                            _stamp(connection, revision.version)
+                    return []
+            pending = [revision for revision in REVISIONS if revision.version not in done]
+            for revision in pending:
+                logger.info(f"Applying migration {revision.version}: {revision.description}")
+                _run(engine, revision)
+            return [revision.version for revision in pending]
+        finally:
+            if _is_postgres(lock):
+                lock.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': ADVISORY_LOCK_KEY})
+                lock.commit()
+
+
+# Route queries that must be answered from an index, with sample parameters.
+def _plan_queries():
+    return {
+        'trip activities (trip_detail, weekly_view, map_view)':
+            select(Activity).where(Activity.trip_id == 1).order_by(Activity.date, Activity.start_time),
+        'trip todos': select(Todo).where(Todo.trip_id == 1),
+        'day conflicts': select(Activity.id, Activity.start_time, Activity.end_time).where(
+            Activity.trip_id == 1, Activity.date.in_([datetime(2024, 1, 1).date()]),
+            Activity.start_time.isnot(None)),
+        'trip budget': select(BudgetRollup).where(BudgetRollup.trip_id == 1),
+        'trip sync': select(ChangeLog.id).where(ChangeLog.trip_id.in_([1]), ChangeLog.id > 0).order_by(ChangeLog.id),
+        'sync': select(ChangeLog.id).where(ChangeLog.id > 0).order_by(ChangeLog.id),
+        'upcoming reminders': select(Activity.id).where(
+            Activity.date >= datetime(2024, 1, 1).date(), Activity.date <= datetime(2024, 1, 2).date()),
+        'upcoming todo reminders': select(Trip.id).where(
+            Trip.start_date >= datetime(2024, 1, 1).date(), Trip.start_date <= datetime(2024, 1, 2).date()),
+    }
+
+
+def _explain(connection, statement):
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    if _is_postgres(connection):
+        plan = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', params).scalar()
+        nodes = []
+        stack = [plan[0]['Plan']]
+        while stack:
+            node = stack.pop()
+            nodes.append(f"{node['Node Type']} on {node['Relation Name']}" if 'Relation Name' in node else node['Node Type'])
+            stack.extend(node.get('Plans', []))
+        return nodes, [node for node in nodes if node.startswith('Seq Scan')]
+    details = [row[3] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params)]
+    # "SCAN t" reads the whole table, "SCAN t USING INDEX" the whole index;
+    # only SEARCH narrows down to the matching rows.
+    return details, [detail for detail in details if detail.startswith('SCAN ')]
+
+
+def check_plans(engine):
+    results = {}
+    with engine.connect() as connection:
+        with connection.begin():
+            if _is_postgres(connection):
+                # Small tables are scanned no matter what; with sequential
+                # scans disabled the planner still picks one only when no
+                # index can serve the query.
+                connection.execute(text('SET LOCAL enable_seqscan = off'))
+            for name, statement in _plan_queries().items():
+                plan, scans = _explain(connection, statement)
+                results[name] = {'plan': plan, 'scans': scans}
+    return results
+
+
+if __name__ == '__main__':
+    # Usage: python migrations.py [upgrade|status|check]
+    from wsgi import create_app
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    with create_app().app_context():
+        if command == 'upgrade':
+            versions = upgrade(db.engine)
+            print(f"Applied {', '.join(versions)}." if versions else "Database is up to date.")
+        elif command == 'status':
+            with db.engine.begin() as connection:
+                done = applied(connection)
+            for revision in REVISIONS:
+                print(f"[{'x' if revision.version in done else ' '}] {revision.version}  {revision.description}")
+        elif command == 'check':
+            failed = False
+            for name, result in check_plans(db.engine).items():
+                print(f"{'FAIL' if result['scans'] else 'ok  '}  {name}: {'; '.join(result['plan'])}")
+                failed = failed or bool(result['scans'])
+            sys.exit(1 if failed else 0)
+        else:
+            sys.exit(f"unknown command: {command}")
@@ -1,15 +1,28 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy.dialects.postgresql import ARRAY
 from datetime import datetime
+from spatial import geohash_for
+import versions  # noqa: F401  registers the commit hooks that bump trip versions
+import budget
+import search  # registers the commit hooks that keep the search index current
+import changelog
+import gateway
+import gazetteer
 
 db = SQLAlchemy()
 
 class Trip(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    start_date = db.Column(db.Date, nullable=False)
+    start_date = db.Column(db.Date, nullable=False, index=True)
     end_date = db.Column(db.Date, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Row version for optimistic concurrency: every ORM update checks and
+    # bumps it, Core updates bump it by hand.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def to_dict(self):
         return {
@@ -17,7 +30,8 @@ class Trip(db.Model):
             'name': self.name,
             'startDate': self.start_date.isoformat(),
             'endDate': self.end_date.isoformat(),
-            'createdAt': self.created_at.isoformat() if self.created_at else None
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+            'version': self.version
         }
 
 class Activity(db.Model):
@@ -34,6 +48,16 @@ class Activity(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12), index=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    __table_args__ = (
+        db.Index('ix_activity_trip_id_geohash', 'trip_id', 'geohash'),
+        db.Index('ix_activity_trip_id_date_start_time', 'trip_id', 'date', 'start_time'),
+        db.Index('ix_activity_date_start_time', 'date', 'start_time'),
+    )
 
     def to_dict(self):
         return {
@@ -49,16 +73,25 @@ class Activity(db.Model):
             'price': self.price,
             'createdAt': self.created_at.isoformat() if self.created_at else None,
             'latitude': self.latitude,
-            'longitude': self.longitude
+            'longitude': self.longitude,
+            'version': self.version
         }
 
+@event.listens_for(Activity, 'before_insert')
+@event.listens_for(Activity, 'before_update')
+def _sync_geohash(mapper, connection, target):
+    target.geohash = geohash_for(target.latitude, target.longitude)
+
 class Todo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    trip_id = db.Column(db.Integer, db.ForeignKey('trip.id'), nullable=False)
+    trip_id = db.Column(db.Integer, db.ForeignKey('trip.id'), nullable=False, index=True)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     is_completed = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def to_dict(self):
         return {
@@ -67,5 +100,66 @@ class Todo(db.Model):
             'title': self.title,
             'description': self.description,
             'isCompleted': self.is_completed,
-            'createdAt': self.created_at.isoformat() if self.created_at else None
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+            'version': self.version
         }
+
+search.register(Trip, Activity, Todo)
+
+class BudgetRollup(db.Model):
+    __tablename__ = 'budget_rollup'
+    trip_id = db.Column(db.Integer, db.ForeignKey('trip.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.String(50), primary_key=True, default='')
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+budget.register(Activity, BudgetRollup)
+
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    # The id doubles as the sync change token. trip_id has no foreign key so
+    # entries outlive a deleted trip.
+    id = db.Column(db.Integer, primary_key=True)
+    trip_id = db.Column(db.Integer, nullable=False)
+    entity = db.Column(db.String(16), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_change_log_trip_id_id', 'trip_id', 'id'),
+    )
+
+changelog.register(ChangeLog)
+
+class GatewaySnapshot(db.Model):
+    __tablename__ = 'gateway_snapshot'
+    # Last value fetched from an external API (weather, exchange rates), served
+    # when the API is down.
+    key = db.Column(db.String(200), primary_key=True)
+    value = db.Column(db.Text, nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
+gateway.register(GatewaySnapshot)
+
+class ReminderState(db.Model):
+    __tablename__ = 'reminder_state'
+    # How far the reminder scheduler has delivered; it resumes from here.
+    name = db.Column(db.String(32), primary_key=True)
+    watermark = db.Column(db.DateTime, nullable=False)
+
+class GeocodeCache(db.Model):
+    __tablename__ = 'geocode_cache'
+    # Location strings already matched against the gazetteer, keyed by
+    # gazetteer.cache_key(). Editing a row overrides the match for that string.
+    location = db.Column(db.String(200), primary_key=True)
+    name = db.Column(db.String(200))
+    province = db.Column(db.String(100))
+    kind = db.Column(db.String(32))
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    score = db.Column(db.Float)
+    resolved_at = db.Column(db.DateTime, nullable=False)
+
+gazetteer.register(GeocodeCache)
@@ -0,0 +1,105 @@
+import base64
+import json
+from datetime import date, time
+from flask import Response, jsonify, stream_with_context
+from sqlalchemy import and_, or_, false
+from models import Trip, Activity, Todo
+from serialization import dumps, json_response
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_BATCH_SIZE = 1000
+
+_PARSERS = {int: int, date: date.fromisoformat, time: time.fromisoformat, str: str}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Keyset:
+    # An ordered list of columns ending in a unique one (the primary key).
+    # Nullable columns sort NULLS LAST, matching the default Postgres btree order.
+    def __init__(self, *columns):
+        self.columns = columns
+
+    def order_by(self):
+        return [c.asc().nulls_last() if c.nullable else c.asc() for c in self.columns]
+
+    def encode(self, row):
+        values = [getattr(row, c.key) for c in self.columns]
+        values = [v.isoformat() if isinstance(v, (date, time)) else v for v in values]
+        return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+    def decode(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            if len(values) != len(self.columns):
+                raise ValueError('wrong number of cursor values')
+            return [None if v is None else _PARSERS[c.type.python_type](v) for c, v in zip(self.columns, values)]
+        except (ValueError, TypeError, KeyError) as e:
+            raise InvalidCursor(f'invalid cursor: {e}') from e
+
+    def after(self, values):
+        # Row-value comparison (c1, c2, ...) > (v1, v2, ...) spelled out so that
+        # NULLs in nullable columns sort last.
+        *prefix, last = self.columns
+        condition = last > values[-1]
+        for column, value in zip(reversed(prefix), reversed(values[:-1])):
+            if value is None:
+                greater = false()
+                equal = column.is_(None)
+            else:
+                greater = or_(column > value, column.is_(None)) if column.nullable else column > value
+                equal = column == value
+            condition = or_(greater, and_(equal, condition))
+        return condition
+
+    def apply(self, query, cursor=None):
+        if cursor:
+            query = query.filter(self.after(self.decode(cursor)))
+        return query.order_by(*self.order_by())
+
+
+TRIP_KEYSET = Keyset(Trip.id)
+ACTIVITY_KEYSET = Keyset(Activity.trip_id, Activity.date, Activity.start_time, Activity.id)
+TODO_KEYSET = Keyset(Todo.trip_id, Todo.id)
+
+
+def page_limit(args):
+    return max(1, min(args.get('limit', DEFAULT_LIMIT, type=int), MAX_LIMIT))
+
+
+def page(keyset, query, cursor, limit, serialize):
+    rows = keyset.apply(query, cursor).limit(limit + 1).all()
+    next_cursor = keyset.encode(rows[limit - 1]) if len(rows) > limit else None
+    return {'items': [serialize(row) for row in rows[:limit]], 'nextCursor': next_cursor}
+
+
+def ndjson_response(keyset, query, cursor, serialize, limit=None):
+    query = keyset.apply(query, cursor)
+    if limit:
+        query = query.limit(limit)
+    # yield_per streams from a server-side cursor where the driver supports
+    # one, so rows are fetched and written in batches instead of all at once.
+    query = query.yield_per(STREAM_BATCH_SIZE)
+
+    def generate():
+        for row in query:
+            yield dumps(serialize(row)) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def wants_paging(args):
+    return any(name in args for name in ('cursor', 'limit', 'format'))
+
+
+def list_response(keyset, query, args, serialize):
+    cursor = args.get('cursor')
+    try:
+        if args.get('format') == 'ndjson':
+            return ndjson_response(keyset, query, cursor, serialize, limit=args.get('limit', type=int))
+        return json_response(page(keyset, query, cursor, page_limit(args), serialize))
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
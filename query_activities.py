@@ -1,6 +1,7 @@
-from main import app, db, Activity
-from flask_sqlalchemy import SQLAlchemy
+from wsgi import create_app
+from models import db, Activity
 
+app = create_app()
 with app.app_context():
     activities = Activity.query.all()
     print([{'id': a.id, 'trip_id': a.trip_id, 'title': a.title, 'latitude': a.latitude, 'longitude': a.longitude} for a in activities])
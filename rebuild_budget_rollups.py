@@ -0,0 +1,14 @@
+import sys
+from wsgi import create_app
+from models import db, BudgetRollup
+import budget
+
+# Usage: python rebuild_budget_rollups.py [trip_id ...]
+trip_ids = [int(arg) for arg in sys.argv[1:]] or None
+
+app = create_app()
+with app.app_context():
+    BudgetRollup.__table__.create(db.engine, checkfirst=True)
+    budget.rebuild(db.session, trip_ids)
+    db.session.commit()
+    print(f"Budget rollups rebuilt for {'trips ' + ', '.join(map(str, trip_ids)) if trip_ids else 'all trips'}.")
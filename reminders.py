@@ -0,0 +1,336 @@
+# Reminders before activities start and for todos still open before a trip.
+#
+# The scheduler keeps a min-heap of the reminders due within the next
+# HORIZON, loaded one slice at a time by date, so memory and queries scale
+# with what is about to happen rather than with every trip ever planned.
+# Writes from any worker reach it through change_log: every POLL_SECONDS the
+# trips changed since the last token seen are reloaded.
+#
+# Delivery is at least once. After each batch is handed to the sink, the due
+# time it reached is saved in reminder_state, and a restart resumes from
+# there; a crash between the two repeats that batch.
+#
+# Only one process schedules at a time: the one holding an advisory lock on
+# Postgres, or an exclusive lock on a file next to the database on SQLite;
+# the rest stand by.
+import heapq
+import itertools
+import json
+import logging
+import queue
+import threading
+import time as _time
+from datetime import datetime, time, timedelta
+from sqlalchemy import func, select, text
+from models import Trip, Activity, Todo, ChangeLog, ReminderState
+
+try:
+    import fcntl
+except ImportError:  # Windows: one process is assumed
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ADVISORY_LOCK_KEY = 7351864
+STATE_NAME = 'reminders'
+
+LEAD_MINUTES = 60
+# Activities without a start time are taken to start at this hour.
+ALL_DAY_TIME = time(8, 0)
+# Open todos are due this many days before the trip, at TODO_TIME.
+TODO_DAYS = 3
+TODO_TIME = time(9, 0)
+# Trip dates and times are Vietnam wall-clock time (UTC+7, no DST).
+UTC_OFFSET_HOURS = 7
+HORIZON = timedelta(hours=24)
+POLL_SECONDS = 5
+# After a long outage, reminders older than this are dropped, not sent.
+MAX_CATCH_UP = timedelta(days=1)
+RETRY_SECONDS = 30
+
+
+class LogSink:
+    def deliver(self, reminders):
+        for reminder in reminders:
+            logger.info(f"Reminder: {reminder['title']} ({reminder['kind']} {reminder['id']}, due {reminder['dueAt']})")
+
+
+class QueueSink:
+    def __init__(self, maxsize=0):
+        self.queue = queue.Queue(maxsize)
+
+    def deliver(self, reminders):
+        for reminder in reminders:
+            self.queue.put(reminder)
+
+
+class FileSink:
+    # One JSON object per line.
+    def __init__(self, path):
+        self.path = path
+
+    def deliver(self, reminders):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for reminder in reminders:
+                f.write(json.dumps(reminder, ensure_ascii=False) + '\n')
+
+
+def make_sink(value):
+    # REMINDER_SINK: a sink object, 'log', 'file:<path>' or None (log).
+    if value is None or value == 'log':
+        return LogSink()
+    if isinstance(value, str) and value.startswith('file:'):
+        return FileSink(value[len('file:'):])
+    if isinstance(value, str):
+        raise ValueError(f'unknown reminder sink {value!r}')
+    return value
+
+
+class Scheduler:
+    def __init__(self, engine, sink, lead_minutes=LEAD_MINUTES, todo_days=TODO_DAYS,
+                 utc_offset_hours=UTC_OFFSET_HOURS, clock=None):
+        self.engine = engine
+        self.sink = sink
+        self.lead = timedelta(minutes=lead_minutes)
+        # From midnight of the trip's first day to a todo reminder.
+        self.todo_offset = timedelta(hours=TODO_TIME.hour, minutes=TODO_TIME.minute) - timedelta(days=todo_days)
+        self.offset = timedelta(hours=utc_offset_hours)
+        self.clock = clock or datetime.utcnow
+        self.heap = []
+        # key -> (due, seq, trip_id, reminder); heap entries are (due, seq, key) and
+        # stale ones, superseded or cancelled, are skipped when popped.
+        self.current = {}
+        self.by_trip = {}
+        self._seq = itertools.count()
+        self.watermark = None
+        self.loaded_until = None
+        self.token = None
+        self._next_poll = 0.0
+        self._retry_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_connection = None
+        self._lock_file = None
+
+    def now(self):
+        return self.clock() + self.offset
+
+    # Loading
+
+    def _activity_due(self, row):
+        return datetime.combine(row.date, row.start_time or ALL_DAY_TIME) - self.lead
+
+    def _todo_due(self, row):
+        return datetime.combine(row.start_date, time()) + self.todo_offset
+
+    def _query(self, connection, start, end, trip_ids=None):
+        # Reminders due in (start, end], optionally for some trips only.
+        found = []
+        activities = select(Activity.id, Activity.trip_id, Activity.title, Activity.date, Activity.start_time,
+                            Activity.location).where(
+            Activity.date >= (start + self.lead).date(), Activity.date <= (end + self.lead).date())
+        todos = select(Todo.id, Todo.trip_id, Todo.title, Trip.start_date).join(Trip, Trip.id == Todo.trip_id).where(
+            Todo.is_completed.isnot(True),
+            Trip.start_date >= (start - self.todo_offset).date(), Trip.start_date <= (end - self.todo_offset).date())
+        if trip_ids is not None:
+            activities = activities.where(Activity.trip_id.in_(trip_ids))
+            todos = todos.where(Todo.trip_id.in_(trip_ids))
+        for row in connection.execute(activities):
+            due = self._activity_due(row)
+            if start < due <= end:
+                starts = datetime.combine(row.date, row.start_time) if row.start_time else None
+                found.append((due, ('activity', row.id), row.trip_id, {
+                    'kind': 'activity', 'id': row.id, 'tripId': row.trip_id, 'title': row.title,
+                    'location': row.location, 'dueAt': due.isoformat(),
+                    'startsAt': starts.isoformat() if starts else row.date.isoformat()
+                }))
+        for row in connection.execute(todos):
+            due = self._todo_due(row)
+            if start < due <= end:
+                found.append((due, ('todo', row.id), row.trip_id, {
+                    'kind': 'todo', 'id': row.id, 'tripId': row.trip_id, 'title': row.title,
+                    'dueAt': due.isoformat(), 'tripStartsOn': row.start_date.isoformat()
+                }))
+        return found
+
+    def _push(self, due, key, trip_id, reminder):
+        seq = next(self._seq)
+        self.current[key] = (due, seq, trip_id, reminder)
+        self.by_trip.setdefault(trip_id, set()).add(key)
+        heapq.heappush(self.heap, (due, seq, key))
+
+    def _cancel(self, key):
+        entry = self.current.pop(key, None)
+        if entry is not None:
+            keys = self.by_trip.get(entry[2])
+            keys.discard(key)
+            if not keys:
+                del self.by_trip[entry[2]]
+
+    def _load_state(self, connection):
+        state = connection.execute(
+            select(ReminderState.watermark).where(ReminderState.name == STATE_NAME)).scalar()
+        # A first start does not replay the past.
+        now = self.now()
+        self.watermark = max(state, now - MAX_CATCH_UP) if state else now
+        self.loaded_until = self.watermark
+        self.token = connection.execute(select(func.max(ChangeLog.id))).scalar() or 0
+
+    def _save_watermark(self, watermark):
+        table = ReminderState.__table__
+        with self.engine.begin() as connection:
+            updated = connection.execute(table.update().where(table.c.name == STATE_NAME),
+                                         {'watermark': watermark}).rowcount
+            if not updated:
+                connection.execute(table.insert(), {'name': STATE_NAME, 'watermark': watermark})
+
+    def _extend(self, connection, now):
+        # Keep at least half a horizon loaded ahead of now.
+        if self.loaded_until - now > HORIZON / 2:
+            return
+        end = now + HORIZON
+        for found in self._query(connection, self.loaded_until, end):
+            self._push(*found)
+        self.loaded_until = end
+
+    def _poll_changes(self, connection):
+        rows = connection.execute(
+            select(ChangeLog.trip_id, func.max(ChangeLog.id)).where(ChangeLog.id > self.token)
+            .group_by(ChangeLog.trip_id)).all()
+        if not rows:
+            return
+        trip_ids = [trip_id for trip_id, _ in rows]
+        self.token = max(token for _, token in rows)
+        for trip_id in trip_ids:
+            for key in list(self.by_trip.get(trip_id, ())):
+                self._cancel(key)
+        for found in self._query(connection, self.watermark, self.loaded_until, trip_ids):
+            self._push(*found)
+
+    # Running
+
+    def _due(self, now):
+        batch = []
+        while self.heap and self.heap[0][0] <= now:
+            due, seq, key = heapq.heappop(self.heap)
+            entry = self.current.get(key)
+            if entry is None or entry[1] != seq:
+                continue
+            self._cancel(key)
+            batch.append((due, entry))
+        return batch
+
+    def run_pending(self):
+        # One scheduling step; returns the reminders delivered.
+        now = self.now()
+        if self._retry_at is not None and now < self._retry_at:
+            return []
+        with self.engine.connect() as connection:
+            if self.watermark is None:
+                self._load_state(connection)
+            if _time.monotonic() >= self._next_poll:
+                self._poll_changes(connection)
+                self._next_poll = _time.monotonic() + POLL_SECONDS
+            self._extend(connection, now)
+        batch = self._due(now)
+        if not batch:
+            return []
+        reminders = [entry[3] for _, entry in batch]
+        try:
+            self.sink.deliver(reminders)
+        except Exception as e:
+            logger.warning(f"Delivering {len(reminders)} reminders failed, retrying in {RETRY_SECONDS}s: {e}")
+            for due, (_, _, trip_id, reminder) in batch:
+                self._push(due, (reminder['kind'], reminder['id']), trip_id, reminder)
+            self._retry_at = now + timedelta(seconds=RETRY_SECONDS)
+            return []
+        self._retry_at = None
+        self.watermark = max(self.watermark, batch[-1][0])
+        self._save_watermark(self.watermark)
+        return reminders
+
+    def _seconds_to_next(self):
+        wait = self._next_poll - _time.monotonic()
+        if self.heap:
+            wait = min(wait, (self.heap[0][0] - self.now()).total_seconds())
+        return max(0.05, min(wait, POLL_SECONDS))
+
+    def _acquire(self):
+        # True when this process may schedule.
+        if self.engine.dialect.name == 'sqlite':
+            return self._acquire_file()
+        if self.engine.dialect.name != 'postgresql':
+            return True
+        if self._lock_connection is None:
+            connection = self.engine.connect()
+            if not connection.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': ADVISORY_LOCK_KEY}).scalar():
+                connection.close()
+                return False
+            connection.commit()
+            self._lock_connection = connection
+            # The lock holder's view may be behind; start from the database.
+            self.watermark = None
+            self.heap, self.current, self.by_trip = [], {}, {}
+        return True
+
+    def _acquire_file(self):
+        # An in-memory database is private to its process.
+        database = self.engine.url.database
+        if fcntl is None or database in (None, '', ':memory:'):
+            return True
+        if self._lock_file is None:
+            lock_file = open(f'{database}.reminders.lock', 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            self.watermark = None
+            self.heap, self.current, self.by_trip = [], {}, {}
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._acquire():
+                    self.run_pending()
+                    wait = self._seconds_to_next()
+                else:
+                    wait = POLL_SECONDS
+            except Exception as e:
+                logger.warning(f"Reminder scheduler error: {e}")
+                if self._lock_connection is not None:
+                    self._lock_connection.invalidate()
+                    self._lock_connection = None
+                wait = RETRY_SECONDS
+            self._stop.wait(wait)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='reminders', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._lock_connection is not None:
+            self._lock_connection.close()
+            self._lock_connection = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def start(app):
+    from models import db
+    with app.app_context():
+        engine = db.engine
+    scheduler = Scheduler(
+        engine, make_sink(app.config.get('REMINDER_SINK')),
+        lead_minutes=app.config.get('REMINDER_LEAD_MINUTES', LEAD_MINUTES),
+        todo_days=app.config.get('TODO_REMINDER_DAYS', TODO_DAYS)
+    ).start()
+    app.extensions['reminders'] = scheduler
+    return scheduler
@@ -0,0 +1,54 @@
+import functools
+import hashlib
+from flask import current_app, make_response, request, Response
+import changelog
+from cache import LRUCache
+from models import db
+
+DEFAULT_TTL = 30
+DEFAULT_MAXSIZE = 2048
+
+cache = LRUCache(maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL)
+
+
+def _etag(key):
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+    return f'{key[2]}-{digest}'
+
+
+def trip_cached(trip_id_arg='trip_id'):
+    # Cache GET responses under (endpoint, trip_id, change token, query string)
+    # and answer If-None-Match with 304. The token is the trip's latest
+    # change_log id, which means the same in every worker, so an ETag from one
+    # is never answered with 304 by another after a write. It comes from
+    # memory (changelog.latest_token), current within CHANGES_POLL_SECONDS of
+    # another worker's write. The trip id comes from the URL rule or the query
+    # string; views without one use the latest token of any trip.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or request.args.get('format') == 'ndjson':
+                return view(*args, **kwargs)
+            trip_id = kwargs.get(trip_id_arg)
+            if trip_id is None:
+                trip_id = request.args.get(trip_id_arg, type=int)
+            key = (request.endpoint, trip_id, changelog.latest_token(db.session, trip_id), request.query_string)
+            etag = _etag(key)
+            if etag in request.if_none_match:
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            cached = cache.get(key)
+            if cached is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                cached = (response.get_data(), response.mimetype)
+                cache.set(key, cached, ttl=current_app.config.get('RESPONSE_CACHE_TTL', DEFAULT_TTL))
+            response = Response(cached[0], mimetype=cached[1])
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
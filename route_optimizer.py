@@ -0,0 +1,164 @@
+import itertools
+import numpy as np
+from models import db, Activity
+import versions
+from cache import LRUCache
+from spatial import EARTH_RADIUS_KM
+
+matrix_cache = LRUCache(maxsize=512, ttl=3600)
+
+
+def distance_matrix(lats, lngs):
+    # All-pairs haversine distances (km) in one vectorized pass.
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lng = np.radians(np.asarray(lngs, dtype=float))
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def with_depot(matrix):
+    # Append a node at distance 0 from every stop; using it as a path endpoint
+    # turns an open end into a fixed one.
+    n = len(matrix)
+    padded = np.zeros((n + 1, n + 1))
+    padded[:n, :n] = matrix
+    return padded
+
+
+def path_length(matrix, path):
+    path = np.asarray(path)
+    return float(matrix[path[:-1], path[1:]].sum()) if len(path) > 1 else 0.0
+
+
+def nearest_neighbour(matrix, start, end, stops):
+    path = [start]
+    remaining = list(stops)
+    while remaining:
+        row = matrix[path[-1], remaining]
+        path.append(remaining.pop(int(np.argmin(row))))
+    path.append(end)
+    return path
+
+
+def two_opt(matrix, path, fixed_mask):
+    # Reverse path[i..j] while that shortens the path. Endpoints stay put, and a
+    # reversal may contain at most one fixed stop so their order is preserved.
+    path = np.asarray(path)
+    n = len(path)
+    improved = False
+    for i in range(1, n - 2):
+        a = path[i - 1]
+        b = path[i]
+        c = path[i + 1:n - 1]
+        e = path[i + 2:n]
+        delta = matrix[a, c] + matrix[b, e] - matrix[a, b] - matrix[c, e]
+        fixed_inside = np.cumsum(fixed_mask[path[i:n - 1]])[1:]
+        delta[fixed_inside > 1] = np.inf
+        j = int(np.argmin(delta))
+        if delta[j] < -1e-9:
+            path[i:i + j + 2] = path[i:i + j + 2][::-1].copy()
+            improved = True
+    return path.tolist(), improved
+
+
+def relocate(matrix, path, fixed_mask):
+    # Move single unscheduled stops to the cheapest edge anywhere in the path.
+    improved = False
+    for stop in [s for s in path[1:-1] if not fixed_mask[s]]:
+        p = path.index(stop)
+        prev, nxt = path[p - 1], path[p + 1]
+        gain = matrix[prev, stop] + matrix[stop, nxt] - matrix[prev, nxt]
+        rest = np.asarray(path[:p] + path[p + 1:])
+        cost = matrix[rest[:-1], stop] + matrix[stop, rest[1:]] - matrix[rest[:-1], rest[1:]]
+        k = int(np.argmin(cost))
+        if cost[k] < gain - 1e-9:
+            path = path[:p] + path[p + 1:]
+            path.insert(k + 1, stop)
+            improved = True
+    return path, improved
+
+
+def optimize_day(matrix, fixed, max_rounds=50):
+    # fixed: indices of stops with a start_time, in time order. Every other
+    # stop is first assigned to the gap between fixed stops where it is
+    # cheapest to insert and ordered there by nearest neighbour; the whole path
+    # is then improved with 2-opt and single-stop relocation.
+    n = len(matrix)
+    depot = n
+    padded = with_depot(matrix)
+    fixed_mask = np.zeros(n + 1, dtype=int)
+    fixed_mask[list(fixed)] = 1
+    anchors = [depot] + list(fixed) + [depot]
+    free = [i for i in range(n) if not fixed_mask[i]]
+    segments = [[] for _ in range(len(anchors) - 1)]
+    if free:
+        starts = np.array(anchors[:-1])
+        ends = np.array(anchors[1:])
+        free_idx = np.array(free)
+        cost = padded[starts][:, free_idx] + padded[free_idx][:, ends].T - padded[starts, ends][:, None]
+        for stop, segment in zip(free, np.argmin(cost, axis=0)):
+            segments[int(segment)].append(stop)
+    path = [depot]
+    for (start, end), stops in zip(zip(anchors, anchors[1:]), segments):
+        path.extend(nearest_neighbour(padded, start, end, stops)[1:])
+    for _ in range(max_rounds):
+        path, swapped = two_opt(padded, path, fixed_mask)
+        path, moved = relocate(padded, path, fixed_mask)
+        if not (swapped or moved):
+            break
+    return [i for i in path if i != depot]
+
+
+def _day_matrix(trip_id, day, stops, version):
+    key = (trip_id, day, version)
+    cached = matrix_cache.get(key)
+    ids = tuple(stop.id for stop in stops)
+    if cached is None or cached[0] != ids:
+        cached = (ids, distance_matrix([s.latitude for s in stops], [s.longitude for s in stops]))
+        matrix_cache.set(key, cached)
+    return cached[1]
+
+
+def _stop_dict(stop):
+    return {
+        'id': stop.id,
+        'title': stop.title,
+        'startTime': stop.start_time.isoformat() if stop.start_time else None,
+        'latitude': stop.latitude,
+        'longitude': stop.longitude,
+        'fixed': stop.start_time is not None
+    }
+
+
+def suggest_routes(trip_id, day=None):
+    query = db.session.query(
+        Activity.id, Activity.title, Activity.date, Activity.start_time, Activity.latitude, Activity.longitude
+    ).filter(Activity.trip_id == trip_id)
+    if day:
+        query = query.filter(Activity.date == day)
+    rows = query.order_by(Activity.date, Activity.start_time.asc().nulls_last(), Activity.id).all()
+    version = versions.current(trip_id)
+
+    days = []
+    for date, group in itertools.groupby(rows, key=lambda row: row.date):
+        group = list(group)
+        stops = [row for row in group if row.latitude is not None and row.longitude is not None]
+        unlocated = [row.id for row in group if row.latitude is None or row.longitude is None]
+        if not stops:
+            days.append({'date': date.isoformat(), 'order': [], 'stops': [], 'unlocated': unlocated,
+                         'totalKm': 0.0, 'currentKm': 0.0})
+            continue
+        matrix = _day_matrix(trip_id, date, stops, version)
+        fixed = [i for i, stop in enumerate(stops) if stop.start_time is not None]
+        order = optimize_day(matrix, fixed)
+        days.append({
+            'date': date.isoformat(),
+            'order': [stops[i].id for i in order],
+            'stops': [_stop_dict(stops[i]) for i in order],
+            'unlocated': unlocated,
+            'totalKm': round(path_length(matrix, order), 3),
+            'currentKm': round(path_length(matrix, list(range(len(stops)))), 3)
+        })
+    return days
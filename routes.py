@@ -1,40 +1,73 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash
-from datetime import datetime, timedelta
+from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash, current_app
+from datetime import date, datetime, timedelta
 from sqlalchemy import func
-import itertools
+from sqlalchemy.orm.exc import StaleDataError
 import logging
 import csv
 import io
-import requests
 import os
+import csv_import
+import conflicts
+import fragments
+import gazetteer
+from response_cache import trip_cached
+
+CATEGORIES = ['Sightseeing', 'Food', 'Transportation', 'Accommodation', 'Entertainment', 'Shopping', 'Other']
+STALE_MESSAGE = 'Someone else changed this {} while you were editing it. These are the current values; make your changes again.'
+
+
+def _is_stale(row):
+    # Forms carry the version they were rendered from; a form without one
+    # (an older page) still overwrites.
+    version = request.form.get('version', type=int)
+    return version is not None and version != row.version
+
+
+def _coordinates(session, location, latitude, longitude):
+    # The form's coordinates, or the gazetteer's for `location` when none were
+    # picked (no Maps key, or a typed location that was never selected).
+    if (latitude is None or longitude is None) and location:
+        geocoder = gazetteer.get_geocoder(current_app)
+        match = geocoder.resolve(location, session) if geocoder else None
+        if match:
+            return match.latitude, match.longitude
+    return latitude, longitude
 
-bp = Blueprint('routes', __name__)
 
 def init_routes(db, Trip, Activity, Todo):
+    # A new blueprint per call, so every app from wsgi.create_app() gets its own.
+    bp = Blueprint('routes', __name__)
+
     @bp.route('/')
     def index():
         trips = Trip.query.all()
-        return render_template('index.html', trips=trips)
+        return render_template('index.html', trips=trips,
+                               google_maps_api_key=current_app.config.get('GOOGLE_MAPS_API_KEY'))
 
     @bp.route('/map_view/<int:trip_id>')
+    @trip_cached()
     def map_view(trip_id):
         try:
             trip = Trip.query.get_or_404(trip_id)
-            activities = Activity.query.filter_by(trip_id=trip_id).order_by(Activity.date, Activity.start_time).all()
-            
+            rows = db.session.query(
+                Activity.id, Activity.title, Activity.date, Activity.start_time, Activity.end_time,
+                Activity.location, Activity.category, Activity.latitude, Activity.longitude,
+                Activity.price, Activity.description
+            ).filter(Activity.trip_id == trip_id).order_by(Activity.date, Activity.start_time)
+
             activities_data = [{
-                'id': activity.id,
-                'title': activity.title,
-                'date': activity.date.strftime('%Y-%m-%d'),
-                'start_time': activity.start_time.strftime('%H:%M'),
-                'end_time': activity.end_time.strftime('%H:%M'),
-                'location': activity.location,
-                'category': activity.category,
-                'latitude': activity.latitude,
-                'longitude': activity.longitude,
-                'price': float(activity.price) if activity.price else 0,
-                'description': activity.description
-            } for activity in activities]
+                'id': row.id,
+                'title': row.title,
+                'date': row.date.isoformat(),
+                'start_time': row.start_time.strftime('%H:%M') if row.start_time else None,
+                'end_time': row.end_time.strftime('%H:%M') if row.end_time else None,
+                'location': row.location,
+                'category': row.category,
+                'latitude': row.latitude,
+                'longitude': row.longitude,
+                'price': float(row.price) if row.price else 0,
+                'description': row.description
+            } for row in rows]
             
             return render_template('map_view.html', trip=trip, activities=activities_data)
         except Exception as e:
@@ -42,12 +75,24 @@ def init_routes(db, Trip, Activity, Todo):
             flash('An error occurred while loading the map view.', 'error')
             return redirect(url_for('routes.index'))
 
+    @bp.route('/weather/<int:trip_id>')
+    def weather(trip_id):
+        # Forecasts and rates are fetched by the page from /api/trips/<id>/weather
+        # and /api/exchange_rates, so it renders without waiting on upstream APIs.
+        trip = Trip.query.get_or_404(trip_id)
+        return render_template('weather.html', trip=trip)
+
     @bp.route('/trip/<int:trip_id>')
+    @trip_cached()
     def trip_detail(trip_id):
         trip = Trip.query.get_or_404(trip_id)
-        activities = Activity.query.filter_by(trip_id=trip_id).order_by(Activity.date, Activity.start_time).all()
+        # Whole trip by default; ?start= and ?end= narrow it.
+        start, end = fragments.date_range(request.args)
+        dates = fragments.activity_dates(db.session, Activity, trip_id, start, end)
+        days = fragments.day_fragments(db.session, Activity, trip_id, dates, 'fragments/trip_day.html')
         todos = Todo.query.filter_by(trip_id=trip_id).all()
-        return render_template('trip_detail.html', trip=trip, activities=activities, todos=todos)
+        return render_template('trip_detail.html', trip=trip, dates=dates, days=days, todos=todos,
+                               start=start, end=end)
 
     @bp.route('/add_trip', methods=['GET', 'POST'])
     def add_trip():
@@ -74,23 +119,36 @@ def init_routes(db, Trip, Activity, Todo):
         return redirect(url_for('routes.index'))
 
     @bp.route('/weekly_view/<int:trip_id>')
+    @trip_cached()
     def weekly_view(trip_id):
         trip = Trip.query.get_or_404(trip_id)
-        activities = Activity.query.filter_by(trip_id=trip_id).order_by(Activity.date, Activity.start_time).all()
-        
-        grouped_activities = itertools.groupby(activities, key=lambda x: x.date)
-        weekly_activities = {date: list(activities) for date, activities in grouped_activities}
-        
-        return render_template('weekly_view.html', trip=trip, weekly_activities=weekly_activities)
+        # One week from ?start= (the trip's first day by default), or ?start= to ?end=.
+        start = request.args.get('start', trip.start_date, type=date.fromisoformat)
+        start, end = fragments.date_range(request.args, start, max(start, min(start + timedelta(days=6), trip.end_date)))
+        dates = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+        days = fragments.day_fragments(db.session, Activity, trip_id, dates, 'fragments/weekly_day.html')
+        weeks = [dates[n:n + 7] for n in range(0, len(dates), 7)]
+        span = timedelta(days=len(dates))
+        return render_template('weekly_view.html', trip=trip, weeks=weeks, days=days,
+                               previous_start=start - span if start > trip.start_date else None,
+                               next_start=end + timedelta(days=1) if end < trip.end_date else None)
 
     @bp.route('/edit_trip/<int:trip_id>', methods=['GET', 'POST'])
     def edit_trip(trip_id):
         trip = Trip.query.get_or_404(trip_id)
         if request.method == 'POST':
+            if _is_stale(trip):
+                flash(STALE_MESSAGE.format('trip'), 'error')
+                return redirect(request.url)
             trip.name = request.form['name']
             trip.start_date = datetime.strptime(request.form['start_date'], '%Y-%m-%d').date()
             trip.end_date = datetime.strptime(request.form['end_date'], '%Y-%m-%d').date()
-            db.session.commit()
+            try:
+                db.session.commit()
+            except StaleDataError:
+                db.session.rollback()
+                flash(STALE_MESSAGE.format('trip'), 'error')
+                return redirect(request.url)
             flash('Trip updated successfully!', 'success')
             return redirect(url_for('routes.index'))
         return render_template('edit_trip.html', trip=trip)
@@ -106,7 +164,6 @@ def init_routes(db, Trip, Activity, Todo):
     @bp.route('/add_activity/<int:trip_id>', methods=['GET', 'POST'])
     def add_activity(trip_id):
         trip = Trip.query.get_or_404(trip_id)
-        categories = ['Sightseeing', 'Food', 'Transportation', 'Accommodation', 'Entertainment', 'Shopping', 'Other']
         
         if request.method == 'POST':
             title = request.form['title']
@@ -115,11 +172,19 @@ def init_routes(db, Trip, Activity, Todo):
             end_time = datetime.strptime(request.form['end_time'], '%H:%M').time()
             location = request.form['location']
             category = request.form['category']
-            latitude = float(request.form['latitude'])
-            longitude = float(request.form['longitude'])
+            latitude = request.form.get('latitude', type=float)
+            longitude = request.form.get('longitude', type=float)
             price = float(request.form['price'])
             description = request.form['description']
 
+            if not request.form.get('allow_overlap'):
+                clashes = conflicts.check_activity(db.session, Activity, trip_id, date, start_time, end_time,
+                                                   buffer=current_app.config.get('SCHEDULE_BUFFER_MINUTES', 0))
+                if clashes:
+                    flash(f'This time overlaps {conflicts.describe_refs(other.ref for other, _ in clashes)}.', 'error')
+                    return redirect(request.url)
+
+            latitude, longitude = _coordinates(db.session, location, latitude, longitude)
             new_activity = Activity(
                 trip_id=trip_id,
                 title=title,
@@ -138,33 +203,69 @@ def init_routes(db, Trip, Activity, Todo):
             flash('New activity added successfully!', 'success')
             return redirect(url_for('routes.trip_detail', trip_id=trip_id))
         
-        return render_template('add_activity.html', trip=trip, categories=categories)
+        return render_template('add_activity.html', trip=trip, categories=CATEGORIES)
 
     @bp.route('/edit_activity/<int:activity_id>', methods=['GET', 'POST'])
     def edit_activity(activity_id):
         activity = Activity.query.get_or_404(activity_id)
         if request.method == 'POST':
+            if _is_stale(activity):
+                flash(STALE_MESSAGE.format('activity'), 'error')
+                return redirect(request.url)
+            if not request.form.get('allow_overlap'):
+                with db.session.no_autoflush:
+                    clashes = conflicts.check_activity(
+                        db.session, Activity, activity.trip_id,
+                        datetime.strptime(request.form['date'], '%Y-%m-%d').date(),
+                        datetime.strptime(request.form['start_time'], '%H:%M').time(),
+                        datetime.strptime(request.form['end_time'], '%H:%M').time(),
+                        exclude_id=activity.id,
+                        buffer=current_app.config.get('SCHEDULE_BUFFER_MINUTES', 0))
+                if clashes:
+                    flash(f'This time overlaps {conflicts.describe_refs(other.ref for other, _ in clashes)}.', 'error')
+                    return redirect(request.url)
+            location = request.form['location']
+            latitude = request.form.get('latitude', type=float)
+            longitude = request.form.get('longitude', type=float)
+            if location != activity.location and (latitude, longitude) == (activity.latitude, activity.longitude):
+                # A new location typed over the old one still carries the old
+                # coordinates.
+                latitude = longitude = None
+            latitude, longitude = _coordinates(db.session, location, latitude, longitude)
             activity.title = request.form['title']
             activity.date = datetime.strptime(request.form['date'], '%Y-%m-%d').date()
             activity.start_time = datetime.strptime(request.form['start_time'], '%H:%M').time()
             activity.end_time = datetime.strptime(request.form['end_time'], '%H:%M').time()
-            activity.location = request.form['location']
+            activity.location = location
             activity.category = request.form['category']
-            activity.latitude = float(request.form['latitude'])
-            activity.longitude = float(request.form['longitude'])
+            activity.latitude = latitude
+            activity.longitude = longitude
             activity.price = float(request.form['price'])
             activity.description = request.form['description']
-            db.session.commit()
+            try:
+                db.session.commit()
+            except StaleDataError:
+                db.session.rollback()
+                flash(STALE_MESSAGE.format('activity'), 'error')
+                return redirect(request.url)
             flash('Activity updated successfully!', 'success')
             return redirect(url_for('routes.trip_detail', trip_id=activity.trip_id))
-        return render_template('edit_activity.html', activity=activity)
+        return render_template('edit_activity.html', activity=activity, categories=CATEGORIES)
 
     @bp.route('/delete_activity/<int:activity_id>', methods=['POST'])
     def delete_activity(activity_id):
         activity = Activity.query.get_or_404(activity_id)
         trip_id = activity.trip_id
+        if _is_stale(activity):
+            flash('Someone else changed this activity since the page was loaded; it was not deleted.', 'error')
+            return redirect(url_for('routes.trip_detail', trip_id=trip_id))
         db.session.delete(activity)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            flash('Someone else changed this activity since the page was loaded; it was not deleted.', 'error')
+            return redirect(url_for('routes.trip_detail', trip_id=trip_id))
         flash('Activity deleted successfully!', 'success')
         return redirect(url_for('routes.trip_detail', trip_id=trip_id))
 
@@ -180,33 +281,36 @@ def init_routes(db, Trip, Activity, Todo):
                 flash('No selected file', 'error')
                 return redirect(request.url)
             if file and file.filename.endswith('.csv'):
+                mode = request.values.get('mode', 'orm')
+                want_json = request.args.get('format') == 'json'
+                check_conflicts = not request.values.get('allow_overlap')
+                buffer = current_app.config.get('SCHEDULE_BUFFER_MINUTES', 0)
                 try:
-                    stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-                    csv_input = csv.reader(stream)
-                    next(csv_input)  # Skip header row
-                    for row in csv_input:
-                        title, date, start_time, end_time, location, category, latitude, longitude, price, description = row
-                        new_activity = Activity(
-                            trip_id=trip_id,
-                            title=title,
-                            date=datetime.strptime(date, '%Y-%m-%d').date(),
-                            start_time=datetime.strptime(start_time, '%H:%M').time(),
-                            end_time=datetime.strptime(end_time, '%H:%M').time(),
-                            location=location,
-                            category=category,
-                            latitude=float(latitude),
-                            longitude=float(longitude),
-                            price=float(price),
-                            description=description
-                        )
-                        db.session.add(new_activity)
-                    db.session.commit()
-                    flash('Activities imported successfully!', 'success')
-                    return redirect(url_for('routes.trip_detail', trip_id=trip_id))
+                    if mode == 'stream':
+                        batch_size = request.values.get('batch_size', type=int) or \
+                            current_app.config.get('IMPORT_BATCH_SIZE', csv_import.DEFAULT_BATCH_SIZE)
+                        report = csv_import.stream_import(db, Activity, trip_id, file.stream, batch_size=max(1, batch_size),
+                                                          check_conflicts=check_conflicts, buffer=buffer,
+                                                          geocoder=gazetteer.get_geocoder(current_app))
+                    else:
+                        report = csv_import.orm_import(db, Activity, trip_id, file.stream,
+                                                       check_conflicts=check_conflicts, buffer=buffer,
+                                                       geocoder=gazetteer.get_geocoder(current_app))
                 except Exception as e:
-                    db.session.rollback()
+                    logging.error(f"Error importing activities for trip {trip_id}: {str(e)}", exc_info=True)
+                    if want_json:
+                        return jsonify({'error': str(e)}), 400
                     flash(f'Error importing activities: {str(e)}', 'error')
                     return redirect(request.url)
+                logging.info(f"Imported activities for trip {trip_id}: {report.to_dict(max_errors=0)}")
+                if want_json:
+                    return jsonify(report.to_dict())
+                if report.rows_failed:
+                    lines = ', '.join(str(e['line']) for e in report.errors[:10])
+                    flash(f'Imported {report.rows_imported} activities; {report.rows_failed} rows failed (lines {lines}).', 'warning')
+                else:
+                    flash('Activities imported successfully!', 'success')
+                return redirect(url_for('routes.trip_detail', trip_id=trip_id))
             else:
                 flash('Please upload a CSV file', 'error')
                 return redirect(request.url)
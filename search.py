@@ -0,0 +1,338 @@
+import bisect
+import heapq
+import math
+import re
+import threading
+import unicodedata
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+import changelog
+
+# Fields indexed per document type, with their ranking weights.
+FIELD_WEIGHTS = {
+    'trip': {'name': 3.0},
+    'activity': {'title': 3.0, 'location': 2.0, 'category': 1.5, 'description': 1.0},
+    'todo': {'title': 3.0, 'description': 1.0}
+}
+TYPE_CODES = {'trip': 0, 'activity': 1, 'todo': 2}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+MAX_PREFIX_EXPANSIONS = 64
+MAX_PREFIX_SCAN = 4096
+MATERIALIZE_LIMIT = 2048
+LOAD_BATCH_SIZE = 5000
+PENDING_KEY = 'pending_search_docs'
+
+_TOKEN_RE = re.compile(r'\w+')
+_MARKS_RE = re.compile('[\u0300-\u036f]')
+_FOLD_TABLE = str.maketrans({'đ': 'd', 'Đ': 'D'})
+
+
+def fold(text):
+    # "Hội An" -> "hoi an": decompose, drop combining marks, map đ to d.
+    return _MARKS_RE.sub('', unicodedata.normalize('NFD', text.translate(_FOLD_TABLE))).lower()
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(fold(text)) if text else []
+
+
+def doc_key(kind, id):
+    return id * 4 + TYPE_CODES[kind]
+
+
+class SearchIndex:
+    # Postings are grouped by weight: token -> {weight: set of doc keys}. A
+    # doc's score for a token is then constant within a bucket, which lets
+    # search() combine terms with C-level set operations and walk buckets from
+    # the highest score down, stopping once no remaining bucket can beat the
+    # current top k.
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.loading = False
+        self.postings = {}     # token -> {weight: {doc key, ...}}
+        self.vocabulary = []   # sorted tokens, for prefix lookups
+        self.docs = {}         # doc key -> (trip id, title, ((token, weight), ...))
+        self.by_trip = {}      # trip id -> {doc key, ...}
+        self.by_type = {code: set() for code in TYPE_NAMES}
+
+    def _add(self, key, trip_id, title, fields, weights, new_tokens):
+        tokens = {}
+        for name, weight in weights.items():
+            for token in tokenize(fields.get(name)):
+                tokens[token] = tokens.get(token, 0.0) + weight
+        for token, weight in tokens.items():
+            buckets = self.postings.get(token)
+            if buckets is None:
+                buckets = self.postings[token] = {}
+                new_tokens.append(token)
+            bucket = buckets.get(weight)
+            if bucket is None:
+                bucket = buckets[weight] = set()
+            bucket.add(key)
+        self.docs[key] = (trip_id, title, tuple(tokens.items()))
+        self.by_trip.setdefault(trip_id, set()).add(key)
+        self.by_type[key % 4].add(key)
+
+    def _remove(self, key):
+        doc = self.docs.pop(key, None)
+        if doc is None:
+            return
+        for token, weight in doc[2]:
+            buckets = self.postings.get(token)
+            if buckets is None:
+                continue
+            bucket = buckets.get(weight)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del buckets[weight]
+            if not buckets:
+                del self.postings[token]
+        trip_docs = self.by_trip.get(doc[0])
+        if trip_docs is not None:
+            trip_docs.discard(key)
+            if not trip_docs:
+                del self.by_trip[doc[0]]
+        self.by_type[key % 4].discard(key)
+
+    def upsert(self, kind, id, trip_id, title, fields):
+        key = doc_key(kind, id)
+        with self._lock:
+            self._remove(key)
+            new_tokens = []
+            self._add(key, trip_id, title, fields, FIELD_WEIGHTS[kind], new_tokens)
+            for token in new_tokens:
+                i = bisect.bisect_left(self.vocabulary, token)
+                if i == len(self.vocabulary) or self.vocabulary[i] != token:
+                    self.vocabulary.insert(i, token)
+
+    def remove(self, kind, id):
+        with self._lock:
+            self._remove(doc_key(kind, id))
+
+    def load(self, sources):
+        # sources: (kind, iterable of (id, trip_id, title, {field: text})).
+        with self._lock:
+            self.postings = {}
+            self.docs = {}
+            self.by_trip = {}
+            self.by_type = {code: set() for code in TYPE_NAMES}
+            new_tokens = []
+            for kind, rows in sources:
+                weights = FIELD_WEIGHTS[kind]
+                for id, trip_id, title, fields in rows:
+                    self._add(doc_key(kind, id), trip_id, title, fields, weights, new_tokens)
+            self.vocabulary = sorted(self.postings)
+            self.loaded = True
+
+    def _expand(self, prefix):
+        vocabulary = self.vocabulary
+        lo = bisect.bisect_left(vocabulary, prefix)
+        hi = bisect.bisect_left(vocabulary, prefix + '\U0010ffff', lo)
+        # Prefer the closest completions ("ha" -> "ha", "hai", "han", ...),
+        # looking at a bounded window so short prefixes stay cheap.
+        window = vocabulary[lo:min(hi, lo + MAX_PREFIX_SCAN)]
+        if len(window) > MAX_PREFIX_EXPANSIONS:
+            window = heapq.nsmallest(MAX_PREFIX_EXPANSIONS, window, key=len)
+        # Tokens whose last document was removed stay in the vocabulary.
+        return [token for token in window if token in self.postings]
+
+    def _term(self, tokens):
+        # One query term as (score, token, doc set) buckets, best first.
+        total = len(self.docs) or 1
+        buckets = []
+        for token in tokens:
+            token_buckets = self.postings[token]
+            idf = math.log(1 + total / sum(len(bucket) for bucket in token_buckets.values()))
+            buckets.extend((weight * idf, token, bucket) for weight, bucket in token_buckets.items())
+        buckets.sort(key=lambda bucket: bucket[0], reverse=True)
+        return buckets
+
+    def search(self, query, limit=20, trip_id=None, kinds=None, prefix=True):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            # Exact terms must match; the last one completes as a prefix for
+            # autocomplete.
+            per_term = []
+            for n, term in enumerate(terms):
+                tokens = self._expand(term) if prefix and n == len(terms) - 1 else \
+                    ([term] if term in self.postings else [])
+                if not tokens:
+                    return []
+                per_term.append(self._term(tokens))
+            filters = []
+            if trip_id is not None:
+                filters.append(self.by_trip.get(trip_id, set()))
+            if kinds:
+                filters.append(set().union(*(self.by_type[TYPE_CODES[kind]] for kind in kinds)))
+            return self._top(per_term, filters, limit)
+
+    def _top(self, terms, filters, limit):
+        # Branch and bound over one bucket per term, best score first. A path
+        # is kept as a list of sets to intersect and only materialized while
+        # that is cheap; at the leaves every doc has the same score, so big
+        # intersections are scanned lazily and stop once the top k is full.
+        terms.sort(key=lambda buckets: buckets[0][0], reverse=True)
+        rest_max = [0.0] * (len(terms) + 1)
+        for i in range(len(terms) - 1, -1, -1):
+            rest_max[i] = rest_max[i + 1] + terms[i][0][0]
+        best = []
+
+        def offer(docs, exclude, score):
+            docs = sorted(docs, key=len)
+            smallest, others = docs[0], docs[1:]
+            for key in smallest:
+                if len(best) >= limit and score <= best[0][0]:
+                    return
+                if all(key in other for other in others) and not any(key in other for other in exclude):
+                    if len(best) < limit:
+                        heapq.heappush(best, (score, -key))
+                    else:
+                        heapq.heapreplace(best, (score, -key))
+
+        def collect(i, docs, exclude, partial):
+            if docs and len(docs) > 1 and min(len(d) for d in docs) <= MATERIALIZE_LIMIT:
+                docs = [set.intersection(*docs)]
+            if docs and not docs[0]:
+                return
+            if i == len(terms):
+                offer(docs, exclude, partial)
+                return
+            buckets = terms[i]
+            for n, (score, token, bucket) in enumerate(buckets):
+                if len(best) >= limit and partial + score + rest_max[i + 1] <= best[0][0]:
+                    return
+                # A doc matching several completions of a prefix counts once,
+                # at its best one; a token's own buckets never overlap.
+                higher = [other for _, other_token, other in buckets[:n] if other_token != token]
+                collect(i + 1, docs + [bucket], exclude + higher, partial + score)
+
+        collect(0, list(filters), [], 0.0)
+        best.sort(reverse=True)
+        return [{
+            'type': TYPE_NAMES[-key % 4],
+            'id': -key // 4,
+            'tripId': self.docs[-key][0],
+            'title': self.docs[-key][1],
+            'score': round(score, 4)
+        } for score, key in best]
+
+
+index = SearchIndex()
+_load_lock = threading.Lock()
+_models = {}
+
+
+def register(Trip, Activity, Todo):
+    _models.update(trip=Trip, activity=Activity, todo=Todo)
+
+
+def _document(obj):
+    kind = type(obj).__name__.lower()
+    if kind not in FIELD_WEIGHTS:
+        return None
+    fields = {name: getattr(obj, name) for name in FIELD_WEIGHTS[kind]}
+    if kind == 'trip':
+        return kind, obj.id, obj.id, obj.name, fields
+    return kind, obj.id, obj.trip_id, obj.title, fields
+
+
+def ensure_loaded(session, Trip, Activity, Todo):
+    if index.loaded:
+        return
+    with _load_lock:
+        if index.loaded:
+            return
+        # Commits that land while loading are applied after the load (they wait
+        # on the index lock) instead of being dropped.
+        index.loading = True
+
+        def rows(*columns):
+            names = [c.key for c in columns[3:]]
+            for row in session.query(*columns).yield_per(LOAD_BATCH_SIZE):
+                yield row[0], row[1], row[2], dict(zip(names, row[3:]))
+
+        try:
+            index.load([
+                ('trip', rows(Trip.id, Trip.id, Trip.name, Trip.name)),
+                ('activity', rows(Activity.id, Activity.trip_id, Activity.title, Activity.title,
+                                  Activity.location, Activity.category, Activity.description)),
+                ('todo', rows(Todo.id, Todo.trip_id, Todo.title, Todo.title, Todo.description))
+            ])
+        finally:
+            index.loading = False
+
+
+def stage_rows(session, kind, rows, ids):
+    # For Core inserts that bypass the unit of work; applied on commit.
+    pending = session.info.setdefault(PENDING_KEY, [])
+    weights = FIELD_WEIGHTS[kind]
+    for id, row in zip(ids, rows):
+        title = row['name'] if kind == 'trip' else row['title']
+        trip_id = id if kind == 'trip' else row['trip_id']
+        pending.append(('upsert', (kind, id, trip_id, title, {name: row.get(name) for name in weights})))
+
+
+def stage_removed(session, kind, ids):
+    # For Core deletes; applied on commit.
+    session.info.setdefault(PENDING_KEY, []).extend(('remove', (kind, id)) for id in ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, flush_context):
+    pending = session.info.setdefault(PENDING_KEY, [])
+    for obj in list(session.new) + list(session.dirty):
+        if obj not in session.deleted:
+            doc = _document(obj)
+            if doc is not None:
+                pending.append(('upsert', doc))
+    for obj in session.deleted:
+        kind = type(obj).__name__.lower()
+        if kind in FIELD_WEIGHTS:
+            pending.append(('remove', (kind, obj.id)))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if not pending or not (index.loaded or index.loading):
+        return
+    for op, args in pending:
+        if op == 'upsert':
+            index.upsert(*args)
+        else:
+            index.remove(*args)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+
+
+def _remote(connection, entries):
+    # Commits from other processes, via changelog.follow(): re-read the rows
+    # they touched; a row that is gone was deleted.
+    if not (index.loaded or index.loading) or not _models:
+        return
+    changed = {}
+    for entry in entries:
+        if entry.entity in FIELD_WEIGHTS:
+            changed.setdefault(entry.entity, set()).add(entry.entity_id)
+    for kind, ids in changed.items():
+        table = _models[kind].__table__
+        names = list(FIELD_WEIGHTS[kind])
+        trip_id = table.c.id if kind == 'trip' else table.c.trip_id
+        title = table.c.name if kind == 'trip' else table.c.title
+        rows = connection.execute(select(table.c.id, trip_id, title, *(table.c[name] for name in names))
+                                  .where(table.c.id.in_(ids))).all()
+        for row in rows:
+            index.upsert(kind, row[0], row[1], row[2], dict(zip(names, row[3:])))
+        for id in ids - {row[0] for row in rows}:
+            index.remove(kind, id)
+
+
+changelog.on_change(_remote)
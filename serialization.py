@@ -0,0 +1,112 @@
+import gzip
+import json
+from time import perf_counter
+from datetime import date, datetime, time
+from flask import Response, request
+from models import db, Trip, Activity, Todo
+import instrumentation
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+# Public field name -> column, in the same shape as the models' to_dict().
+TRIP_FIELDS = {
+    'id': Trip.id,
+    'name': Trip.name,
+    'startDate': Trip.start_date,
+    'endDate': Trip.end_date,
+    'createdAt': Trip.created_at,
+    'version': Trip.version
+}
+
+ACTIVITY_FIELDS = {
+    'id': Activity.id,
+    'tripId': Activity.trip_id,
+    'date': Activity.date,
+    'startTime': Activity.start_time,
+    'endTime': Activity.end_time,
+    'title': Activity.title,
+    'location': Activity.location,
+    'description': Activity.description,
+    'category': Activity.category,
+    'price': Activity.price,
+    'createdAt': Activity.created_at,
+    'latitude': Activity.latitude,
+    'longitude': Activity.longitude,
+    'version': Activity.version
+}
+
+TODO_FIELDS = {
+    'id': Todo.id,
+    'tripId': Todo.trip_id,
+    'title': Todo.title,
+    'description': Todo.description,
+    'isCompleted': Todo.is_completed,
+    'createdAt': Todo.created_at,
+    'version': Todo.version
+}
+
+
+def _default(value):
+    if isinstance(value, (date, datetime, time)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    # orjson writes date/time/datetime natively in isoformat() form.
+    def _dumps(value):
+        return orjson.dumps(value)
+else:
+    def _dumps(value):
+        return json.dumps(value, default=_default, separators=(',', ':')).encode()
+
+
+def dumps(value):
+    started = perf_counter()
+    try:
+        return _dumps(value)
+    finally:
+        instrumentation.add_serialize_time(perf_counter() - started)
+
+
+GZIP_MIN_SIZE = 1024
+
+
+def json_response(value, status=200, headers=None, compress=False):
+    body = dumps(value)
+    if compress:
+        headers = dict(headers or {}, Vary='Accept-Encoding')
+        if len(body) >= GZIP_MIN_SIZE and 'gzip' in request.accept_encodings:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+    return Response(body, status=status, headers=headers, mimetype='application/json')
+
+
+class Projection:
+    def __init__(self, available, fields=None):
+        if fields:
+            names = [name.strip() for name in fields.split(',') if name.strip()]
+            unknown = [name for name in names if name not in available]
+            if unknown:
+                raise ValueError(f"unknown fields: {', '.join(unknown)}")
+        else:
+            names = list(available)
+        self.keys = names
+        self.columns = [available[name] for name in names]
+
+    def query(self, *extra_columns):
+        # Extra columns (e.g. a pagination keyset) are appended after the
+        # requested ones; serialize() only reads the first len(keys) values.
+        present = {column.key for column in self.columns}
+        extras = [column for column in extra_columns if column.key not in present]
+        return db.session.query(*self.columns, *extras)
+
+    def serialize(self, row):
+        return dict(zip(self.keys, row))
+
+    def serialize_all(self, rows):
+        keys = self.keys
+        return [dict(zip(keys, row)) for row in rows]
@@ -0,0 +1,104 @@
+from sqlalchemy import func
+from models import db, Trip, Activity, Todo, ChangeLog
+from serialization import TRIP_FIELDS, ACTIVITY_FIELDS, TODO_FIELDS, Projection
+
+SYNC_LIMIT = 5000
+FETCH_CHUNK = 500
+
+# entity -> (model, public fields, response key)
+ENTITIES = {
+    'trip': (Trip, TRIP_FIELDS, 'trips'),
+    'activity': (Activity, ACTIVITY_FIELDS, 'activities'),
+    'todo': (Todo, TODO_FIELDS, 'todos')
+}
+
+
+class TokenAhead(ValueError):
+    pass
+
+
+def latest_token(trip_id=None):
+    query = db.session.query(func.max(ChangeLog.id))
+    if trip_id is not None:
+        query = query.filter(ChangeLog.trip_id == trip_id)
+    return query.scalar() or 0
+
+
+def _table(fields, rows):
+    # Column-oriented: field names once, then one array per row.
+    return {'fields': fields.keys, 'rows': [list(row[:len(fields.keys)]) for row in rows]}
+
+
+def _without(available, *names):
+    return {key: column for key, column in available.items() if key not in names}
+
+
+def snapshot(trip_id):
+    # The token is read before the rows: a change landing in between shows up
+    # in both the snapshot and the next sync, which is harmless, instead of in
+    # neither.
+    token = latest_token()
+    trips = Projection(TRIP_FIELDS)
+    trip = trips.query().filter(Trip.id == trip_id).first()
+    if trip is None:
+        return None
+    activities = Projection(_without(ACTIVITY_FIELDS, 'tripId'))
+    todos = Projection(_without(TODO_FIELDS, 'tripId'))
+    return {
+        'token': token,
+        'trip': trips.serialize(trip),
+        'activities': _table(activities, activities.query().filter(Activity.trip_id == trip_id)
+                             .order_by(Activity.date, Activity.start_time.asc().nulls_last(), Activity.id)),
+        'todos': _table(todos, todos.query().filter(Todo.trip_id == trip_id).order_by(Todo.id))
+    }
+
+
+def _fetch(entity, ids, trip_ids):
+    model, fields, _ = ENTITIES[entity]
+    projection = Projection(fields)
+    ids = sorted(ids)
+    rows = []
+    for start in range(0, len(ids), FETCH_CHUNK):
+        query = projection.query().filter(model.id.in_(ids[start:start + FETCH_CHUNK]))
+        if trip_ids:
+            query = query.filter((model.id if model is Trip else model.trip_id).in_(trip_ids))
+        rows.extend(query)
+    return projection, rows
+
+
+def changes_since(since, trip_ids=None, limit=SYNC_LIMIT):
+    # Rows changed after token `since`, each reduced to its latest state: an
+    # upsert carries the current row, a delete only the id. At most `limit` log
+    # entries are read per call; `more` tells the client to call again with the
+    # returned token.
+    end = latest_token()
+    if since > end:
+        raise TokenAhead(f'token {since} is newer than the latest change {end}')
+    query = db.session.query(ChangeLog.id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.deleted) \
+        .filter(ChangeLog.id > since, ChangeLog.id <= end)
+    if trip_ids:
+        query = query.filter(ChangeLog.trip_id.in_(trip_ids))
+    entries = query.order_by(ChangeLog.id).limit(limit + 1).all()
+    more = len(entries) > limit
+    entries = entries[:limit]
+
+    latest = {}
+    for _, entity, entity_id, deleted in entries:
+        latest[(entity, entity_id)] = deleted
+
+    result = {'token': entries[-1].id if more else end, 'more': more}
+    deleted = {}
+    for entity, (_, _, key) in ENTITIES.items():
+        upserted = {entity_id for (kind, entity_id), gone in latest.items() if kind == entity and not gone}
+        removed = {entity_id for (kind, entity_id), gone in latest.items() if kind == entity and gone}
+        if upserted:
+            projection, rows = _fetch(entity, upserted, trip_ids)
+            if rows:
+                result[key] = _table(projection, rows)
+            # Deleted (or moved out of the requested trips) after the entry.
+            removed |= upserted - {row.id for row in rows}
+        if removed:
+            deleted[key] = sorted(removed)
+    if deleted:
+        result['deleted'] = deleted
+    return result
@@ -0,0 +1,257 @@
+import math
+from sqlalchemy import and_, case, or_
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DECODE = {c: i for i, c in enumerate(BASE32)}
+
+GEOHASH_PRECISION = 9  # ~4.8m x 4.8m cells
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+MAX_BBOX_CELLS = 32
+MAX_BBOX_RESULTS = 1000
+# nearest() fetches this many more rows than k per query, so candidates the
+# database orders slightly out of place still get ranked.
+NEAREST_SLACK = 4
+
+
+def encode(lat, lng, precision=GEOHASH_PRECISION):
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    ch = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                ch = (ch << 1) | 1
+                lng_lo = mid
+            else:
+                ch <<= 1
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                ch = (ch << 1) | 1
+                lat_lo = mid
+            else:
+                ch <<= 1
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[ch])
+            bits = 0
+            ch = 0
+    return ''.join(chars)
+
+
+def decode_bounds(geohash):
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    even = True
+    for c in geohash:
+        value = DECODE[c]
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            if even:
+                mid = (lng_lo + lng_hi) / 2
+                if bit:
+                    lng_lo = mid
+                else:
+                    lng_hi = mid
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                if bit:
+                    lat_lo = mid
+                else:
+                    lat_hi = mid
+            even = not even
+    return lat_lo, lng_lo, lat_hi, lng_hi
+
+
+def cell_size(precision):
+    # (lat degrees, lng degrees) of a cell at the given precision.
+    bits = precision * 5
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def geohash_for(latitude, longitude):
+    if latitude is None or longitude is None:
+        return None
+    return encode(latitude, longitude)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def prefix_upper(prefix):
+    # Smallest geohash string greater than every string starting with prefix,
+    # or None when the prefix is all 'z'.
+    prefix = prefix.rstrip('z')
+    if not prefix:
+        return None
+    return prefix[:-1] + BASE32[DECODE[prefix[-1]] + 1]
+
+
+def cells_in_bbox(south, west, north, east, precision):
+    dlat, dlng = cell_size(precision)
+    cells = set()
+    lat = south
+    while True:
+        lng = west
+        while True:
+            cells.add(encode(min(lat, 90.0), min(lng, 180.0 - 1e-9), precision))
+            if lng >= east:
+                break
+            lng = min(lng + dlng, east)
+        if lat >= north:
+            break
+        lat = min(lat + dlat, north)
+    return cells
+
+
+def estimate_cells(south, west, north, east, precision):
+    # Upper bound on len(cells_in_bbox(...)) without enumerating the cells.
+    dlat, dlng = cell_size(precision)
+    return (math.floor((north - south) / dlat) + 2) * (math.floor((east - west) / dlng) + 2)
+
+
+def covering_prefixes(south, west, north, east, max_cells=MAX_BBOX_CELLS):
+    precision = 1
+    for p in range(GEOHASH_PRECISION, 0, -1):
+        if estimate_cells(south, west, north, east, p) <= max_cells:
+            precision = p
+            break
+    return sorted(cells_in_bbox(south, west, north, east, precision))
+
+
+def prefix_ranges(prefixes):
+    # Merge sorted prefixes into [lo, hi) ranges so adjacent cells share one
+    # index range scan.
+    ranges = []
+    for prefix in prefixes:
+        hi = prefix_upper(prefix)
+        if ranges and ranges[-1][1] == prefix:
+            ranges[-1][1] = hi
+        else:
+            ranges.append([prefix, hi])
+    return ranges
+
+
+def range_filter(column, prefixes):
+    clauses = []
+    for lo, hi in prefix_ranges(prefixes):
+        clauses.append(column >= lo if hi is None else and_(column >= lo, column < hi))
+    return or_(*clauses)
+
+
+def _split_bbox(south, west, north, east):
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def bbox_query(Activity, south, west, north, east, trip_id=None, limit=MAX_BBOX_RESULTS):
+    boxes = _split_bbox(south, west, north, east)
+    prefixes = []
+    exact = []
+    for box in boxes:
+        prefixes.extend(covering_prefixes(*box))
+        exact.append(and_(Activity.longitude >= box[1], Activity.longitude <= box[3]))
+    query = Activity.query.filter(
+        range_filter(Activity.geohash, sorted(set(prefixes))),
+        Activity.latitude >= south,
+        Activity.latitude <= north,
+        or_(*exact)
+    )
+    if trip_id:
+        query = query.filter(Activity.trip_id == trip_id)
+    return query.order_by(Activity.id).limit(limit)
+
+
+def neighbors(geohash):
+    lat_lo, lng_lo, lat_hi, lng_hi = decode_bounds(geohash)
+    dlat = lat_hi - lat_lo
+    dlng = lng_hi - lng_lo
+    lat = (lat_lo + lat_hi) / 2
+    lng = (lng_lo + lng_hi) / 2
+    cells = set()
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            nlat = lat + i * dlat
+            if nlat > 90 or nlat < -90:
+                continue
+            nlng = (lng + j * dlng + 180.0) % 360.0 - 180.0
+            cells.add(encode(nlat, nlng, len(geohash)))
+    return cells
+
+
+def _covered_radius_km(lat, precision):
+    # A point's cell plus its 8 neighbours always contains the disc of this
+    # radius around the point.
+    dlat, dlng = cell_size(precision)
+    worst_lat = min(90.0, abs(lat) + 2 * dlat)
+    return min(dlat * KM_PER_DEGREE, dlng * KM_PER_DEGREE * math.cos(math.radians(worst_lat)))
+
+
+def _sin(x):
+    # Taylor series to x^9, within 4e-6 of sin() on [-pi/2, pi/2]. SQLite has
+    # no trigonometric functions unless built with them.
+    x2 = x * x
+    return x * (1 + x2 * (-1 / 6 + x2 * (1 / 120 + x2 * (-1 / 5040 + x2 / 362880))))
+
+
+def _cos(x):
+    # Taylor series to x^10, within 5e-7 of cos() on [-pi/2, pi/2].
+    x2 = x * x
+    return 1 + x2 * (-1 / 2 + x2 * (1 / 24 + x2 * (-1 / 720 + x2 * (1 / 40320 - x2 / 3628800))))
+
+
+def _distance_order(Activity, lat, lng):
+    # Haversine's a term as SQL arithmetic: grows with great-circle distance,
+    # so ORDER BY ... LIMIT returns the closest rows anywhere on the globe.
+    dlng = Activity.longitude - lng
+    dlng = case((dlng > 180, dlng - 360), (dlng < -180, dlng + 360), else_=dlng)
+    half_dlat = _sin((Activity.latitude - lat) * (math.pi / 360))
+    half_dlng = _sin(dlng * (math.pi / 360))
+    return half_dlat * half_dlat + math.cos(math.radians(lat)) * _cos(Activity.latitude * (math.pi / 180)) \
+        * half_dlng * half_dlng
+
+
+def nearest(Activity, lat, lng, k=10, trip_id=None, max_km=None, start_precision=6):
+    base = Activity.query.filter(Activity.geohash.isnot(None))
+    if trip_id:
+        base = base.filter(Activity.trip_id == trip_id)
+    # Every query returns at most `limit` rows, closest first.
+    limit = k + NEAREST_SLACK
+    order = _distance_order(Activity, lat, lng)
+
+    def ranked(candidates):
+        scored = [(haversine_km(lat, lng, a.latitude, a.longitude), a) for a in candidates]
+        scored.sort(key=lambda pair: pair[0])
+        if max_km is not None:
+            scored = [pair for pair in scored if pair[0] <= max_km]
+        return scored
+
+    center = encode(lat, lng, start_precision)
+    for precision in range(start_precision, 0, -1):
+        radius = _covered_radius_km(lat, precision)
+        candidates = base.filter(range_filter(Activity.geohash, sorted(neighbors(center[:precision])))) \
+            .order_by(order).limit(limit).all()
+        scored = ranked(candidates)
+        if len(scored) >= k and scored[k - 1][0] <= radius:
+            return scored[:k]
+        if max_km is not None and max_km <= radius:
+            return scored[:k]
+    # Fewer than k within the widest ring: the closest rows anywhere.
+    return ranked(base.order_by(order).limit(limit).all())[:k]
@@ -0,0 +1,162 @@
+# Seeded generator for realistic trips, activities and todos across Vietnam.
+# The same seed and sizes always produce the same rows, so benchmark runs on
+# different commits measure the same data.
+import argparse
+import random
+from datetime import date, datetime, time, timedelta
+from models import Trip, Activity, Todo
+from spatial import geohash_for
+import versions
+import budget
+import changelog
+
+INSERT_BATCH_SIZE = 2000
+
+# name, latitude, longitude, spread in degrees around the centre
+PLACES = [
+    ('Hà Nội', 21.0285, 105.8542, 0.05),
+    ('Hạ Long', 20.9101, 107.1839, 0.08),
+    ('Sa Pa', 22.3364, 103.8438, 0.05),
+    ('Hà Giang', 22.8233, 104.9784, 0.08),
+    ('Ninh Bình', 20.2506, 105.9745, 0.06),
+    ('Phong Nha', 17.5906, 106.2833, 0.06),
+    ('Huế', 16.4637, 107.5909, 0.04),
+    ('Đà Nẵng', 16.0544, 108.2022, 0.05),
+    ('Hội An', 15.8801, 108.3380, 0.03),
+    ('Quy Nhơn', 13.7830, 109.2197, 0.04),
+    ('Nha Trang', 12.2388, 109.1967, 0.05),
+    ('Đà Lạt', 11.9404, 108.4583, 0.04),
+    ('Buôn Ma Thuột', 12.6667, 108.0500, 0.05),
+    ('Mũi Né', 10.9333, 108.2833, 0.04),
+    ('Vũng Tàu', 10.3460, 107.0843, 0.04),
+    ('TP. Hồ Chí Minh', 10.7769, 106.7009, 0.06),
+    ('Cần Thơ', 10.0452, 105.7469, 0.05),
+    ('Phú Quốc', 10.2899, 103.9840, 0.08),
+]
+
+ACTIVITIES = {
+    'Food': ['Phở bò', 'Bún chả', 'Bánh mì', 'Cao lầu', 'Cơm tấm', 'Bánh xèo', 'Cà phê trứng',
+             'Bún bò Huế', 'Mì Quảng', 'Hải sản nướng', 'Chè', 'Lẩu dê'],
+    'Sightseeing': ['Phố cổ walk', 'Chùa visit', 'Bảo tàng', 'Chợ đêm', 'Old town by lantern light',
+                    'Viewpoint at sunset', 'Citadel tour', 'Waterfall hike'],
+    'Transportation': ['Grab to hotel', 'Xe khách', 'Sleeper train', 'Domestic flight', 'Motorbike rental'],
+    'Accommodation': ['Check in at homestay', 'Check in at hotel', 'Check out'],
+    'Entertainment': ['Water puppet show', 'Cooking class', 'Kayaking', 'Boat trip', 'Night market music'],
+    'Shopping': ['Tailor fitting', 'Souvenir shopping', 'Chợ Bến Thành', 'Coffee beans'],
+    'Other': ['Buy SIM card', 'Exchange money', 'Laundry', 'Free afternoon'],
+}
+CATEGORY_WEIGHTS = [5, 4, 2, 1, 2, 1, 1]
+
+# Typical prices in VND.
+PRICE_RANGES = {
+    'Food': (25000, 350000),
+    'Sightseeing': (0, 200000),
+    'Transportation': (30000, 2500000),
+    'Accommodation': (300000, 3000000),
+    'Entertainment': (100000, 1200000),
+    'Shopping': (50000, 2000000),
+    'Other': (0, 300000),
+}
+
+TODOS = ['Apply for e-visa', 'Buy travel insurance', 'Book sleeper train', 'Exchange money to VND',
+         'Buy local SIM card', 'Pack rain jacket', 'Download offline maps', 'Book Hạ Long cruise',
+         'Confirm homestay', 'Get vaccinations', 'Print booking confirmations', 'Buy motion sickness pills']
+
+
+def _trip(rng, start):
+    length = rng.randint(5, 21)
+    first = rng.randrange(len(PLACES) - 3)
+    route = PLACES[first:first + rng.randint(2, 4)]
+    if rng.random() < 0.5:
+        route = route[::-1]
+    begin = start + timedelta(days=rng.randrange(365))
+    return {
+        'name': f"{' - '.join(place[0] for place in route)} {begin.year}",
+        'start_date': begin,
+        'end_date': begin + timedelta(days=length - 1),
+        'created_at': datetime.combine(begin - timedelta(days=30), time(9))
+    }, route
+
+
+def _activity(rng, trip_id, trip, route):
+    days = (trip['end_date'] - trip['start_date']).days + 1
+    day = rng.randrange(days)
+    name, lat, lng, spread = route[min(day * len(route) // days, len(route) - 1)]
+    category = rng.choices(list(ACTIVITIES), CATEGORY_WEIGHTS)[0]
+    low, high = PRICE_RANGES[category]
+    row = {
+        'trip_id': trip_id,
+        'date': trip['start_date'] + timedelta(days=day),
+        'title': f"{rng.choice(ACTIVITIES[category])} ({name})",
+        'location': name,
+        'category': category,
+        'description': f"{category} in {name}",
+        'price': float(rng.randrange(low, high + 1, 1000)) if rng.random() < 0.85 else None,
+        'created_at': trip['created_at'],
+        'start_time': None,
+        'end_time': None,
+        'latitude': None,
+        'longitude': None
+    }
+    if rng.random() < 0.8:
+        start = rng.randrange(7 * 60, 21 * 60, 30)
+        end = min(start + rng.choice([30, 60, 90, 120, 180]), 23 * 60 + 59)
+        row['start_time'] = time(start // 60, start % 60)
+        row['end_time'] = time(end // 60, end % 60)
+    if rng.random() < 0.9:
+        row['latitude'] = round(lat + rng.uniform(-spread, spread), 6)
+        row['longitude'] = round(lng + rng.uniform(-spread, spread), 6)
+    row['geohash'] = geohash_for(row['latitude'], row['longitude'])
+    return row
+
+
+def insert_rows(session, table, rows):
+    ids = []
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[start:start + INSERT_BATCH_SIZE]
+        ids.extend(session.execute(table.insert().returning(table.c.id), batch).scalars().all())
+    return ids
+
+
+def generate(session, trips=10, activities=200, todos=20, seed=42, start=date(2025, 1, 1)):
+    # Inserts `trips` trips with `activities` activities and `todos` todos
+    # each, keeping the budget rollups and change log in step. Returns the new
+    # trip ids.
+    rng = random.Random(seed)
+    trip_rows, routes = zip(*(_trip(rng, start) for _ in range(trips))) if trips else ((), ())
+    trip_ids = insert_rows(session, Trip.__table__, list(trip_rows))
+    for trip_id, trip, route in zip(trip_ids, trip_rows, routes):
+        activity_rows = [_activity(rng, trip_id, trip, route) for _ in range(activities)]
+        todo_rows = [{
+            'trip_id': trip_id,
+            'title': rng.choice(TODOS),
+            'description': None,
+            'is_completed': rng.random() < 0.3,
+            'created_at': trip['created_at']
+        } for _ in range(todos)]
+        activity_ids = insert_rows(session, Activity.__table__, activity_rows)
+        todo_ids = insert_rows(session, Todo.__table__, todo_rows)
+        changelog.log_rows(session, 'trip', trip_id, [trip_id])
+        changelog.log_rows(session, 'activity', trip_id, activity_ids)
+        changelog.log_rows(session, 'todo', trip_id, todo_ids)
+    budget.rebuild(session, trip_ids)
+    versions.touch(session, *trip_ids)
+    session.commit()
+    return trip_ids
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Insert seeded synthetic trips into DATABASE_URL.')
+    parser.add_argument('--trips', type=int, default=10)
+    parser.add_argument('--activities', type=int, default=200, help='activities per trip')
+    parser.add_argument('--todos', type=int, default=20, help='todos per trip')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    from wsgi import create_app
+    from models import db
+    import migrations
+    with create_app().app_context():
+        migrations.upgrade(db.engine)
+        trip_ids = generate(db.session, args.trips, args.activities, args.todos, args.seed)
+        print(f"Created {len(trip_ids)} trips with {args.activities} activities and {args.todos} todos each.")
@@ -0,0 +1,48 @@
+from datetime import date
+
+import pytest
+
+import fragments
+import response_cache
+from models import db, Trip, Activity
+from wsgi import create_app
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'SECRET_KEY': 'test',
+        'TESTING': True,
+    })
+    # Cached responses are keyed on change tokens, which restart with every
+    # database.
+    response_cache.cache.clear()
+    fragments.cache.clear()
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def trip(app):
+    trip = Trip(name='Hanoi', start_date=date(2024, 1, 1), end_date=date(2024, 1, 5))
+    db.session.add(trip)
+    db.session.commit()
+    return trip
+
+
+@pytest.fixture
+def add_activity(trip):
+    def add(title, day, start=None, end=None):
+        activity = Activity(trip_id=trip.id, title=title, date=day, start_time=start, end_time=end)
+        db.session.add(activity)
+        db.session.commit()
+        return activity
+    return add
@@ -0,0 +1,86 @@
+from datetime import date, time
+
+import pytest
+
+from models import db, Activity, Trip
+
+
+def _schedule(trip_id):
+    db.session.expire_all()
+    return [(a.title, a.date, a.start_time, a.end_time)
+            for a in Activity.query.filter_by(trip_id=trip_id).order_by(Activity.title)]
+
+
+def test_shift_minutes_across_midnight(client, trip, add_activity):
+    add_activity('late', date(2024, 1, 2), time(23, 30), time(23, 45))
+    add_activity('all day', date(2024, 1, 3))
+    response = client.post(f'/api/trips/{trip.id}/activities/shift', json={'minutes': 60})
+    assert response.status_code == 200
+    assert response.get_json()['shifted'] == 2
+    assert _schedule(trip.id) == [
+        ('all day', date(2024, 1, 3), None, None),
+        ('late', date(2024, 1, 3), time(0, 30), time(0, 45)),
+    ]
+
+
+def test_shift_back_across_midnight_and_days(client, trip, add_activity):
+    add_activity('early', date(2024, 1, 3), time(0, 15), time(1, 0))
+    response = client.post(f'/api/trips/{trip.id}/activities/shift', json={'days': 1, 'minutes': -30})
+    assert response.status_code == 200
+    assert _schedule(trip.id) == [('early', date(2024, 1, 3), time(23, 45), time(0, 30))]
+
+
+@pytest.mark.parametrize('body', [[1], 'x', {'days': 1.5}, {'days': True}, {}])
+def test_shift_rejects_bad_bodies(client, trip, body):
+    response = client.post(f'/api/trips/{trip.id}/activities/shift', json=body)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('body', [{'days': 1000000}, {'days': -4000}, {'minutes': 10 ** 9}])
+def test_shift_rejects_out_of_range_offsets(client, trip, add_activity, body):
+    add_activity('a', date(2024, 1, 2), time(9, 0), time(10, 0))
+    response = client.post(f'/api/trips/{trip.id}/activities/shift', json=body)
+    assert response.status_code == 400
+    assert _schedule(trip.id) == [('a', date(2024, 1, 2), time(9, 0), time(10, 0))]
+
+
+@pytest.mark.parametrize('body', [[1, 2], 'x', None, {'create': {'title': 'a'}}])
+def test_batch_rejects_non_object_bodies(client, trip, body):
+    response = client.post(f'/api/trips/{trip.id}/activities/batch', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_batch_stale_update_is_refused(client, trip, add_activity):
+    activity = add_activity('a', date(2024, 1, 2), time(9, 0), time(10, 0))
+    url = f'/api/trips/{trip.id}/activities/batch'
+    first = client.post(url, json={'update': [{'id': activity.id, 'version': 1, 'title': 'b'}]})
+    assert first.status_code == 200
+    second = client.post(url, json={'update': [{'id': activity.id, 'version': 1, 'title': 'c'}]})
+    assert second.status_code == 409
+    assert second.get_json()['versions'] == {str(activity.id): 2}
+    assert _schedule(trip.id)[0][0] == 'b'
+
+
+def test_batch_conflict_rolls_back_everything(client, trip, add_activity):
+    add_activity('a', date(2024, 1, 2), time(9, 0), time(10, 0))
+    response = client.post(f'/api/trips/{trip.id}/activities/batch', json={'create': [
+        {'title': 'ok', 'date': '2024-01-03', 'startTime': '09:00', 'endTime': '10:00'},
+        {'title': 'clash', 'date': '2024-01-02', 'startTime': '09:30', 'endTime': '10:30'},
+    ]})
+    assert response.status_code == 409
+    assert [row[0] for row in _schedule(trip.id)] == ['a']
+
+
+def test_reschedule_moves_activities_and_checks_version(client, trip, add_activity):
+    add_activity('a', date(2024, 1, 2), time(9, 0), time(10, 0))
+    url = f'/api/trips/{trip.id}/reschedule'
+    response = client.post(url, json={'startDate': '2024-02-01', 'version': 1})
+    assert response.status_code == 200
+    assert response.get_json()['shiftedDays'] == 31
+    stale = client.post(url, json={'startDate': '2024-03-01', 'version': 1})
+    assert stale.status_code == 409
+    assert stale.get_json()['current']['version'] == 2
+    db.session.expire_all()
+    assert db.session.get(Trip, trip.id).start_date == date(2024, 2, 1)
+    assert _schedule(trip.id)[0][1] == date(2024, 2, 2)
@@ -0,0 +1,71 @@
+from datetime import date
+
+import pytest
+
+import snapshots
+from models import db, Activity, ChangeLog
+
+
+def _entries():
+    return [(entry.entity, entry.entity_id, entry.deleted)
+            for entry in ChangeLog.query.order_by(ChangeLog.id)]
+
+
+def test_entries_are_written_on_commit_only(app, trip):
+    before = _entries()
+    db.session.add(Activity(trip_id=trip.id, title='a', date=date(2024, 1, 2)))
+    db.session.flush()
+    assert _entries() == before
+    db.session.rollback()
+    assert _entries() == before
+    activity = Activity(trip_id=trip.id, title='b', date=date(2024, 1, 2))
+    db.session.add(activity)
+    db.session.commit()
+    assert _entries() == before + [('activity', activity.id, False)]
+
+
+def test_changes_since_reports_updates_and_deletes(app, trip, add_activity):
+    kept = add_activity('kept', date(2024, 1, 2))
+    gone = add_activity('gone', date(2024, 1, 3))
+    token = snapshots.latest_token()
+    kept.title = 'renamed'
+    db.session.delete(gone)
+    db.session.commit()
+
+    changes = snapshots.changes_since(token)
+    assert changes['token'] == snapshots.latest_token()
+    assert changes['more'] is False
+    activities = changes['activities']
+    rows = [dict(zip(activities['fields'], row)) for row in activities['rows']]
+    assert [(row['id'], row['title']) for row in rows] == [(kept.id, 'renamed')]
+    assert changes['deleted'] == {'activities': [gone.id]}
+
+
+def test_changes_since_created_then_deleted_is_a_delete(app, trip, add_activity):
+    token = snapshots.latest_token()
+    activity = add_activity('brief', date(2024, 1, 2))
+    db.session.delete(activity)
+    db.session.commit()
+    changes = snapshots.changes_since(token)
+    assert 'activities' not in changes
+    assert changes['deleted'] == {'activities': [activity.id]}
+
+
+def test_changes_since_pages_with_more(app, trip, add_activity):
+    token = snapshots.latest_token()
+    ids = [add_activity(f'a{n}', date(2024, 1, 2)).id for n in range(3)]
+    first = snapshots.changes_since(token, limit=2)
+    assert first['more'] is True
+    second = snapshots.changes_since(first['token'], limit=2)
+    assert second['more'] is False
+    seen = [row[0] for page in (first, second) for row in page['activities']['rows']]
+    assert seen == ids
+
+
+def test_changes_since_rejects_tokens_ahead(app, trip):
+    with pytest.raises(snapshots.TokenAhead):
+        snapshots.changes_since(snapshots.latest_token() + 1)
+
+
+def test_sync_endpoint_reports_token_ahead_as_gone(client, trip):
+    assert client.get('/api/sync?since=999').status_code == 410
@@ -0,0 +1,115 @@
+import threading
+from collections import defaultdict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+import changelog
+
+# Per-trip change counters used as keys for this process's caches. Counters
+# are bumped only after a commit succeeds, so a reader can never cache
+# uncommitted state under a new version. Key None is the global counter,
+# bumped on any trip change. Commits made by other processes reach them
+# through changelog.follow(), within CHANGES_POLL_SECONDS. The counters mean
+# nothing outside this process; anything shared, like an ETag, uses the
+# change_log token instead.
+_lock = threading.Lock()
+_versions = defaultdict(int)
+# Per-day counters for the activities of one trip date, so a page built from
+# per-day fragments re-renders only the days an edit touched. _all_days is
+# bumped when the days changed are not known and stales every day of a trip.
+_days = defaultdict(int)
+_all_days = defaultdict(int)
+
+PENDING_KEY = 'pending_trip_versions'
+PENDING_DAYS_KEY = 'pending_day_versions'
+
+
+def current(trip_id=None):
+    return _versions[trip_id]
+
+
+def day(trip_id, date):
+    return (_all_days.get(trip_id, 0), _days.get((trip_id, date), 0))
+
+
+def bump(*trip_ids):
+    with _lock:
+        for trip_id in set(trip_ids):
+            _versions[trip_id] += 1
+        _versions[None] += 1
+
+
+def bump_days(days):
+    # days: (trip_id, date) pairs; a date of None means every day of the trip.
+    with _lock:
+        for trip_id, date in set(days):
+            if date is None:
+                _all_days[trip_id] += 1
+            else:
+                _days[(trip_id, date)] += 1
+
+
+def touch(session, *trip_ids, dates=None):
+    # For writes that bypass the ORM unit of work (Core inserts/updates).
+    # `dates` are the activity dates written, old and new; without them every
+    # day of the trips is taken to have changed.
+    session.info.setdefault(PENDING_KEY, set()).update(trip_ids)
+    days = session.info.setdefault(PENDING_DAYS_KEY, set())
+    for trip_id in trip_ids:
+        days.update((trip_id, date) for date in (dates if dates is not None else [None]))
+
+
+def _trip_ids(obj):
+    if hasattr(obj, 'trip_id'):
+        ids = {obj.trip_id}
+        history = inspect(obj).attrs.trip_id.history
+        ids.update(history.deleted or ())
+        return ids
+    if type(obj).__name__ == 'Trip':
+        return {obj.id}
+    return set()
+
+
+def _days_of(obj, trip_ids):
+    # Activities: every (trip, date) the object was or now is on.
+    if not hasattr(obj, 'date') or not hasattr(obj, 'trip_id'):
+        return set()
+    dates = {obj.date}
+    dates.update(inspect(obj).attrs.date.history.deleted or ())
+    return {(trip_id, date) for trip_id in trip_ids for date in dates if trip_id is not None}
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, flush_context):
+    pending = session.info.setdefault(PENDING_KEY, set())
+    days = session.info.setdefault(PENDING_DAYS_KEY, set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        trip_ids = _trip_ids(obj)
+        pending.update(trip_ids)
+        days.update(_days_of(obj, trip_ids))
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    days = session.info.pop(PENDING_DAYS_KEY, None)
+    if days:
+        bump_days(days)
+    if pending:
+        pending.discard(None)
+        bump(*pending)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+    session.info.pop(PENDING_DAYS_KEY, None)
+
+
+def _remote(connection, entries):
+    # The log does not say which dates changed, so every day of the trip is.
+    trip_ids = {entry.trip_id for entry in entries}
+    bump_days((trip_id, None) for trip_id in trip_ids)
+    bump(*trip_ids)
+
+
+changelog.on_change(_remote)
@@ -1,4 +1,243 @@
-from . import app as application
+# The single app factory. Production servers load `wsgi:application`; the
+# dev servers in app.py and main.py and the maintenance scripts call
+# create_app() themselves.
+#
+#   gunicorn --preload -k gthread -w 4 --threads 8 wsgi:application
+#
+# With --preload the master builds and warms the app once and every forked
+# worker only drops the master's connections (see _after_fork), opening its
+# own as requests need them. Threaded (or gevent) workers, because every open
+# /events stream holds a thread for as long as the client stays connected;
+# size DB_POOL_SIZE to --threads.
+#
+# Background threads (the change log follower, the reminder scheduler) run
+# only in workers, never in the master: each process starts them on its
+# first request. To start them as soon as a worker is up, call
+# start_services() from a gunicorn post_fork hook:
+#
+#   def post_fork(server, worker):
+#       import wsgi
+#       wsgi.start_services(wsgi.application)
+import logging
+import os
+import time
+import weakref
+from flask import Flask
+from flask_cors import CORS
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value not in (None, '') else default
+
+
+def _env_flag(name, default):
+    value = os.getenv(name)
+    return value.lower() not in ('0', 'false', 'no', 'off') if value not in (None, '') else default
+
+
+def default_config():
+    # Read from the environment on every create_app() call; anything passed in
+    # `config` wins.
+    return {
+        'SQLALCHEMY_DATABASE_URI': os.getenv('DATABASE_URL'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SECRET_KEY': os.getenv('FLASK_SECRET_KEY'),
+        'GOOGLE_MAPS_API_KEY': os.getenv('GOOGLE_MAPS_API_KEY'),
+        # Per process. Size the pool for the worker's thread count; overflow
+        # connections are opened and closed on demand, which is the churn
+        # that shows up under load, so keep it small.
+        'DB_POOL_SIZE': _env_int('DB_POOL_SIZE', 5),
+        'DB_MAX_OVERFLOW': _env_int('DB_MAX_OVERFLOW', 2),
+        'DB_POOL_TIMEOUT': _env_int('DB_POOL_TIMEOUT', 10),
+        # Recycle before typical server/proxy idle timeouts drop connections.
+        'DB_POOL_RECYCLE': _env_int('DB_POOL_RECYCLE', 1800),
+        'DB_POOL_PRE_PING': _env_flag('DB_POOL_PRE_PING', True),
+        # Postgres statement_timeout in milliseconds; 0 disables it.
+        'DB_STATEMENT_TIMEOUT_MS': _env_int('DB_STATEMENT_TIMEOUT_MS', 15000),
+        # Connections opened by warmup(); defaults to DB_POOL_SIZE.
+        'DB_POOL_WARM': _env_int('DB_POOL_WARM', None),
+        # External weather and exchange-rate APIs (see gateway.py).
+        'WEATHER_API_URL': os.getenv('WEATHER_API_URL'),
+        'RATES_API_URL': os.getenv('RATES_API_URL'),
+        'GATEWAY_TIMEOUT': _env_int('GATEWAY_TIMEOUT', 5),
+        # Reminder scheduler (see reminders.py); REMINDER_SINK is 'log',
+        # 'file:<path>' or a sink object.
+        'REMINDERS_ENABLED': _env_flag('REMINDERS_ENABLED', False),
+        'REMINDER_SINK': os.getenv('REMINDER_SINK'),
+        'REMINDER_LEAD_MINUTES': _env_int('REMINDER_LEAD_MINUTES', 60),
+        'TODO_REMINDER_DAYS': _env_int('TODO_REMINDER_DAYS', 3),
+        # How soon this process's caches and search index pick up writes made
+        # by other workers (see changelog.Follower).
+        'CHANGES_POLL_SECONDS': _env_int('CHANGES_POLL_SECONDS', 1),
+        # Push updates (see events.py): how often other workers' changes are
+        # picked up.
+        'EVENTS_POLL_SECONDS': _env_int('EVENTS_POLL_SECONDS', 1),
+        # Offline geocoding of activity locations (see gazetteer.py); the
+        # compiled file is rebuilt when the source is newer.
+        'GAZETTEER_SOURCE': os.getenv('GAZETTEER_SOURCE'),
+        'GAZETTEER_PATH': os.getenv('GAZETTEER_PATH'),
+        'GEOCODE_CACHE_SIZE': _env_int('GEOCODE_CACHE_SIZE', 65536),
+        # Serve /api/debug/metrics and Server-Timing headers (see
+        # instrumentation.py) outside debug mode.
+        'DEBUG_METRICS': _env_flag('DEBUG_METRICS', False),
+        # Warn when create_app() + warmup() take longer than this.
+        'STARTUP_BUDGET_MS': _env_int('STARTUP_BUDGET_MS', 1500),
+    }
+
+
+def engine_options(config):
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if not uri:
+        return {}
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        # In-process connections: nothing to pool, ping or time out.
+        return {}
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if url.get_backend_name() == 'postgresql' and config['DB_STATEMENT_TIMEOUT_MS']:
+        options['connect_args'] = {'options': f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"}
+    return options
+
+
+def create_app(config=None):
+    started = time.perf_counter()
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    app = Flask(__name__)
+    app.config.update(default_config())
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    CORS(app)
+
+    from models import db, Trip, Activity, Todo
+    import instrumentation
+    import routes
+    import app as api
+    import main
+    db.init_app(app)
+    instrumentation.install(app)
+    app.register_blueprint(routes.init_routes(db, Trip, Activity, Todo))
+    app.register_blueprint(api.bp)
+    app.register_blueprint(main.bp)
+
+    app.extensions['startup'] = {'createAppMs': round((time.perf_counter() - started) * 1000, 1)}
+    return app
+
+
+def _warm_pool(engine, size):
+    # Hold `size` connections at once so the pool really opens that many; the
+    # first one also runs the dialect's first-connect queries.
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def _after_fork(app_ref):
+    # Runs in the child of any fork, not only a server worker, so it does
+    # nothing but drop the parent's connections without closing them (the
+    # parent still owns the sockets); the child opens its own when it needs
+    # them.
+    app = app_ref()
+    if app is None:
+        return
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def start_services(app):
+    # Once per process. Every worker follows the change log for its caches and
+    # runs a scheduler; only the one holding the scheduler's lock delivers,
+    # the rest stand by.
+    if app.extensions.get('services') == os.getpid():
+        return
+    app.extensions['services'] = os.getpid()
+    import changelog
+    changelog.follow(app)
+    if app.config['REMINDERS_ENABLED']:
+        import reminders
+        reminders.start(app)
+
+
+def _pool_warm_size(app):
+    if app.config['DB_POOL_WARM'] is not None:
+        return app.config['DB_POOL_WARM']
+    return app.config['DB_POOL_SIZE'] if app.config['SQLALCHEMY_ENGINE_OPTIONS'] else 1
+
+
+def warmup(app):
+    # Does the first-request work up front: compiles every template, configures
+    # the ORM mappers, opens the pool and maps the gazetteer.
+    from sqlalchemy.orm import configure_mappers
+    from models import db
+    timings = app.extensions.setdefault('startup', {})
+
+    started = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    timings['templatesMs'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    configure_mappers()
+    timings['mappersMs'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    with app.app_context():
+        _warm_pool(db.engine, _pool_warm_size(app))
+    timings['poolMs'] = round((time.perf_counter() - started) * 1000, 1)
+
+    # Mapped before any fork, so workers share the pages.
+    started = time.perf_counter()
+    import gazetteer
+    gazetteer.get_geocoder(app)
+    timings['gazetteerMs'] = round((time.perf_counter() - started) * 1000, 1)
+
+    # Background threads are not started here: this may be a --preload
+    # master, whose threads would not survive the fork. Fork hooks cannot be
+    # removed, so they are registered once per app.
+    if not app.extensions.get('fork_hooks'):
+        app.extensions['fork_hooks'] = True
+        if hasattr(os, 'register_at_fork'):
+            app_ref = weakref.ref(app)
+            os.register_at_fork(after_in_child=lambda: _after_fork(app_ref))
+        app.before_request(lambda: start_services(app))
+
+    total = sum(timings.values())
+    timings['totalMs'] = round(total, 1)
+    if total > app.config['STARTUP_BUDGET_MS']:
+        logger.warning(f"Startup took {total:.0f} ms, over the {app.config['STARTUP_BUDGET_MS']} ms budget: {timings}")
+    else:
+        logger.info(f"Ready in {total:.0f} ms: {timings}")
+    return app
+
+
+def __getattr__(name):
+    # `application` is built on first access, so importing create_app (the
+    # scripts, the benchmark) does not build and warm an app as a side effect.
+    if name == 'application':
+        global application
+        logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+        application = warmup(create_app())
+        return application
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
-    application.run()
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+    warmup(create_app()).run()